@@ -0,0 +1,120 @@
+# encoding: utf-8
+# Control de admisión de las conexiones nuevas al server
+
+import threading
+import time
+from collections import Counter, deque
+from constants import *
+
+# Decisiones de AdmissionController.admit
+ADMIT = 'admit'     # Atenderla ya
+QUEUE = 'queue'     # Quedó en espera hasta que se libere un lugar
+REJECT = 'reject'   # Contestarle SERVER_BUSY y cerrarla
+
+
+class AdmissionController(object):
+    """
+    Decide qué hacer con cada conexión nueva, para que bajo sobrecarga el
+    server conteste enseguida en lugar de dejar a los clientes esperando
+    sin respuesta.
+
+    Se atienden a la vez a lo sumo 'max_active' conexiones (0 para no
+    limitar). Las que llegan de más esperan en una cola de a lo sumo
+    'max_pending' conexiones, y si la cola está llena se las rechaza. Un
+    mismo cliente (dirección IP) no puede tener más de 'max_per_client'
+    conexiones entre atendidas y en espera (0 para no limitar).
+
+    Las conexiones se guardan como objetos cualesquiera ('item'): el server
+    decide qué guarda (un socket, un future, ...) y qué hace con la
+    conexión cuando le toca ser atendida.
+
+    Esta es la cola donde esperan las conexiones cuando el server está
+    saturado (en el modo threads, por defecto se admiten tantas como hilos
+    tiene el pool, así que la cola del pool queda vacía), así que acá se
+    mide cuánto esperan (ver stats).
+
+    Se puede usar desde varios hilos a la vez.
+    """
+
+    def __init__(self, max_active: int = 0, max_pending: int = MAX_PENDING,
+                 max_per_client: int = 0):
+        self.max_active = max_active
+        self.max_pending = max_pending
+        self.max_per_client = max_per_client
+        self.active = 0
+        # Tripletas (momento en que se encoló, item, host) de las
+        # conexiones que esperan lugar
+        self.pending = deque()
+        # Conexiones (atendidas o en espera) de cada cliente
+        self.clients = Counter()
+        self.lock = threading.Lock()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def admit(self, item, host: str) -> str:
+        """
+        Decide qué hacer con la conexión nueva del cliente 'host'. Devuelve
+        ADMIT, QUEUE (la conexión queda guardada y la devuelve release
+        cuando le toca) o REJECT.
+        """
+        with self.lock:
+            if (self.max_per_client > 0
+                    and self.clients[host] >= self.max_per_client):
+                self.rejected += 1
+                return REJECT
+            if self.max_active == 0 or self.active < self.max_active:
+                self.active += 1
+                self.admitted += 1
+                decision = ADMIT
+            elif len(self.pending) < self.max_pending:
+                self.pending.append((time.monotonic(), item, host))
+                self.queued += 1
+                decision = QUEUE
+            else:
+                self.rejected += 1
+                return REJECT
+            self.clients[host] += 1
+            return decision
+
+    def release(self, host: str):
+        """
+        Avisa que terminó una conexión atendida del cliente 'host'.
+        Devuelve la conexión en espera que pasa a ser atendida en su lugar
+        (el 'item' que se dio en admit), o None si no hay ninguna.
+        """
+        with self.lock:
+            self.clients[host] -= 1
+            if self.clients[host] == 0:
+                del self.clients[host]
+            if self.pending:
+                queued_at, item, _ = self.pending.popleft()
+                wait = time.monotonic() - queued_at
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.admitted += 1
+                return item
+            self.active -= 1
+            return None
+
+    def stats(self) -> dict:
+        """
+        Devuelve el estado del control de admisión: conexiones atendidas y
+        en espera, cuántas se admitieron, encolaron y rechazaron en total,
+        y espera promedio y máxima (en segundos) de las que ya salieron de
+        la cola, contando también cuánto lleva esperando la primera que
+        sigue en la cola.
+        """
+        with self.lock:
+            dequeued = self.queued - len(self.pending)
+            max_wait = self.max_wait
+            if self.pending:
+                max_wait = max(max_wait,
+                               time.monotonic() - self.pending[0][0])
+            return {'active': self.active, 'pending': len(self.pending),
+                    'admitted': self.admitted, 'queued': self.queued,
+                    'rejected': self.rejected,
+                    'average_wait': self.total_wait / max(dequeued, 1),
+                    'max_wait': max_wait}
@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# Generador de carga para medir el rendimiento del server HFTP
+
+import datetime
+import json
+import logging
+import math
+import optparse
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import client
+from constants import *
+
+# Proporción de cada tipo de pedido, y de cada tamaño de archivo (en bytes)
+DEFAULT_MIX = 'listing=1,metadata=4,slice=5'
+DEFAULT_SIZES = '4096=6,1048576=3,16777216=1'
+OPERATIONS = ['listing', 'metadata', 'slice', 'slice_raw']
+
+# Los archivos que crea el benchmark se llaman bench_0000, bench_0001, ...
+BENCH_PREFIX = 'bench_'
+
+
+def parse_weights(text: str, convert=str) -> list:
+    """
+    Convierte un texto de la forma 'a=1,b=2.5' en una lista de pares
+    (convert(a), 1.0), (convert(b), 2.5). Falla con ValueError si el texto
+    no tiene esa forma.
+    """
+    result = []
+    for item in text.split(','):
+        key, weight = item.split('=')
+        result.append((convert(key.strip()), float(weight)))
+        if result[-1][1] < 0:
+            raise ValueError
+    if sum(weight for _, weight in result) <= 0:
+        raise ValueError
+    return result
+
+
+def choose(rng: random.Random, weights: list):
+    """
+    Elige una clave de la lista de pares (clave, peso), con probabilidad
+    proporcional a su peso.
+    """
+    keys = [key for key, _ in weights]
+    return rng.choices(keys, [weight for _, weight in weights])[0]
+
+
+def percentile(values: list, fraction: float) -> float:
+    """
+    Percentil (por rango más cercano) de una lista ordenada no vacía.
+    """
+    rank = max(1, math.ceil(fraction * len(values)))
+    return values[rank - 1]
+
+
+def summarize(latencies: list) -> dict:
+    """
+    Resumen de una lista de latencias en segundos: cantidad, y promedio,
+    percentiles 50, 99 y 99.9 y máximo en milisegundos.
+    """
+    if not latencies:
+        return {'count': 0}
+    values = sorted(latencies)
+    return {'count': len(values),
+            'mean': 1000 * sum(values) / len(values),
+            'p50': 1000 * percentile(values, 0.5),
+            'p99': 1000 * percentile(values, 0.99),
+            'p999': 1000 * percentile(values, 0.999),
+            'max': 1000 * values[-1]}
+
+
+def process_cpu(pid: int):
+    """
+    Segundos de CPU (usuario y sistema) que usaron el proceso 'pid' y sus
+    hijos directos que siguen vivos (los workers del server), leídos de
+    /proc. Devuelve None si no se pudieron leer.
+    """
+    ticks = os.sysconf('SC_CLK_TCK')
+
+    def read_stat(p):
+        with open(f'/proc/{p}/stat') as f:
+            # El nombre del proceso (entre paréntesis) puede tener espacios
+            fields = f.read().rsplit(')', 1)[1].split()
+        return int(fields[1]), int(fields[11]) + int(fields[12])
+
+    try:
+        _, total = read_stat(pid)
+    except (OSError, ValueError, IndexError):
+        return None
+    for entry in os.listdir('/proc'):
+        if entry.isdecimal():
+            try:
+                ppid, used = read_stat(entry)
+            except (OSError, ValueError, IndexError):
+                continue
+            if ppid == pid:
+                total += used
+    return total / ticks
+
+
+def git_commit():
+    """
+    Commit actual del repositorio, o None si no se puede saber.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def setup_files(datadir: str, count: int, sizes: list, seed: int) -> list:
+    """
+    Crea en 'datadir' (el directorio que comparte el server) 'count'
+    archivos con tamaños elegidos al azar según 'sizes'. Los archivos que ya
+    existen con el tamaño correcto no se vuelven a escribir. Devuelve la
+    lista de pares (nombre, tamaño).
+    """
+    rng = random.Random(seed)
+    block = rng.randbytes(2 ** 20)
+    files = []
+    for i in range(count):
+        filename = '%s%04d' % (BENCH_PREFIX, i)
+        size = choose(rng, sizes)
+        pathname = os.path.join(datadir, filename)
+        if not (os.path.isfile(pathname)
+                and os.path.getsize(pathname) == size):
+            with open(pathname, 'wb') as f:
+                remaining = size
+                while remaining > 0:
+                    remaining -= f.write(block[:remaining])
+        files.append((filename, size))
+    return files
+
+
+def discover_files(c: client.Client) -> list:
+    """
+    Lista de pares (nombre, tamaño) de los archivos que ya tiene el server.
+    """
+    files = []
+    for filename in c.file_lookup():
+        size = c.get_metadata(filename)
+        if c.status == CODE_OK:
+            files.append((filename, size))
+    return files
+
+
+class Worker(threading.Thread):
+    """
+    Hilo que manda pedidos al server por su propia conexión, uno detrás de
+    otro, hasta 'deadline' o hasta mandar 'requests' pedidos (si no es
+    None), y guarda la latencia de cada uno.
+    """
+
+    def __init__(self, options, files: list, mix: list, deadline: float,
+                 requests, seed: int):
+        super().__init__(daemon=True)
+        self.options = options
+        self.files = files
+        self.mix = mix
+        self.deadline = deadline
+        self.requests = requests
+        self.rng = random.Random(seed)
+        # Tipo de pedido -> lista de latencias en segundos
+        self.latencies = {operation: [] for operation in OPERATIONS}
+        self.errors = 0
+        self.bytes = 0
+
+    def receive(self, data):
+        self.bytes += len(data)
+
+    def run(self):
+        c = None
+        done = 0
+        while time.monotonic() < self.deadline and (self.requests is None
+                                                    or done < self.requests):
+            operation = choose(self.rng, self.mix)
+            start = time.perf_counter()
+            try:
+                if c is None:
+                    c = client.Client(self.options.server, self.options.port)
+                ok = self.request(c, operation)
+                if not c.connected:
+                    c = None
+            except (OSError, ValueError):
+                # Se cortó la conexión (o el server la rechazó); se cuenta
+                # como error y se abre otra
+                ok = False
+                c = None
+            self.latencies[operation].append(time.perf_counter() - start)
+            if not ok:
+                self.errors += 1
+            done += 1
+        if c is not None:
+            try:
+                c.close()
+            except OSError:
+                pass
+
+    def request(self, c: client.Client, operation: str) -> bool:
+        """
+        Manda un pedido del tipo dado, y devuelve si salió bien.
+        """
+        if operation == 'listing':
+            c.file_lookup()
+            return c.status == CODE_OK
+
+        filename, size = self.rng.choice(self.files)
+        if operation == 'metadata':
+            c.get_metadata(filename)
+            return c.status == CODE_OK
+
+        length = min(size, self.rng.randint(1, self.options.slice_size))
+        start = self.rng.randint(0, size - length)
+        if operation == 'slice':
+            c.get_slice(filename, start, length, self.receive)
+        else:
+            c.get_slice_raw(filename, start, length, self.receive)
+        return c.status == CODE_OK
+
+
+def run(options, files: list, mix: list) -> dict:
+    """
+    Corre el benchmark y devuelve los resultados.
+    """
+    requests = None
+    if options.requests > 0:
+        requests = -(-options.requests // options.connections)
+    deadline = time.monotonic() + options.duration
+    workers = [Worker(options, files, mix, deadline, requests,
+                      options.seed + i)
+               for i in range(options.connections)]
+
+    cpu_before = None
+    if options.server_pid is not None:
+        cpu_before = process_cpu(options.server_pid)
+    start = time.monotonic()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - start
+    cpu_after = None
+    if cpu_before is not None:
+        cpu_after = process_cpu(options.server_pid)
+
+    latencies = {operation: [] for operation in OPERATIONS}
+    for worker in workers:
+        for operation, values in worker.latencies.items():
+            latencies[operation].extend(values)
+    total = sum(len(values) for values in latencies.values())
+    received = sum(worker.bytes for worker in workers)
+
+    results = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'config': {'server': options.server, 'port': options.port,
+                   'connections': options.connections,
+                   'duration': options.duration,
+                   'requests': options.requests, 'mix': dict(mix),
+                   'files': len(files), 'slice_size': options.slice_size,
+                   'seed': options.seed},
+        'elapsed': elapsed,
+        'requests': total,
+        'errors': sum(worker.errors for worker in workers),
+        'requests_per_second': total / elapsed,
+        'bytes': received,
+        'mb_per_second': received / elapsed / 2 ** 20,
+        'latency_ms': {'all': summarize(sum(latencies.values(), []))},
+        'server_cpu': None,
+    }
+    for operation, values in latencies.items():
+        if values:
+            results['latency_ms'][operation] = summarize(values)
+    if cpu_after is not None:
+        used = cpu_after - cpu_before
+        results['server_cpu'] = {'seconds': used,
+                                 'percent': 100 * used / elapsed}
+    return results
+
+
+def report(results: dict, baseline: dict = None):
+    """
+    Muestra los resultados. Si se da 'baseline' (resultados de otra
+    corrida), muestra también cuánto cambió cada medida.
+    """
+    def compare(value, key, *path):
+        if baseline is None:
+            return ''
+        old = baseline
+        for step in (key,) + path:
+            old = old.get(step) if isinstance(old, dict) else None
+        if not old:
+            return ''
+        return ' (%+.1f%%)' % (100 * (value - old) / old)
+
+    print("Pedidos: %d en %.1f s, %d errores"
+          % (results['requests'], results['elapsed'], results['errors']))
+    value = results['requests_per_second']
+    print("Pedidos por segundo: %.1f%s"
+          % (value, compare(value, 'requests_per_second')))
+    value = results['mb_per_second']
+    print("MB/s: %.2f%s" % (value, compare(value, 'mb_per_second')))
+    if results['server_cpu'] is not None:
+        value = results['server_cpu']['percent']
+        print("CPU del server: %.1f%%%s"
+              % (value, compare(value, 'server_cpu', 'percent')))
+    print("Latencias (ms):%s" % ''.join('%10s' % column for column in
+                                        ['cantidad', 'p50', 'p99', 'p999',
+                                         'max']))
+    for operation, summary in results['latency_ms'].items():
+        columns = ''.join('%10.2f' % summary[column]
+                          for column in ['p50', 'p99', 'p999', 'max'])
+        change = compare(summary['p99'], 'latency_ms', operation, 'p99')
+        print("  %-12s %10d%s%s" % (operation, summary['count'], columns,
+                                    change and ' p99' + change))
+
+
+def main():
+    """Parsea los argumentos y corre el benchmark"""
+
+    parser = optparse.OptionParser(usage="%prog [options] [server]")
+    parser.add_option(
+        "-p", "--port",
+        help="Número de puerto TCP del server", default=DEFAULT_PORT)
+    parser.add_option(
+        "-c", "--connections",
+        help="Cantidad de conexiones simultáneas", default=8)
+    parser.add_option(
+        "-t", "--duration",
+        help="Segundos que dura la prueba", default=10)
+    parser.add_option(
+        "-n", "--requests",
+        help="Cantidad total de pedidos (0 para mandar pedidos hasta que "
+        "termine el tiempo)", default=0)
+    parser.add_option(
+        "--mix",
+        help="Proporción de cada tipo de pedido (%s), por ejemplo '%s'"
+        % (', '.join(OPERATIONS), DEFAULT_MIX), default=DEFAULT_MIX)
+    parser.add_option(
+        "-d", "--datadir",
+        help="Directorio compartido por el server, donde se crean los "
+        "archivos de prueba (tiene que ser local)", default=DEFAULT_DIR)
+    parser.add_option(
+        "-f", "--files",
+        help="Cantidad de archivos de prueba (0 para usar los archivos que "
+        "ya tiene el server)", default=20)
+    parser.add_option(
+        "--sizes",
+        help="Proporción de cada tamaño de archivo de prueba en bytes, por "
+        "ejemplo '%s'" % DEFAULT_SIZES, default=DEFAULT_SIZES)
+    parser.add_option(
+        "--slice-size",
+        help="Tamaño máximo de cada slice pedido", default=2 ** 20)
+    parser.add_option(
+        "--seed",
+        help="Semilla para los números al azar", default=0)
+    parser.add_option(
+        "--server-pid",
+        help="PID del server (local), para medir cuánta CPU usa",
+        default=None)
+    parser.add_option(
+        "-o", "--output",
+        help="Archivo donde guardar los resultados en JSON", default=None)
+    parser.add_option(
+        "--compare",
+        help="Archivo JSON con los resultados de otra corrida, para "
+        "compararlos", default=None)
+
+    options, args = parser.parse_args()
+    if len(args) > 1:
+        parser.print_help()
+        sys.exit(1)
+    options.server = args[0] if args else 'localhost'
+    try:
+        options.port = int(options.port)
+        options.connections = int(options.connections)
+        options.duration = float(options.duration)
+        options.requests = int(options.requests)
+        options.files = int(options.files)
+        options.slice_size = int(options.slice_size)
+        options.seed = int(options.seed)
+        if options.server_pid is not None:
+            options.server_pid = int(options.server_pid)
+        if (options.connections < 1 or options.duration <= 0
+                or options.requests < 0 or options.files < 0
+                or options.slice_size < 1):
+            raise ValueError
+        mix = parse_weights(options.mix)
+        if not set(dict(mix)) <= set(OPERATIONS):
+            raise ValueError
+        sizes = parse_weights(options.sizes, int)
+    except ValueError:
+        sys.stderr.write("Opciones invalidas\n")
+        parser.print_help()
+        sys.exit(1)
+
+    # Los errores se cuentan en los resultados
+    logging.getLogger().setLevel(logging.ERROR)
+
+    baseline = None
+    if options.compare is not None:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+
+    if options.files > 0:
+        files = setup_files(options.datadir, options.files, sizes,
+                            options.seed)
+    else:
+        try:
+            c = client.Client(options.server, options.port)
+        except OSError:
+            sys.stderr.write("Error al conectarse\n")
+            sys.exit(1)
+        files = discover_files(c)
+        c.close()
+    if not files and set(dict(mix)) - {'listing'}:
+        sys.stderr.write("El server no tiene archivos\n")
+        sys.exit(1)
+
+    results = run(options, files, mix)
+    report(results, baseline)
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
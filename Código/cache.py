@@ -0,0 +1,466 @@
+# encoding: utf-8
+# Caches compartidos por todas las conexiones del server
+
+import mmap
+import os
+import stat
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from constants import *
+
+
+def cacheable(filename: str) -> bool:
+    """
+    Indica si se puede guardar en un cache información del archivo. Solo
+    se guardan nombres válidos de archivos del directorio compartido, que
+    son los únicos de los que avisa el DirectoryWatcher.
+    """
+    return (0 < len(filename) <= 255 and filename not in ('.', '..')
+            and set(filename) <= VALID_CHARS)
+
+
+class MetadataCache(object):
+    """
+    Cache del tamaño y la fecha de modificación de los archivos del
+    directorio compartido, para no tener que consultar al sistema de
+    archivos en cada pedido.
+
+    Las entradas se invalidan cuando el 'watcher' avisa que el archivo
+    cambió. Sin watcher no se guarda nada y cada consulta va al sistema de
+    archivos.
+
+    Se puede usar desde varios hilos a la vez.
+    """
+
+    def __init__(self, directory: str, watcher=None):
+        self.directory = directory
+        self.watcher = watcher
+        self.entries = {}
+        self.lock = threading.Lock()
+        # Cambia con cada invalidación, para no guardar un resultado que se
+        # obtuvo antes de una invalidación pero llegó después
+        self.generation = 0
+        if watcher is not None:
+            watcher.subscribe(self.invalidate)
+
+    def stat(self, filename: str):
+        """
+        Devuelve un par (tamaño, fecha de modificación en nanosegundos) del
+        archivo, o None si no existe o no es un archivo regular.
+        """
+        with self.lock:
+            if filename in self.entries:
+                return self.entries[filename]
+            generation = self.generation
+
+        try:
+            st = os.stat(os.path.join(self.directory, filename))
+            result = None
+            if stat.S_ISREG(st.st_mode):
+                result = (st.st_size, st.st_mtime_ns)
+        except (OSError, ValueError):
+            result = None
+
+        if (self.watcher is not None and self.watcher.watching
+                and cacheable(filename)):
+            with self.lock:
+                if generation == self.generation:
+                    self.entries[filename] = result
+        return result
+
+    def invalidate(self, filename):
+        """
+        Descarta lo que se sabe del archivo, o de todos si es None.
+        """
+        with self.lock:
+            self.generation += 1
+            if filename is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(filename, None)
+
+
+class DirectoryListing(object):
+    """
+    Listado de los archivos del directorio compartido, ya codificado como lo
+    manda get_file_listing (una línea por archivo), para no tener que leer
+    el directorio y armar la respuesta en cada pedido.
+
+    Los nombres se guardan ordenados, en bloques de entre 1 y 2 * block_size
+    nombres, y de cada bloque se guardan sus líneas ya codificadas. Cuando
+    el 'watcher' avisa que un archivo apareció o desapareció, solo cambia
+    (y se vuelve a codificar) el bloque donde cae su nombre. Sin watcher no
+    se guarda nada y cada pedido lee el directorio.
+
+    Solo se listan los nombres que se pueden pedir (ver cacheable).
+
+    Se puede usar desde varios hilos a la vez.
+    """
+
+    def __init__(self, directory: str, watcher=None,
+                 block_size: int = LISTING_BLOCK):
+        assert block_size > 0
+        self.directory = directory
+        self.watcher = watcher
+        self.block_size = block_size
+        # Listas ordenadas de nombres, o None si hay que leer el directorio
+        self.blocks = None
+        # Líneas codificadas de cada bloque, o None si cambió
+        self.encoded = []
+        self.lock = threading.Lock()
+        self.generation = 0
+        if watcher is not None:
+            watcher.subscribe(self.update)
+
+    def chunks(self, cursor: int = 0, limit: int = None) -> list:
+        """
+        Devuelve las líneas del listado como una lista de trozos de bytes,
+        salteando los primeros 'cursor' nombres y con a lo sumo 'limit'
+        nombres (o todos, si es None).
+        """
+        with self.lock:
+            if self.blocks is not None:
+                return self._chunks(self.blocks, self.encoded, cursor, limit)
+            generation = self.generation
+
+        blocks = self._read_blocks()
+        encoded = [None] * len(blocks)
+
+        with self.lock:
+            if (self.watcher is not None and self.watcher.watching
+                    and generation == self.generation):
+                self.blocks, self.encoded = blocks, encoded
+            return self._chunks(blocks, encoded, cursor, limit)
+
+    def names(self) -> list:
+        """
+        Devuelve la lista ordenada de los nombres del listado.
+        """
+        with self.lock:
+            if self.blocks is not None:
+                return [name for block in self.blocks for name in block]
+        return [name for block in self._read_blocks() for name in block]
+
+    def _read_blocks(self) -> list:
+        names = sorted(filter(cacheable, os.listdir(self.directory)))
+        return [names[i:i + self.block_size]
+                for i in range(0, len(names), self.block_size)]
+
+    def _chunks(self, blocks: list, encoded: list, cursor: int, limit):
+        result = []
+        for i, block in enumerate(blocks):
+            if limit is not None and limit <= 0:
+                break
+            if cursor >= len(block):
+                cursor -= len(block)
+                continue
+            if cursor == 0 and (limit is None or limit >= len(block)):
+                # Se usa el bloque entero
+                if encoded[i] is None:
+                    encoded[i] = encode_names(block)
+                result.append(encoded[i])
+                part = block
+            else:
+                end = None if limit is None else cursor + limit
+                part = block[cursor:end]
+                result.append(encode_names(part))
+            cursor = 0
+            if limit is not None:
+                limit -= len(part)
+        return result
+
+    def update(self, filename):
+        """
+        Actualiza el listado porque el archivo pudo haber aparecido o
+        desaparecido (o cualquiera, si es None).
+        """
+        with self.lock:
+            self.generation += 1
+            if filename is None:
+                self.blocks = None
+            elif self.blocks is not None and cacheable(filename):
+                pathname = os.path.join(self.directory, filename)
+                if os.path.lexists(pathname):
+                    self._add(filename)
+                else:
+                    self._remove(filename)
+
+    def _find(self, filename: str):
+        """
+        Devuelve el índice del bloque donde va el nombre, y la posición
+        dentro del bloque. Tiene que haber al menos un bloque.
+        """
+        i = bisect_left(self.blocks, filename, key=lambda block: block[-1])
+        i = min(i, len(self.blocks) - 1)
+        return i, bisect_left(self.blocks[i], filename)
+
+    def _add(self, filename: str):
+        if not self.blocks:
+            self.blocks.append([filename])
+            self.encoded.append(None)
+            return
+        i, j = self._find(filename)
+        block = self.blocks[i]
+        if j < len(block) and block[j] == filename:
+            return
+        block.insert(j, filename)
+        if len(block) > 2 * self.block_size:
+            self.blocks[i:i + 1] = [block[:self.block_size],
+                                    block[self.block_size:]]
+            self.encoded[i:i + 1] = [None, None]
+        else:
+            self.encoded[i] = None
+
+    def _remove(self, filename: str):
+        if not self.blocks:
+            return
+        i, j = self._find(filename)
+        block = self.blocks[i]
+        if j == len(block) or block[j] != filename:
+            return
+        del block[j]
+        if block:
+            self.encoded[i] = None
+        else:
+            del self.blocks[i]
+            del self.encoded[i]
+
+
+class OpenFiles(object):
+    """
+    Cache LRU de archivos abiertos del directorio compartido, para no
+    abrir el archivo de nuevo en cada get_slice. Guarda a lo sumo
+    'capacity' archivos; al pasarse, cierra el que hace más que no se usa.
+
+    Los archivos abiertos se comparten entre todas las conexiones, así que
+    se tienen que leer con os.pread (que no usa ni mueve la posición del
+    archivo). Un archivo que sale del cache se cierra recién cuando
+    terminan de leerlo todos los que lo estaban usando.
+
+    Las entradas se descartan cuando el 'watcher' avisa que el archivo
+    cambió. Sin watcher no se guarda nada y cada lectura abre el archivo.
+
+    Se puede usar desde varios hilos a la vez.
+    """
+
+    def __init__(self, directory: str, watcher=None,
+                 capacity: int = OPEN_FILES):
+        self.directory = directory
+        self.watcher = watcher
+        self.capacity = capacity
+        # Nombre -> OpenFile, del usado hace más tiempo al más reciente
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        if watcher is not None:
+            watcher.subscribe(self.invalidate)
+
+    @contextmanager
+    def open(self, filename: str):
+        """
+        Context manager que da el file descriptor del archivo abierto para
+        lectura. Puede fallar con OSError si no se pudo abrir.
+        """
+        entry = self._acquire(filename)
+        try:
+            yield entry.fd
+        finally:
+            with self.lock:
+                entry.unref()
+
+    def _acquire(self, filename: str):
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is not None:
+                self.entries.move_to_end(filename)
+                entry.refs += 1
+                return entry
+            generation = self.generation
+
+        entry = OpenFile(os.open(os.path.join(self.directory, filename),
+                                 os.O_RDONLY))
+
+        with self.lock:
+            if (self.watcher is not None and self.watcher.watching
+                    and generation == self.generation
+                    and cacheable(filename) and filename not in self.entries):
+                # El cache tiene su propia referencia
+                entry.refs += 1
+                self.entries[filename] = entry
+                while len(self.entries) > self.capacity:
+                    _, oldest = self.entries.popitem(last=False)
+                    oldest.unref()
+        return entry
+
+    def invalidate(self, filename):
+        """
+        Saca del cache el archivo, o todos si es None.
+        """
+        with self.lock:
+            self.generation += 1
+            if filename is None:
+                entries = list(self.entries.values())
+                self.entries.clear()
+            else:
+                entries = [self.entries.pop(filename, None)]
+            for entry in entries:
+                if entry is not None:
+                    entry.unref()
+
+
+class MappedFiles(object):
+    """
+    Registro de los archivos del directorio compartido mapeados en memoria
+    (mmap), compartido por todas las conexiones. Guarda a lo sumo
+    'capacity' archivos, sacando el que hace más que no se usa.
+
+    Los mapeos no se cierran explícitamente: un mapeo que sale del registro
+    se libera cuando ya nadie tiene memoryviews de él. Un mapeo se vuelve a
+    hacer si cambió la versión (tamaño y fecha de modificación) del
+    archivo, y el 'watcher' saca del registro los archivos que cambian. Sin
+    watcher no se guarda nada y cada pedido mapea el archivo.
+
+    Se puede usar desde varios hilos a la vez.
+    """
+
+    def __init__(self, directory: str, watcher=None,
+                 capacity: int = OPEN_FILES):
+        self.directory = directory
+        self.watcher = watcher
+        self.capacity = capacity
+        # Nombre -> (versión, mmap), del usado hace más tiempo al más reciente
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        if watcher is not None:
+            watcher.subscribe(self.invalidate)
+
+    def map(self, filename: str, version: tuple) -> mmap.mmap:
+        """
+        Devuelve el archivo mapeado en memoria, para solo lectura. 'version'
+        es el par (tamaño, fecha de modificación) del archivo, que tiene que
+        tener tamaño mayor a 0.
+        """
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(filename)
+                return entry[1]
+            generation = self.generation
+
+        pathname = os.path.join(self.directory, filename)
+        with open(pathname, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        size, _ = version
+        if len(mapped) < size:
+            raise EOFError(f"map: faltaron {size - len(mapped)} bytes")
+
+        with self.lock:
+            if (self.watcher is not None and self.watcher.watching
+                    and generation == self.generation
+                    and cacheable(filename)):
+                self.entries[filename] = (version, mapped)
+                self.entries.move_to_end(filename)
+                while len(self.entries) > self.capacity:
+                    self.entries.popitem(last=False)
+        return mapped
+
+    def invalidate(self, filename):
+        """
+        Saca del registro el archivo, o todos si es None.
+        """
+        with self.lock:
+            self.generation += 1
+            if filename is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(filename, None)
+
+
+class ChunkCache(object):
+    """
+    Cache LRU de trozos de archivos ya codificados en base64, para no
+    codificar una y otra vez los mismos datos de los archivos que piden
+    muchos clientes.
+
+    Las claves son (nombre, versión, offset), donde la versión es el par
+    (tamaño, fecha de modificación) del archivo y el offset es múltiplo del
+    tamaño de trozo, así los trozos de una versión vieja no se usan nunca
+    más y terminan saliendo del cache. Se guardan a lo sumo 'capacity'
+    bytes codificados.
+
+    Los trozos comprimidos (ver Connection.compressed_chunks) se guardan
+    también acá, con el nombre del algoritmo al final de la clave.
+
+    Cuenta los aciertos (hits) y los fallos (misses).
+
+    Se puede usar desde varios hilos a la vez.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Devuelve el trozo codificado guardado con la clave dada, o None.
+        """
+        with self.lock:
+            encoded = self.entries.get(key)
+            if encoded is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return encoded
+
+    def put(self, key, encoded: bytes):
+        """
+        Guarda el trozo codificado, sacando los que hace más que no se usan
+        si hace falta lugar.
+        """
+        if len(encoded) > self.capacity:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = encoded
+            self.size += len(encoded)
+            while self.size > self.capacity:
+                _, oldest = self.entries.popitem(last=False)
+                self.size -= len(oldest)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self.entries), 'bytes': self.size}
+
+
+class OpenFile(object):
+    """
+    Archivo abierto del OpenFiles, con la cantidad de referencias que tiene
+    (el cache y los que lo están leyendo). Se cierra al quedarse sin ninguna.
+    """
+
+    def __init__(self, fd: int):
+        self.fd = fd
+        self.refs = 1
+
+    def unref(self):
+        self.refs -= 1
+        if self.refs == 0:
+            os.close(self.fd)
+
+
+def encode_names(names: list) -> bytes:
+    """
+    Codifica los nombres como líneas de la respuesta a get_file_listing.
+    """
+    return ''.join(f"{name} {EOL}" for name in names).encode("ascii")
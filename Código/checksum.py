@@ -0,0 +1,435 @@
+# encoding: utf-8
+# Índice de hashes (SHA-256) de los archivos del directorio compartido, y
+# búsqueda de bloques para sincronizar copias de archivos
+
+import hashlib
+import json
+import os
+import threading
+import traceback
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future
+from constants import *
+from pool import WorkerPool
+
+
+class FileHashes(object):
+    """
+    Hashes de una versión (par (tamaño, fecha de modificación)) de un
+    archivo: el del archivo entero ('digest') y el de cada bloque de
+    'block_size' bytes ('blocks'), en hexadecimal, y el checksum débil de
+    cada bloque ('weak', ver weak_checksum). Cuando están listos se
+    completa 'future' con este mismo objeto; si no se pudieron calcular
+    (por ejemplo, porque el archivo cambió mientras se leía), con None.
+    """
+
+    def __init__(self, version: tuple):
+        self.version = version
+        self.digest = None
+        self.blocks = None
+        self.weak = None
+        self.future = Future()
+
+
+class HashIndex(object):
+    """
+    Índice de los hashes de los archivos, por bloques de 'block_size'
+    bytes, para contestar get_checksum sin leer el archivo en cada pedido.
+
+    Los hashes de un archivo se calculan recién la primera vez que se los
+    pide, en un pool de hasta 'workers' hilos (así los de archivos
+    distintos se calculan a la vez), que recorre el archivo una sola vez. Se
+    guardan junto con la versión del archivo, así que si el archivo cambia
+    se vuelven a calcular; el 'watcher' solo sirve para liberar antes los
+    que ya no sirven. Se guardan los de a lo sumo 'capacity' archivos.
+
+    Los pedidos devuelven un concurrent.futures.Future en lugar de esperar
+    el resultado, así los modos select y asyncio lo esperan sin frenar el
+    loop de eventos.
+
+    Si se da 'index_dir', el índice de cada archivo además se guarda ahí
+    (en <nombre>.json), así sobrevive a que se reinicie el server.
+
+    Se puede usar desde varios hilos a la vez.
+    """
+
+    def __init__(self, directory: str, watcher=None,
+                 block_size: int = CHECKSUM_BLOCK,
+                 capacity: int = CHECKSUM_FILES, index_dir: str = None,
+                 workers: int = CHECKSUM_WORKERS):
+        assert block_size > 0
+        self.directory = directory
+        self.block_size = block_size
+        self.capacity = capacity
+        self.index_dir = index_dir
+        if index_dir is not None:
+            os.makedirs(index_dir, exist_ok=True)
+        # Nombre -> FileHashes, del usado hace más tiempo al más reciente
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Los hilos se lanzan recién con el primer pedido, así que no
+        # importa que el índice se cree antes de un fork
+        self.pool = WorkerPool(0, workers)
+        if watcher is not None:
+            watcher.subscribe(self.invalidate)
+
+    def checksum(self, filename: str, version: tuple, offset: int,
+                 size: int) -> Future:
+        """
+        Devuelve un Future con el hash (en hexadecimal) de 'size' bytes del
+        archivo a partir de 'offset'. El archivo entero y los bloques
+        alineados salen del índice; los demás rangos se calculan aparte, en
+        el pool.
+        """
+        pathname = os.path.join(self.directory, filename)
+        file_size, _ = version
+        if offset == 0 and size == file_size:
+            return self._lookup(filename, version,
+                                lambda hashes: hashes.digest,
+                                hash_range, pathname, offset, size)
+        if (size > 0 and offset % self.block_size == 0
+                and (size == self.block_size or offset + size == file_size)):
+            index = offset // self.block_size
+            return self._lookup(filename, version,
+                                lambda hashes: hashes.blocks[index],
+                                hash_range, pathname, offset, size)
+        return self.submit(hash_range, pathname, offset, size)
+
+    def signatures(self, filename: str, version: tuple) -> Future:
+        """
+        Devuelve un Future con los hashes (FileHashes) del archivo. Si no
+        se pudieron calcular los de esta versión, se calculan los de la
+        que haya sin guardarlos en el índice.
+        """
+        return self._lookup(filename, version, lambda hashes: hashes,
+                            compute_hashes,
+                            os.path.join(self.directory, filename),
+                            self.block_size)
+
+    def hashes(self, filename: str, version: tuple) -> FileHashes:
+        """
+        Devuelve los hashes de la versión dada del archivo, esperando a que
+        se calculen si todavía no están. Devuelve None si no se pudieron
+        calcular.
+        """
+        return self.request(filename, version).result()
+
+    def request(self, filename: str, version: tuple) -> Future:
+        """
+        Devuelve el Future de los hashes de la versión dada del archivo
+        (ver FileHashes), pidiendo que se calculen si todavía no se pidió.
+        """
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is None or entry.version != version:
+                entry = FileHashes(version)
+                self.entries[filename] = entry
+                while len(self.entries) > self.capacity:
+                    self.entries.popitem(last=False)
+                self.pool.submit(self._work, filename, entry)
+            else:
+                self.entries.move_to_end(filename)
+        return entry.future
+
+    def submit(self, function, *args) -> Future:
+        """
+        Hace function(*args) en el pool, y devuelve un Future con el
+        resultado.
+        """
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+        self.pool.submit(run)
+        return future
+
+    def _lookup(self, filename: str, version: tuple, pick, fallback,
+                *args) -> Future:
+        """
+        Devuelve un Future con pick(hashes) de los hashes del archivo, o,
+        si no se pudieron calcular, con fallback(*args), hecho en el pool.
+        """
+        result = Future()
+
+        def done(future):
+            hashes = future.result()
+            if hashes is None:
+                chain(self.submit(fallback, *args), result)
+            else:
+                result.set_result(pick(hashes))
+        self.request(filename, version).add_done_callback(done)
+        return result
+
+    def invalidate(self, filename):
+        """
+        Descarta los hashes del archivo, o de todos si es None.
+        """
+        with self.lock:
+            if filename is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(filename, None)
+        if (filename is not None and self.index_dir is not None
+                and not os.path.exists(os.path.join(self.directory,
+                                                    filename))):
+            try:
+                os.remove(self._index_path(filename))
+            except OSError:
+                pass
+
+    def _work(self, filename: str, entry: FileHashes):
+        try:
+            if not self._load(filename, entry):
+                self._compute(filename, entry)
+        except Exception:
+            print(traceback.format_exc())
+        finally:
+            if entry.blocks is None:
+                # Que el próximo pedido vuelva a intentar
+                with self.lock:
+                    if self.entries.get(filename) is entry:
+                        del self.entries[filename]
+                entry.future.set_result(None)
+            else:
+                entry.future.set_result(entry)
+
+    def _compute(self, filename: str, entry: FileHashes):
+        """
+        Lee el archivo y calcula sus hashes, si no cambió mientras tanto.
+        """
+        hashes = compute_hashes(os.path.join(self.directory, filename),
+                                self.block_size)
+        if hashes.version != entry.version:
+            return
+        entry.digest = hashes.digest
+        entry.blocks = hashes.blocks
+        entry.weak = hashes.weak
+        self._save(filename, entry)
+
+    def _index_path(self, filename: str) -> str:
+        return os.path.join(self.index_dir, filename + '.json')
+
+    def _load(self, filename: str, entry: FileHashes) -> bool:
+        """
+        Carga los hashes guardados en 'index_dir', si son de esta versión
+        del archivo. Devuelve si pudo.
+        """
+        if self.index_dir is None:
+            return False
+        try:
+            with open(self._index_path(filename)) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        size, mtime = entry.version
+        if (saved.get('size') != size or saved.get('mtime_ns') != mtime
+                or saved.get('block_size') != self.block_size
+                or 'weak' not in saved):
+            return False
+        entry.digest = saved['sha256']
+        entry.blocks = saved['blocks']
+        entry.weak = saved['weak']
+        return True
+
+    def _save(self, filename: str, entry: FileHashes):
+        if self.index_dir is None:
+            return
+        size, mtime = entry.version
+        saved = {'size': size, 'mtime_ns': mtime,
+                 'block_size': self.block_size, 'sha256': entry.digest,
+                 'blocks': entry.blocks, 'weak': entry.weak}
+        # Se escribe en otro archivo y se lo renombra, así nunca queda un
+        # índice a medio escribir
+        path = self._index_path(filename)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(saved, f)
+        os.replace(path + '.tmp', path)
+
+
+def compute_hashes(pathname: str, block_size: int) -> FileHashes:
+    """
+    Lee el archivo entero y devuelve sus hashes, con la versión que tenía
+    el archivo al terminar de leerlo.
+    """
+    digest = hashlib.sha256()
+    blocks = []
+    weak = []
+    with open(pathname, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            digest.update(data)
+            blocks.append(hashlib.sha256(data).hexdigest())
+            weak.append(weak_checksum(data))
+        st = os.fstat(f.fileno())
+    hashes = FileHashes((st.st_size, st.st_mtime_ns))
+    hashes.digest = digest.hexdigest()
+    hashes.blocks = blocks
+    hashes.weak = weak
+    return hashes
+
+
+def weak_checksum(data: bytes) -> int:
+    """
+    Checksum débil de un bloque (adler32), que se puede actualizar al
+    correr el bloque un byte (ver find_matches).
+    """
+    return zlib.adler32(data)
+
+
+def find_matches(pathname: str, size: int, block_size: int,
+                 blocks: list, scan_limit: int = SYNC_SCAN_LIMIT) -> dict:
+    """
+    Busca en el archivo local los bloques de otra versión del archivo,
+    que tiene 'size' bytes y bloques de 'block_size' bytes, dados como
+    pares (checksum débil, hash). Devuelve un diccionario del número de
+    bloque al offset del archivo local donde está.
+
+    Primero se compara cada bloque con el que está en el mismo lugar del
+    archivo local (lo que alcanza si el archivo solo se modificó o se
+    agrandó). Las partes del archivo local que no coinciden se recorren
+    byte por byte con el checksum débil, que se actualiza en tiempo
+    constante al correr la ventana (como en rsync), buscando los bloques
+    que faltan en otro lugar; solo los candidatos se comparan con el hash.
+
+    Ese recorrido es Python puro (unos pocos MB/s), así que solo se hace si
+    las partes que no coinciden suman a lo sumo 'scan_limit' bytes; si no,
+    los bloques que no están en su lugar se dan por faltantes. Si todos los
+    bloques están en su lugar no se recorre nada.
+    """
+    matches = {}
+    with open(pathname, 'rb') as f:
+        local_size = os.fstat(f.fileno()).st_size
+
+        def read(offset, length):
+            f.seek(offset)
+            return f.read(length)
+
+        # Los bloques en el mismo lugar
+        for i, (weak, strong) in enumerate(blocks):
+            start = i * block_size
+            length = min(block_size, size - start)
+            data = read(start, length)
+            if (len(data) == length and weak_checksum(data) == weak
+                    and hashlib.sha256(data).hexdigest() == strong):
+                matches[i] = start
+
+        # El último bloque (que puede ser más corto) al final del archivo
+        # local
+        last = len(blocks) - 1
+        if last >= 0 and last not in matches:
+            length = size - last * block_size
+            if local_size >= length:
+                data = read(local_size - length, length)
+                if (weak_checksum(data) == blocks[last][0]
+                        and hashlib.sha256(data).hexdigest()
+                        == blocks[last][1]):
+                    matches[last] = local_size - length
+
+        # Checksum débil -> bloques enteros que faltan
+        wanted = {}
+        for i, (weak, strong) in enumerate(blocks):
+            start = i * block_size
+            if i not in matches and start + block_size <= size:
+                wanted.setdefault(weak, []).append(i)
+        if not wanted:
+            return matches
+
+        # Partes del archivo local que no coinciden
+        used = sorted((start, start + min(block_size, size - i * block_size))
+                      for i, start in matches.items())
+        regions = []
+        position = 0
+        for start, end in used:
+            if start > position:
+                regions.append((position, start))
+            position = max(position, end)
+        regions.append((position, local_size))
+        if sum(end - start for start, end in regions) > scan_limit:
+            return matches
+
+        for start, end in regions:
+            _scan(read, start, end, block_size, blocks, wanted, matches)
+    return matches
+
+
+def _scan(read, start: int, end: int, block_size: int, blocks: list,
+          wanted: dict, matches: dict):
+    """
+    Recorre [start, end) del archivo local con una ventana de 'block_size'
+    bytes, agregando a 'matches' los bloques de 'wanted' que encuentra.
+    """
+    modulus = 65521  # El de adler32
+    position = start
+    # Datos del archivo a partir de 'base'
+    base = start
+    data = b''
+    while position + block_size <= end:
+        # Hace falta la ventana y el byte siguiente
+        if min(position + block_size + 1, end) > base + len(data):
+            data = data[position - base:] + read(
+                base + len(data), max(block_size, CHUNK_SIZE) * 4)
+            base = position
+            if position + block_size > base + len(data):
+                break  # El archivo se achicó
+        k = position - base
+        weak = weak_checksum(data[k:k + block_size])
+        a, b = weak & 0xffff, weak >> 16
+        # Se corre la ventana de a un byte mientras el checksum débil no
+        # sea el de ningún bloque, hasta donde alcanzan los datos
+        last = min(end, base + len(data)) - block_size - base
+        while weak not in wanted and k < last:
+            out, new = data[k], data[k + block_size]
+            a = (a - out + new) % modulus
+            b = (b - block_size * out + a - 1) % modulus
+            weak = (b << 16) | a
+            k += 1
+        position = base + k
+
+        found = False
+        if weak in wanted:
+            strong = hashlib.sha256(data[k:k + block_size]).hexdigest()
+            for i in wanted[weak]:
+                if i not in matches and blocks[i][1] == strong:
+                    matches[i] = position
+                    found = True
+        if found:
+            position += block_size
+        else:
+            position += 1
+
+
+def hash_range(pathname: str, offset: int, size: int,
+               read_size: int = CHUNK_SIZE) -> str:
+    """
+    Devuelve el hash (en hexadecimal) de 'size' bytes del archivo a partir
+    de 'offset'.
+    """
+    digest = hashlib.sha256()
+    with open(pathname, 'rb') as f:
+        f.seek(offset)
+        while size > 0:
+            data = f.read(min(read_size, size))
+            if not data:
+                raise EOFError(f"hash_range: faltaron {size} bytes")
+            digest.update(data)
+            size -= len(data)
+    return digest.hexdigest()
+
+
+def chain(source: Future, target: Future):
+    """
+    Completa el Future 'target' con el resultado (o la excepción) de
+    'source' cuando este termine.
+    """
+    def done(future):
+        if future.exception() is not None:
+            target.set_exception(future.exception())
+        else:
+            target.set_result(future.result())
+    source.add_done_callback(done)
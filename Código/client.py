@@ -6,37 +6,144 @@
 # Copyright 2008-2010 Natalia Bidart y Daniel Moisset
 # $Id: client.py 387 2011-03-22 13:48:44Z nicolasw $
 
+import asyncio
+import contextlib
+import os
 import socket
 import logging
 import optparse
 import sys
+import threading
 import time
 from base64 import b64decode
+from collections import deque
+from checksum import find_matches, hash_range
+from compression import CODECS, FrameDecoder
 from constants import *
+from framing import LineBuffer
 
 
-class Client(object):
+class BaseClient(object):
+    """
+    Lo que comparten Client y AsyncClient: el buffer de lo recibido y cómo
+    se interpretan las respuestas del server, sin hacer entrada/salida.
+    """
+
+    def __init__(self, recv_size=RECV_SIZE):
+        self.status = None
+        self.recv_size = recv_size
+        self.buffer = LineBuffer()
+        self.connected = True
+        # Algoritmo de compresión negociado (ver set_compression), o None
+        self.codec = None
+
+    def _feed(self, data: bytes):
+        """
+        Acumula en el buffer interno los datos recibidos del server.
+
+        El buffer es de bytes, porque después de la respuesta a
+        get_slice_raw vienen datos binarios. Solo se decodifican las líneas.
+        """
+        self.buffer.feed(data)
+
+        if len(data) == 0:
+            logging.info("El server interrumpió la conexión.")
+            self.connected = False
 
-    def __init__(self, server=DEFAULT_ADDR, port=DEFAULT_PORT):
+    def _pop_line(self):
+        """
+        Saca del buffer la primera línea completa, sin el terminador ni
+        espacios al principio y al final. Devuelve None si no hay ninguna.
+        """
+        response = self.buffer.pop_line()
+        if response is not None:
+            return response.decode("ascii").strip()
+        return None
+
+    @staticmethod
+    def _parse_response_line(response):
+        result = None, None
+        if ' ' in response:
+            code, message = response.split(None, 1)
+            try:
+                result = int(code), message
+            except ValueError:
+                pass
+        else:
+            logging.warning("Respuesta inválida: '%s'" % response)
+        return result
+
+    def _fragment_decoder(self):
+        """
+        Devuelve una función que recibe los datos de un fragmento ya
+        decodificados de base64 y devuelve los datos del archivo,
+        descomprimiéndolos si se negoció compresión.
+        """
+        if self.codec is None:
+            return lambda data: data
+        return FrameDecoder(self.codec).feed
+
+    def _pop_fragment_data(self):
+        """
+        Saca del buffer y decodifica todo lo que se pueda de una línea de
+        datos en base64.
+
+        Devuelve un par (bytes, bool), donde el bool indica si se llegó al
+        final de la línea.
+        """
+        # El server manda el fragmento codificado en base64 en una sola
+        # línea, que puede ser muy larga. En lugar de esperar la línea
+        # entera, se decodifica a medida que llega.
+        data, line_ended = self.buffer.pop_base64()
+        return b64decode(data.strip()), line_ended
+
+    def _use_compression(self, name, message):
+        if self.status != CODE_OK:
+            logging.info(f"El server no acepta compresión {name} "
+                         f"(code={self.status} {message}).")
+            return False
+        self.codec = None if name == 'none' else CODECS[name]
+        return True
+
+    @staticmethod
+    def _parse_file_header(header):
+        """
+        Interpreta la línea 'NOMBRE TAMAÑO' que precede a cada archivo en
+        la respuesta de get_files. Devuelve el par (nombre, tamaño), o None
+        si la línea no es válida (incluido un nombre que podría salir del
+        directorio actual).
+        """
+        filename, _, size = header.rpartition(' ')
+        if not size.isdecimal() or not filename or not set(
+                filename) <= VALID_CHARS:
+            logging.warning("Respuesta inválida: '%s'" % header)
+            return None
+        return filename, int(size)
+
+
+class Client(BaseClient):
+
+    def __init__(self, server=DEFAULT_ADDR, port=DEFAULT_PORT,
+                 recv_size=RECV_SIZE):
         """
         Nuevo cliente, conectado al `server' solicitado en el `port' TCP
         indicado.
 
         Si falla la conexión, genera una excepción de socket.
         """
+        super().__init__(recv_size)
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.status = None
+        self.server = server
+        self.port = port
         self.s.connect((server, port))
-        self.buffer = ''
-        self.connected = True
 
-    def close(self):
+    def close(self, timeout=None):
         """
         Desconecta al cliente del server, mandando el mensaje apropiado
         antes de desconectar.
         """
-        self.send('quit')
-        self.status, message = self.read_response_line()
+        self.send('quit', timeout)
+        self.status, message = self.read_response_line(timeout)
         if self.status != CODE_OK:
             logging.warning("Warning: quit no contesto ok, sino '%s'(%s)'."
                             % (message, self.status))
@@ -60,6 +167,13 @@ class Client(object):
             assert bytes_sent > 0
             message = message[bytes_sent:]
 
+    def send_batch(self, messages, timeout=None):
+        """
+        Envía varios mensajes juntos, con una sola escritura, sin esperar
+        las respuestas (pipelining).
+        """
+        self.send(EOL.join(messages), timeout)
+
     def _recv(self, timeout=None):
         """
         Recibe datos y acumula en el buffer interno.
@@ -67,12 +181,7 @@ class Client(object):
         Para uso privado del cliente.
         """
         self.s.settimeout(timeout)
-        data = self.s.recv(4096).decode("ascii")
-        self.buffer += data
-
-        if len(data) == 0:
-            logging.info("El server interrumpió la conexión.")
-            self.connected = False
+        self._feed(self.s.recv(self.recv_size))
 
     def read_line(self, timeout=None):
         """
@@ -82,7 +191,7 @@ class Client(object):
         Devuelve la línea, eliminando el terminaodr y los espacios en blanco
         al principio y al final.
         """
-        while not EOL in self.buffer and self.connected:
+        while not self.buffer.has_line() and self.connected:
             if timeout is not None:
                 t1 = time.process_time()
             self._recv(timeout)
@@ -90,12 +199,11 @@ class Client(object):
                 t2 = time.process_time()
                 timeout -= t2 - t1
                 t1 = t2
-        if EOL in self.buffer:
-            response, self.buffer = self.buffer.split(EOL, 1)
-            return response.strip()
-        else:
+        response = self._pop_line()
+        if response is None:
             self.connected = False
             return ""
+        return response
 
     def read_response_line(self, timeout=None):
         """
@@ -104,40 +212,103 @@ class Client(object):
         Devuelve un par (int, str) con el código y el error, o
         (None, None) en caso de error.
         """
-        result = None, None
-        response = self.read_line(timeout)
-        if ' ' in response:
-            code, message = response.split(None, 1)
-            try:
-                result = int(code), message
-            except ValueError:
-                pass
-        else:
-            logging.warning("Respuesta inválida: '%s'" % response)
-        return result
+        return self._parse_response_line(self.read_line(timeout))
 
-    def read_fragment(self, length):
+    def read_fragment(self, length, output=None):
         """
         Espera y lee un fragmento de un archivo.
 
-        Devuelve el contenido del fragmento.
+        Devuelve el contenido del fragmento. Si se da un 'output' (ver
+        fragment_writer), en cambio, el fragmento se le va pasando a medida
+        que llega y se decodifica, sin juntarlo entero en memoria, y se
+        devuelve la cantidad de bytes recibidos.
+        """
+        fragment = bytearray() if output is None else None
+        write = fragment_writer(output if output is not None else fragment)
+        decode = self._fragment_decoder()
+        received = 0
+        while True:
+            data, line_ended = self._pop_fragment_data()
+            data = decode(data)
+            if data:
+                write(data)
+            received += len(data)
+            if line_ended:
+                if received >= length:
+                    break
+            elif self.connected:
+                self._recv()
+            else:
+                break
+
+        if output is None:
+            return bytes(fragment)
+        return received
+
+    def read_raw(self, length, output):
+        """
+        Lee 'length' bytes tal cual (como vienen después de get_slice_raw)
+        y se los pasa a 'output' (ver fragment_writer) a medida que llegan.
+
+        Devuelve la cantidad de bytes leídos, que es menor a 'length' solo
+        si el server cortó la conexión.
         """
-        # Ahora, esperamos hasta tener la cantidad de datos necesaria
-        data = self.read_line()
-        fragment = b64decode(data)
-        while len(fragment) < length:
-            data = self.read_line()
-            fragment += b64decode(data)
+        write = fragment_writer(output)
+        data = self.buffer.pop(length)
+        write(data)
+        remaining = length - len(data)
+
+        # El resto se recibe directo en un buffer fijo, sin pasar por
+        # self.buffer
+        self.s.settimeout(None)
+        view = memoryview(bytearray(min(remaining, 2 ** 16)))
+        while remaining > 0:
+            bytes_read = self.s.recv_into(view, min(len(view), remaining))
+            if bytes_read == 0:
+                logging.info("El server interrumpió la conexión.")
+                self.connected = False
+                break
+            write(view[:bytes_read])
+            remaining -= bytes_read
 
-        return fragment
+        return length - remaining
 
-    def file_lookup(self):
+    def file_lookup(self, page_size=None):
         """
         Obtener el listado de archivos en el server. Devuelve una lista
         de strings.
+
+        Si se da 'page_size', el listado se pide de a páginas de esa
+        cantidad de archivos (ver file_lookup_page).
         """
+        if page_size is None:
+            self.send('get_file_listing')
+            return self._read_listing()
+
+        assert page_size > 0
+        result = []
+        page = self.file_lookup_page(0, page_size)
+        result.extend(page)
+        while self.status == CODE_OK and len(page) == page_size:
+            page = self.file_lookup_page(len(result), page_size)
+            result.extend(page)
+        return result
+
+    def file_lookup_page(self, cursor, limit):
+        """
+        Obtener una página del listado de archivos (ordenado) en el server:
+        a lo sumo 'limit' archivos, salteando los primeros 'cursor'.
+        Devuelve una lista de strings, con menos de 'limit' elementos solo
+        si es la última página.
+
+        Si los archivos del server cambian entre una página y otra, puede
+        que algún archivo se repita o falte.
+        """
+        self.send('get_file_listing %d %d' % (cursor, limit))
+        return self._read_listing()
+
+    def _read_listing(self):
         result = []
-        self.send('get_file_listing')
         self.status, message = self.read_response_line()
         if self.status == CODE_OK:
             filename = self.read_line()
@@ -151,43 +322,1163 @@ class Client(object):
 
         return result
 
+    def set_compression(self, name='zlib'):
+        """
+        Le pide al server que mande comprimidos los siguientes get_slice
+        grandes, con el algoritmo dado (uno de compression.CODECS, o 'none'
+        para no comprimir). read_fragment los descomprime.
+
+        Devuelve si el server aceptó; si no (por ejemplo, porque no conoce
+        el comando o el algoritmo), los datos siguen llegando sin comprimir.
+        """
+        assert name == 'none' or name in CODECS
+        self.send(f'set_compression {name}')
+        self.status, message = self.read_response_line()
+        return self._use_compression(name, message)
+
     def get_metadata(self, filename):
         """
         Obtiene en el server el tamaño del archivo con el nombre dado.
         Devuelve None en caso de error.
         """
         self.send(f'get_metadata {filename}')
+        return self._read_metadata()
+
+    def _read_metadata(self):
         self.status, message = self.read_response_line()
         if self.status == CODE_OK:
             size = int(self.read_line())
             return size
 
-    def get_slice(self, filename, start, length):
+    def get_stat(self, filename):
+        """
+        Obtiene en el server el tamaño y la fecha de modificación (en
+        nanosegundos) del archivo con el nombre dado, como un par. Devuelve
+        None en caso de error.
+        """
+        self.send(f'get_stat {filename}')
+        self.status, message = self.read_response_line()
+        if self.status == CODE_OK:
+            size, mtime = self.read_line().split()
+            return int(size), int(mtime)
+
+    def get_metadata_batch(self, filenames):
+        """
+        Como get_metadata para varios archivos, pero mandando los pedidos
+        de a PIPELINE_DEPTH juntos, sin esperar cada respuesta antes de
+        mandar el siguiente pedido. Devuelve una lista con el tamaño de cada
+        archivo (None para los que dieron error).
+        """
+        sizes = []
+        for i in range(0, len(filenames), PIPELINE_DEPTH):
+            batch = filenames[i:i + PIPELINE_DEPTH]
+            self.send_batch([f'get_metadata {filename}' for filename in batch])
+            for filename in batch:
+                sizes.append(self._read_metadata())
+        return sizes
+
+    def get_slice(self, filename, start, length, output=None):
         """
         Obtiene un trozo de un archivo en el server.
 
         El archivo es guardado localmente, en el directorio actual, con el
-        mismo nombre que tiene en el server.
+        mismo nombre que tiene en el server. Si se da un 'output' (un
+        archivo abierto para escritura, una función o un buffer; ver
+        fragment_writer), en cambio, el trozo se le pasa a ese.
+
+        En ambos casos los datos se escriben a medida que van llegando. Si
+        se corta la conexión antes de recibir todo, self.status queda en
+        None.
         """
         self.send('get_slice %s %d %d' % (filename, start, length))
+        self._read_slice(filename, length, output)
+
+    def _read_slice(self, filename, length, output):
         self.status, message = self.read_response_line()
         if self.status == CODE_OK:
-            output = open(filename, 'wb')
-            fragment = self.read_fragment(length)
-            output.write(fragment)
-            output.close()
+            if output is None:
+                with open(filename, 'wb') as output:
+                    received = self.read_fragment(length, output)
+            else:
+                received = self.read_fragment(length, output)
+            if received < length:
+                logging.warning("Se cortó la conexión bajando %s." % filename)
+                self.status = None
         else:
             logging.warning("El servidor indico un error al leer de %s."
                             % filename)
 
-    def retrieve(self, filename):
+    def get_slice_batch(self, filename, ranges, outputs):
+        """
+        Obtiene varios trozos (inicio, largo) de un archivo, mandando los
+        pedidos de a PIPELINE_DEPTH juntos. Cada trozo se le pasa a su
+        destino en 'outputs' (ver fragment_writer) a medida que llega.
+
+        Al terminar, self.status es CODE_OK solo si se recibieron todos.
+        """
+        requests = list(zip(ranges, outputs))
+        result = CODE_OK
+        for i in range(0, len(requests), PIPELINE_DEPTH):
+            batch = requests[i:i + PIPELINE_DEPTH]
+            self.send_batch(['get_slice %s %d %d' % (filename, start, length)
+                             for (start, length), _ in batch])
+            for (start, length), output in batch:
+                self._read_slice(filename, length, output)
+                if self.status != CODE_OK and result == CODE_OK:
+                    result = self.status
+                if not self.connected:
+                    self.status = None
+                    return
+        self.status = result
+
+    def get_checksum(self, filename, start=None, length=None):
+        """
+        Obtiene en el server el hash SHA-256 (en hexadecimal) del archivo
+        entero o, si se dan 'start' y 'length', de ese trozo. Devuelve None
+        en caso de error.
+        """
+        if start is None:
+            self.send(f'get_checksum {filename}')
+        else:
+            self.send('get_checksum %s %d %d' % (filename, start, length))
+        return self._read_checksum()
+
+    def _read_checksum(self):
+        self.status, message = self.read_response_line()
+        if self.status == CODE_OK:
+            return self.read_line()
+
+    def get_checksum_batch(self, filename, ranges):
+        """
+        Como get_checksum para varios trozos (inicio, largo) del archivo,
+        mandando los pedidos de a PIPELINE_DEPTH juntos. Devuelve una lista
+        con el hash de cada trozo (None para los que dieron error).
+
+        Al terminar, self.status es CODE_OK solo si no hubo errores.
+        """
+        digests = []
+        result = CODE_OK
+        for i in range(0, len(ranges), PIPELINE_DEPTH):
+            batch = ranges[i:i + PIPELINE_DEPTH]
+            self.send_batch(['get_checksum %s %d %d' % (filename, start, length)
+                             for start, length in batch])
+            for _ in batch:
+                digests.append(self._read_checksum())
+                if self.status != CODE_OK and result == CODE_OK:
+                    result = self.status
+        self.status = result
+        return digests
+
+    def verify(self, filename, size, block_size=CHECKSUM_BLOCK):
+        """
+        Compara el hash de cada bloque de 'block_size' bytes del archivo
+        local con el del archivo en el server, y vuelve a bajar los bloques
+        que no coinciden. Devuelve la lista de rangos (inicio, largo) que se
+        volvieron a bajar.
+
+        Al terminar, self.status es CODE_OK solo si todos los bloques
+        coinciden.
+        """
+        blocks = [(start, min(block_size, size - start))
+                  for start in range(0, size, block_size)]
+        digests = self.get_checksum_batch(filename, blocks)
+        if self.status != CODE_OK:
+            logging.warning(f"No se pudieron obtener los hashes de {filename} "
+                            f"(code={self.status}).")
+            return []
+
+        expected = dict(zip(blocks, digests))
+
+        def corrupt(blocks):
+            return [(start, length) for start, length in blocks
+                    if hash_range(filename, start, length)
+                    != expected[(start, length)]]
+
+        bad = corrupt(blocks)
+        if bad:
+            logging.warning(f"{len(bad)} bloques de {filename} no coinciden "
+                            "con el server, se vuelven a bajar.")
+            fd = os.open(filename, os.O_WRONLY)
+            try:
+                self.get_slice_batch(filename, bad,
+                                     [file_writer(fd, start)
+                                      for start, _ in bad])
+            finally:
+                os.close(fd)
+            if self.status == CODE_OK and corrupt(bad):
+                logging.warning(f"{filename} sigue sin coincidir con el "
+                                "server (¿cambió mientras se bajaba?).")
+                self.status = None
+        return bad
+
+    def get_signatures(self, filename):
+        """
+        Obtiene en el server las firmas de los bloques del archivo. Devuelve
+        una tupla (tamaño, tamaño de bloque, hash del archivo, lista de
+        pares (checksum débil, hash) de cada bloque), o None en caso de
+        error.
+        """
+        self.send(f'get_signatures {filename}')
+        self.status, message = self.read_response_line()
+        if self.status != CODE_OK:
+            return None
+        size, block_size, digest = self.read_line().split()
+        blocks = []
+        line = self.read_line()
+        while line:
+            weak, strong = line.split()
+            blocks.append((int(weak, 16), strong))
+            line = self.read_line()
+        return int(size), int(block_size), digest, blocks
+
+    def sync(self, filename):
+        """
+        Actualiza la copia local del archivo con la del server, bajando
+        solo los bloques que cambiaron (como rsync). Los bloques que ya
+        están en la copia local (en el mismo lugar o corridos) se buscan
+        con las firmas del server (ver checksum.find_matches), y los demás
+        se piden con get_slice. Si no hay copia local, se baja entera.
+
+        Si todos los bloques que se encontraron están en su lugar, el
+        archivo se modifica ahí mismo; si no, se arma uno nuevo al lado y
+        se lo renombra al terminar. Devuelve la cantidad de bytes que se
+        pidieron al server.
+
+        La búsqueda de bloques corridos recorre la copia local byte por
+        byte en Python, así que solo se hace sobre a lo sumo
+        SYNC_SCAN_LIMIT bytes (ver find_matches); con archivos grandes muy
+        cambiados, conviene más bajarlos enteros.
+
+        Al terminar, self.status es CODE_OK solo si el archivo quedó igual
+        al del server.
+        """
+        if not os.path.exists(filename):
+            self.retrieve(filename)
+            return os.path.getsize(filename) if self.status == CODE_OK else 0
+        signatures = self.get_signatures(filename)
+        if signatures is None:
+            logging.warning(f"No se pudieron obtener las firmas de {filename} "
+                            f"(code={self.status}).")
+            return 0
+        size, block_size, digest, blocks = signatures
+        matches = find_matches(filename, size, block_size, blocks)
+
+        # Rangos que faltan, juntando los bloques consecutivos
+        missing = []
+        for i in range(len(blocks)):
+            if i in matches:
+                continue
+            start = i * block_size
+            length = min(block_size, size - start)
+            if missing and sum(missing[-1]) == start:
+                missing[-1] = (missing[-1][0], missing[-1][1] + length)
+            else:
+                missing.append((start, length))
+
+        in_place = all(offset == i * block_size
+                       for i, offset in matches.items())
+        target = filename if in_place else filename + '.sync'
+        fd = os.open(target, os.O_RDWR | os.O_CREAT)
+        try:
+            if not in_place:
+                with open(filename, 'rb') as local:
+                    for i, offset in matches.items():
+                        local.seek(offset)
+                        length = min(block_size, size - i * block_size)
+                        os.pwrite(fd, local.read(length), i * block_size)
+            os.ftruncate(fd, size)
+            self.get_slice_batch(filename, missing,
+                                 [file_writer(fd, start)
+                                  for start, _ in missing])
+        finally:
+            os.close(fd)
+        if self.status == CODE_OK and hash_range(target, 0, size) != digest:
+            logging.warning(f"{filename} no quedó igual al del server "
+                            "(¿cambió mientras se sincronizaba?).")
+            self.status = None
+        if not in_place:
+            if self.status == CODE_OK:
+                os.replace(target, filename)
+            else:
+                os.remove(target)
+        return sum(length for _, length in missing)
+
+    def get_slice_raw(self, filename, start, length, output=None):
+        """
+        Como get_slice, pero usando get_slice_raw: el server manda los bytes
+        sin codificar en base64, y se escriben directo al archivo (o a
+        'output', si se da).
+        """
+        self.send('get_slice_raw %s %d %d' % (filename, start, length))
+        self.status, message = self.read_response_line()
+        if self.status == CODE_OK:
+            if output is None:
+                with open(filename, 'wb') as output:
+                    self.read_raw(length, output)
+            else:
+                self.read_raw(length, output)
+        else:
+            logging.warning("El servidor indico un error al leer de %s."
+                            % filename)
+
+    def get_segments(self, filename, journal, connections):
+        """
+        Obtiene los rangos del archivo que todavía no están registrados en
+        el 'journal', partiendo el archivo en a lo sumo 'connections'
+        segmentos que se bajan en paralelo por hasta esa cantidad de
+        conexiones (la primera es esta), cada una en un hilo aparte. Cada
+        trozo se escribe en su lugar en el archivo local a medida que
+        llega, y se registra en el journal.
+
+        Los segmentos se reparten desde una cola compartida: cada conexión
+        toma uno, y al terminarlo sigue con el siguiente que quede. Las
+        conexiones de más se cierran apenas no queda nada para tomar, así
+        no ocupan lugar en el server mientras las demás terminan. Si una
+        no se puede abrir o el server no la atiende (por ejemplo, con
+        SERVER_BUSY), no toma ningún segmento y los bajan las demás; esta
+        conexión sigue hasta que no queda ninguno.
+
+        Al terminar, self.status es CODE_OK solo si todos los rangos se
+        bajaron bien.
+        """
+        work = [journal.missing(start, length)
+                for start, length in split_ranges(journal.size, connections)]
+        pending = deque(ranges for ranges in work if ranges)
+        statuses = []
+        lock = threading.Lock()
+
+        def fetch(client):
+            fd = os.open(filename, os.O_WRONLY)
+            try:
+                while True:
+                    with lock:
+                        if not pending:
+                            return
+                        ranges = pending.popleft()
+                    writers = [JournalWriter(fd, journal, start)
+                               for start, length in ranges]
+                    try:
+                        client.get_slice_batch(filename, ranges, writers)
+                    finally:
+                        for writer in writers:
+                            writer.commit()
+                    with lock:
+                        statuses.append(client.status)
+                    if client.status != CODE_OK:
+                        return
+            finally:
+                os.close(fd)
+
+        def helper():
+            try:
+                client = Client(self.server, self.port)
+            except OSError:
+                return
+            try:
+                # Si el server no atiende la conexión, contesta SERVER_BUSY
+                # (o la corta) al primer pedido
+                if client.get_metadata(filename) is None:
+                    logging.info("Conexión extra rechazada (code=%s)."
+                                 % client.status)
+                    return
+                if self.codec is not None:
+                    client.set_compression(self.codec.name)
+                fetch(client)
+            except OSError as e:
+                logging.info("Se perdió una conexión extra: %s" % e)
+            finally:
+                try:
+                    if client.connected:
+                        client.close()
+                except OSError:
+                    pass
+                client.s.close()
+
+        threads = [threading.Thread(target=helper)
+                   for _ in range(len(pending) - 1)]
+        for thread in threads:
+            thread.start()
+        fetch(self)
+        for thread in threads:
+            thread.join()
+
+        self.status = CODE_OK
+        for status in statuses:
+            if status != CODE_OK:
+                self.status = status
+
+    def retrieve(self, filename, connections=1, verify=False):
         """
         Obtiene un archivo completo desde el servidor.
+
+        El progreso se va registrando en un journal (ver Journal), así que
+        si la descarga se corta, volver a llamar a retrieve pide solo lo que
+        faltaba (si el archivo no cambió en el server mientras tanto). Si
+        el server no tiene get_stat, se usa get_metadata y el journal
+        distingue las versiones del archivo solo por el tamaño.
+
+        Si 'connections' es mayor a 1, el archivo se baja en paralelo por
+        esa cantidad de conexiones (ver get_segments). Si 'verify', al
+        terminar se comparan los hashes de los bloques con los del server y
+        se vuelven a bajar los que no coinciden (ver verify).
+        """
+        stat = self.get_stat(filename)
+        if self.status == INVALID_COMMAND:
+            size = self.get_metadata(filename)
+            stat = size, None
+        if self.status == CODE_OK:
+            size, mtime = stat
+            assert size >= 0
+            journal = Journal(filename, size, mtime)
+            self.get_segments(filename, journal, connections)
+            if verify and self.status == CODE_OK:
+                self.verify(filename, size)
+            journal.close()
+            if self.status == CODE_OK:
+                journal.remove()
+        elif self.status == FILE_NOT_FOUND:
+            logging.info("El archivo solicitado no existe.")
+        else:
+            logging.warning(
+                f"No se pudo obtener el archivo {filename} (code={self.status})."
+            )
+
+    def retrieve_many(self, names):
+        """
+        Obtiene varios archivos completos con get_files, pidiendo de a
+        BATCH_FILES nombres (o patrones, ver fnmatch) por vez. Cada archivo
+        se guarda en el directorio actual a medida que llega, sin juntarlo
+        en memoria.
+
+        Devuelve la lista de los archivos bajados. Al terminar, self.status
+        es CODE_OK solo si se bajaron todos.
+        """
+        received = []
+        for i in range(0, len(names), BATCH_FILES):
+            batch = names[i:i + BATCH_FILES]
+            self.send('get_files ' + ' '.join(batch))
+            self.status, message = self.read_response_line()
+            if self.status != CODE_OK:
+                logging.warning(
+                    f"No se pudieron obtener los archivos (code={self.status})."
+                )
+                return received
+            header = self.read_line()
+            while header:
+                parsed = self._parse_file_header(header)
+                if parsed is None:
+                    self.status = None
+                    return received
+                filename, size = parsed
+                with open(filename, 'wb') as output:
+                    length = self.read_fragment(size, output)
+                if length < size:
+                    logging.warning(
+                        "Se cortó la conexión bajando %s." % filename)
+                    self.status = None
+                    return received
+                received.append(filename)
+                header = self.read_line()
+            if not self.connected:
+                self.status = None
+                return received
+        return received
+
+
+def fragment_writer(output):
+    """
+    Devuelve una función que recibe los datos de un fragmento a medida que
+    llegan y se los pasa a 'output', que puede ser:
+
+    - un archivo (o cualquier objeto con un método write),
+    - una función, que se llama con cada trozo de datos,
+    - un bytearray o memoryview preasignado, que se va llenando desde el
+      principio (tiene que tener lugar para todo el fragmento),
+    - un bytearray vacío, al que se le van agregando los datos.
+    """
+    if isinstance(output, bytearray) and len(output) == 0:
+        return output.extend
+    if isinstance(output, (bytearray, memoryview)):
+        view = memoryview(output).cast('B')
+        position = 0
+
+        def write(data):
+            nonlocal position
+            view[position:position + len(data)] = data
+            position += len(data)
+        return write
+    if callable(output):
+        return output
+    return output.write
+
+
+def file_writer(fd, position):
+    """
+    Devuelve una función que escribe los datos que recibe en el archivo
+    abierto 'fd' a partir de 'position', uno a continuación del otro.
+    """
+    def write(data):
+        nonlocal position
+        os.pwrite(fd, data, position)
+        position += len(data)
+    return write
+
+
+def split_ranges(size, parts, align=CHUNK_SIZE):
+    """
+    Parte el rango [0, size) en a lo sumo 'parts' rangos consecutivos, con
+    largos múltiplos de 'align' (salvo el último). Devuelve una lista de
+    pares (inicio, largo).
+    """
+    step = -(-size // parts)  # Redondeando para arriba
+    step = max(align, -(-step // align) * align)
+    return [(start, min(step, size - start)) for start in range(0, size, step)]
+
+
+class Journal(object):
+    """
+    Registro en disco del progreso de la descarga de un archivo, para poder
+    retomarla si se corta. Se guarda al lado del archivo, con la extensión
+    JOURNAL_SUFFIX.
+
+    La primera línea es el tamaño y la fecha de modificación (en
+    nanosegundos) del archivo en el server, o solo el tamaño si no se
+    conoce la fecha (mtime None), y cada una de las siguientes es un rango
+    'inicio largo' que ya está escrito en el archivo local.
+    """
+
+    def __init__(self, filename, size, mtime):
+        """
+        Abre el journal del archivo. Si no hay uno de una descarga anterior
+        de la misma versión (tamaño y fecha de modificación) del archivo,
+        empieza una descarga nueva: crea el archivo local con el tamaño
+        final y un journal vacío. Así nunca se mezclan datos de dos
+        versiones distintas que tienen el mismo tamaño.
+        """
+        self.path = filename + JOURNAL_SUFFIX
+        self.size = size
+        self.version = f"{size}" if mtime is None else f"{size} {mtime}"
+        self.done = []
+        self.lock = threading.Lock()
+
+        if not self._load(filename):
+            with open(filename, 'wb') as output:
+                output.truncate(size)
+            with open(self.path, 'w') as f:
+                f.write(f"{self.version}\n")
+
+        self.file = open(self.path, 'a')
+
+    def _load(self, filename):
+        """
+        Lee los rangos ya bajados de un journal existente. Devuelve False si
+        no hay un journal válido para retomar.
+        """
+        if not (os.path.exists(self.path) and os.path.exists(filename)):
+            return False
+        with open(self.path) as f:
+            lines = f.read().split('\n')
+        if lines[0] != self.version:
+            return False
+        for line in lines[1:]:
+            try:
+                start, length = map(int, line.split())
+            except ValueError:
+                continue  # La última línea puede haber quedado a medias
+            self.done.append((start, length))
+        logging.info(f"Retomando la descarga de {filename}.")
+        return True
+
+    def record(self, start, length):
+        """
+        Registra que el rango ya está escrito en el archivo local.
+        """
+        with self.lock:
+            self.done.append((start, length))
+            self.file.write(f"{start} {length}\n")
+            self.file.flush()
+
+    def missing(self, start, length):
+        """
+        Devuelve la lista de rangos (inicio, largo) dentro de
+        [start, start + length) que todavía no se bajaron.
+        """
+        result = []
+        end = start + length
+        with self.lock:
+            done = sorted(self.done)
+        for done_start, done_length in done:
+            if done_start > start:
+                result.append((start, min(done_start, end) - start))
+            start = max(start, done_start + done_length)
+            if start >= end:
+                break
+        if start < end:
+            result.append((start, end - start))
+        return result
+
+    def close(self):
+        self.file.close()
+
+    def remove(self):
+        os.remove(self.path)
+
+
+class JournalWriter(object):
+    """
+    Escribe un rango del archivo de salida (dado por su file descriptor) a
+    partir de 'start', y va registrando en el journal lo que se escribe,
+    cada JOURNAL_INTERVAL bytes.
+
+    Escribe con os.pwrite, sin buffer propio ni posición compartida, así
+    que varios JournalWriter pueden usar el mismo file descriptor y el
+    journal nunca dice más que lo que ya se escribió.
+    """
+
+    def __init__(self, fd, journal, start):
+        self.fd = fd
+        self.journal = journal
+        self.start = start
+        self.pending = 0
+
+    def write(self, data):
+        data = memoryview(data)
+        while len(data) > 0:
+            written = os.pwrite(self.fd, data, self.start + self.pending)
+            self.pending += written
+            data = data[written:]
+        if self.pending >= JOURNAL_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        """
+        Registra en el journal lo escrito hasta ahora.
+        """
+        if self.pending > 0:
+            self.journal.record(self.start, self.pending)
+            self.start += self.pending
+            self.pending = 0
+
+
+class ClientPool(object):
+    """
+    Pool de conexiones persistentes (Client) a un server, para no pagar una
+    conexión nueva por cada pedido. Se puede usar desde varios hilos a la
+    vez; cada conexión la usa un solo hilo por vez:
+
+        pool = ClientPool(server, port)
+        with pool.connection() as client:
+            size = client.get_metadata(filename)
+
+    Hay a lo sumo 'max_size' conexiones abiertas (las que se están usando y
+    las libres); si no queda ninguna libre, connection espera a que se
+    devuelva alguna. Las conexiones libres por más de 'idle_timeout'
+    segundos se cierran (cada conexión abierta ocupa un lugar en el
+    server).
+
+    Antes de volver a usar una conexión se revisa que el server no la haya
+    cerrado, y si estuvo libre más de 'check_interval' segundos, que
+    conteste un pedido; si no, se abre otra en su lugar. Las conexiones que
+    vuelven con datos sin leer, cerradas o con un error fatal se descartan,
+    y a las que vuelven con compresión (ver Client.set_compression) se les
+    vuelve a pedir que no comprima, para que no le quede al que la use
+    después.
+    Como el server puede cerrar una conexión justo después de la revisión,
+    run además reintenta el pedido con una conexión nueva.
+    """
+
+    def __init__(self, server=DEFAULT_ADDR, port=DEFAULT_PORT,
+                 max_size=POOL_SIZE, idle_timeout=POOL_IDLE_TIMEOUT,
+                 check_interval=POOL_CHECK_INTERVAL):
+        assert max_size > 0
+        self.server = server
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        # Pares (cliente, momento en que se devolvió) de las conexiones
+        # libres; se reutiliza primero la última que se devolvió
+        self.idle = deque()
+        # Cantidad de conexiones abiertas, libres o no
+        self.size = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        reaper = threading.Thread(target=self._reap, daemon=True)
+        reaper.start()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """
+        Context manager que presta una conexión del pool y la devuelve al
+        terminar. Si hay una excepción, la conexión se descarta (puede
+        haber quedado a mitad de una respuesta).
+        """
+        client = self.acquire(timeout)
+        try:
+            yield client
+        except BaseException:
+            self.release(client, discard=True)
+            raise
+        self.release(client)
+
+    def run(self, function, *args, timeout=None):
+        """
+        Llama a function(client, *args) con una conexión del pool (por
+        ejemplo, ClientPool.run(Client.get_metadata, filename)) y devuelve
+        lo que devuelva.
+
+        Si la conexión era una reutilizada y resulta que el server la había
+        cerrado (falla con una excepción de socket o queda desconectada), se
+        vuelve a llamar con una conexión nueva. Los pedidos del protocolo se
+        pueden repetir sin problemas.
+        """
+        client, reused = self._acquire(timeout)
+        try:
+            result = function(client, *args)
+        except OSError:
+            self.release(client, discard=True)
+            if not reused:
+                raise
+        except BaseException:
+            self.release(client, discard=True)
+            raise
+        else:
+            if client.connected or not reused:
+                self.release(client)
+                return result
+            self.release(client, discard=True)
+        logging.info("El server cerró una conexión del pool, reintentando.")
+        with self.connection(timeout) as client:
+            return function(client, *args)
+
+    def acquire(self, timeout=None):
+        """
+        Devuelve una conexión sana (reutilizando una libre o abriendo una
+        nueva), que se tiene que devolver con release. Si no hay lugar para
+        otra, espera a lo sumo 'timeout' segundos a que se devuelva alguna,
+        o falla con TimeoutError.
+
+        Si no se puede conectar, falla con una excepción de socket.
+        """
+        client, _ = self._acquire(timeout)
+        return client
+
+    def _acquire(self, timeout):
+        """
+        Como acquire, pero devuelve un par (conexión, si es reutilizada).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise ValueError("El pool está cerrado")
+                if self.idle:
+                    client, released_at = self.idle.pop()
+                    break
+                if self.size < self.max_size:
+                    client, released_at = None, None
+                    self.size += 1
+                    break
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError("No hay conexiones libres")
+                self.condition.wait(remaining)
+
+        # Lo que sigue puede esperar al server, así que se hace sin el lock
+        if client is not None and self._healthy(client, released_at):
+            return client, True
+        if client is not None:
+            logging.info("Conexión del pool cerrada, reconectando.")
+            self._close(client)
+        try:
+            return Client(self.server, self.port), False
+        except Exception:
+            self._forget()
+            raise
+
+    def release(self, client, discard=False):
+        """
+        Devuelve al pool una conexión de acquire. Si 'discard', o si quedó
+        en un estado en el que no se puede reutilizar, se cierra.
+        """
+        if not discard and client.codec is not None:
+            try:
+                discard = not client.set_compression('none')
+            except OSError:
+                discard = True
+        if (discard or not client.connected or len(client.buffer) > 0
+                or (valid_status(client.status)
+                    and fatal_status(client.status))):
+            self._close(client)
+            self._forget()
+            return
+        client.status = None
+        with self.condition:
+            if self.closed:
+                close = True
+            else:
+                close = False
+                self.idle.append((client, time.monotonic()))
+                self.condition.notify()
+        if close:
+            self._close(client)
+            self._forget()
+
+    def close(self):
+        """
+        Cierra las conexiones libres. Las que se están usando se cierran al
+        devolverlas.
+        """
+        with self.condition:
+            self.closed = True
+            idle = [client for client, _ in self.idle]
+            self.idle.clear()
+            self.size -= len(idle)
+            self.condition.notify_all()
+        for client in idle:
+            self._close(client)
+
+    def _healthy(self, client, released_at):
+        """
+        Indica si la conexión libre se puede seguir usando.
+        """
+        # Si el server cerró la conexión hay un EOF para leer (y no puede
+        # haber datos que nadie pidió)
+        try:
+            client.s.settimeout(0)
+            client.s.recv(1, socket.MSG_PEEK)
+            return False
+        except BlockingIOError:
+            pass
+        except OSError:
+            return False
+        if time.monotonic() - released_at < self.check_interval:
+            return True
+        # Un pedido del protocolo estándar que cualquier server contesta
+        # enseguida; alcanza con que la respuesta no sea un error fatal
+        try:
+            client.send('get_metadata .', POOL_CHECK_TIMEOUT)
+            status, _ = client.read_response_line(POOL_CHECK_TIMEOUT)
+            if status == CODE_OK:
+                client.read_line(POOL_CHECK_TIMEOUT)
+        except OSError:
+            return False
+        return (client.connected and valid_status(status)
+                and not fatal_status(status))
+
+    def _forget(self):
+        """
+        Libera el lugar de una conexión que se cerró.
+        """
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+
+    def _close(self, client):
+        try:
+            if client.connected:
+                client.close(self.check_interval)
+        except OSError:
+            pass
+        finally:
+            client.s.close()
+
+    def _reap(self):
+        """
+        Cierra las conexiones que estuvieron libres más de 'idle_timeout'
+        segundos, hasta que se cierra el pool.
+        """
+        while True:
+            with self.condition:
+                if self.closed:
+                    return
+                self.condition.wait(self.idle_timeout / 2)
+                now = time.monotonic()
+                expired = []
+                # Las más viejas están al principio
+                while (self.idle
+                       and now - self.idle[0][1] >= self.idle_timeout):
+                    expired.append(self.idle.popleft()[0])
+                self.size -= len(expired)
+                if expired:
+                    self.condition.notify_all()
+            for client in expired:
+                self._close(client)
+
+
+class AsyncClient(BaseClient):
+    """
+    Versión de Client para usar con asyncio: los métodos que hablan con el
+    server son corrutinas, así que se pueden hacer muchas descargas a la vez
+    desde un solo hilo.
+
+    Tiene los mismos comandos que Client, incluidos los que mandan varios
+    pedidos juntos, pero no las operaciones que además trabajan sobre el
+    archivo local con varios hilos o lo recorren entero (get_segments,
+    verify y sync); retrieve baja el archivo con un solo get_slice, sin
+    journal.
+
+    Se crea con `await AsyncClient.connect(server, port)`.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter, recv_size=RECV_SIZE):
+        super().__init__(recv_size)
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, server=DEFAULT_ADDR, port=DEFAULT_PORT):
         """
-        size = self.get_metadata(filename)
+        Nuevo cliente, conectado al `server' solicitado en el `port' TCP
+        indicado.
+
+        Si falla la conexión, genera una excepción de socket.
+        """
+        reader, writer = await asyncio.open_connection(server, port)
+        return cls(reader, writer)
+
+    async def close(self):
+        await self.send('quit')
+        self.status, message = await self.read_response_line()
+        if self.status != CODE_OK:
+            logging.warning("Warning: quit no contesto ok, sino '%s'(%s)'."
+                            % (message, self.status))
+        self.connected = False
+        self.writer.close()
+        await self.writer.wait_closed()
+
+    async def send(self, message, timeout=None):
+        message += EOL  # Completar el mensaje con un fin de línea
+        logging.debug(f"Enviando el mensaje {repr(message)}.")
+        self.writer.write(message.encode("ascii"))
+        await asyncio.wait_for(self.writer.drain(), timeout)
+
+    async def send_batch(self, messages, timeout=None):
+        await self.send(EOL.join(messages), timeout)
+
+    async def _recv(self, timeout=None):
+        self._feed(await asyncio.wait_for(self.reader.read(self.recv_size),
+                                          timeout))
+
+    async def read_line(self, timeout=None):
+        await asyncio.wait_for(self._wait_line(), timeout)
+        response = self._pop_line()
+        if response is None:
+            self.connected = False
+            return ""
+        return response
+
+    async def _wait_line(self):
+        while not self.buffer.has_line() and self.connected:
+            await self._recv()
+
+    async def read_response_line(self, timeout=None):
+        return self._parse_response_line(await self.read_line(timeout))
+
+    async def read_fragment(self, length, output=None):
+        fragment = bytearray() if output is None else None
+        write = fragment_writer(output if output is not None else fragment)
+        decode = self._fragment_decoder()
+        received = 0
+        while True:
+            data, line_ended = self._pop_fragment_data()
+            data = decode(data)
+            if data:
+                write(data)
+            received += len(data)
+            if line_ended:
+                if received >= length:
+                    break
+            elif self.connected:
+                await self._recv()
+            else:
+                break
+
+        if output is None:
+            return bytes(fragment)
+        return received
+
+    async def read_raw(self, length, output):
+        write = fragment_writer(output)
+        data = self.buffer.pop(length)
+        write(data)
+        remaining = length - len(data)
+        while remaining > 0:
+            data = await self.reader.read(min(remaining, 2 ** 16))
+            if len(data) == 0:
+                logging.info("El server interrumpió la conexión.")
+                self.connected = False
+                break
+            write(data)
+            remaining -= len(data)
+
+        return length - remaining
+
+    async def file_lookup(self, page_size=None):
+        if page_size is None:
+            await self.send('get_file_listing')
+            return await self._read_listing()
+
+        assert page_size > 0
+        result = []
+        page = await self.file_lookup_page(0, page_size)
+        result.extend(page)
+        while self.status == CODE_OK and len(page) == page_size:
+            page = await self.file_lookup_page(len(result), page_size)
+            result.extend(page)
+        return result
+
+    async def file_lookup_page(self, cursor, limit):
+        await self.send('get_file_listing %d %d' % (cursor, limit))
+        return await self._read_listing()
+
+    async def _read_listing(self):
+        result = []
+        self.status, message = await self.read_response_line()
+        if self.status == CODE_OK:
+            filename = await self.read_line()
+            while filename:
+                logging.debug("Received filename %s" % filename)
+                result.append(filename)
+                filename = await self.read_line()
+        else:
+            logging.warning("Falló la solicitud de la lista de archivos" +
+                            "(code=%s %s)." % (self.status, message))
+
+        return result
+
+    async def set_compression(self, name='zlib'):
+        assert name == 'none' or name in CODECS
+        await self.send(f'set_compression {name}')
+        self.status, message = await self.read_response_line()
+        return self._use_compression(name, message)
+
+    async def get_metadata(self, filename):
+        await self.send(f'get_metadata {filename}')
+        return await self._read_metadata()
+
+    async def _read_metadata(self):
+        self.status, message = await self.read_response_line()
+        if self.status == CODE_OK:
+            size = int(await self.read_line())
+            return size
+
+    async def get_stat(self, filename):
+        await self.send(f'get_stat {filename}')
+        self.status, message = await self.read_response_line()
+        if self.status == CODE_OK:
+            size, mtime = (await self.read_line()).split()
+            return int(size), int(mtime)
+
+    async def get_metadata_batch(self, filenames):
+        sizes = []
+        for i in range(0, len(filenames), PIPELINE_DEPTH):
+            batch = filenames[i:i + PIPELINE_DEPTH]
+            await self.send_batch([f'get_metadata {filename}'
+                                   for filename in batch])
+            for filename in batch:
+                sizes.append(await self._read_metadata())
+        return sizes
+
+    async def get_slice(self, filename, start, length, output=None):
+        await self.send('get_slice %s %d %d' % (filename, start, length))
+        await self._read_slice(filename, length, output)
+
+    async def _read_slice(self, filename, length, output):
+        self.status, message = await self.read_response_line()
+        if self.status == CODE_OK:
+            if output is None:
+                with open(filename, 'wb') as output:
+                    received = await self.read_fragment(length, output)
+            else:
+                received = await self.read_fragment(length, output)
+            if received < length:
+                logging.warning("Se cortó la conexión bajando %s." % filename)
+                self.status = None
+        else:
+            logging.warning("El servidor indico un error al leer de %s."
+                            % filename)
+
+    async def get_slice_batch(self, filename, ranges, outputs):
+        requests = list(zip(ranges, outputs))
+        result = CODE_OK
+        for i in range(0, len(requests), PIPELINE_DEPTH):
+            batch = requests[i:i + PIPELINE_DEPTH]
+            await self.send_batch(['get_slice %s %d %d'
+                                   % (filename, start, length)
+                                   for (start, length), _ in batch])
+            for (start, length), output in batch:
+                await self._read_slice(filename, length, output)
+                if self.status != CODE_OK and result == CODE_OK:
+                    result = self.status
+                if not self.connected:
+                    self.status = None
+                    return
+        self.status = result
+
+    async def get_slice_raw(self, filename, start, length, output=None):
+        await self.send('get_slice_raw %s %d %d' % (filename, start, length))
+        self.status, message = await self.read_response_line()
+        if self.status == CODE_OK:
+            if output is None:
+                with open(filename, 'wb') as output:
+                    await self.read_raw(length, output)
+            else:
+                await self.read_raw(length, output)
+        else:
+            logging.warning("El servidor indico un error al leer de %s."
+                            % filename)
+
+    async def get_checksum(self, filename, start=None, length=None):
+        if start is None:
+            await self.send(f'get_checksum {filename}')
+        else:
+            await self.send('get_checksum %s %d %d'
+                            % (filename, start, length))
+        return await self._read_checksum()
+
+    async def _read_checksum(self):
+        self.status, message = await self.read_response_line()
+        if self.status == CODE_OK:
+            return await self.read_line()
+
+    async def get_checksum_batch(self, filename, ranges):
+        digests = []
+        result = CODE_OK
+        for i in range(0, len(ranges), PIPELINE_DEPTH):
+            batch = ranges[i:i + PIPELINE_DEPTH]
+            await self.send_batch(['get_checksum %s %d %d'
+                                   % (filename, start, length)
+                                   for start, length in batch])
+            for _ in batch:
+                digests.append(await self._read_checksum())
+                if self.status != CODE_OK and result == CODE_OK:
+                    result = self.status
+        self.status = result
+        return digests
+
+    async def get_signatures(self, filename):
+        await self.send(f'get_signatures {filename}')
+        self.status, message = await self.read_response_line()
+        if self.status != CODE_OK:
+            return None
+        size, block_size, digest = (await self.read_line()).split()
+        blocks = []
+        line = await self.read_line()
+        while line:
+            weak, strong = line.split()
+            blocks.append((int(weak, 16), strong))
+            line = await self.read_line()
+        return int(size), int(block_size), digest, blocks
+
+    async def retrieve(self, filename):
+        size = await self.get_metadata(filename)
         if self.status == CODE_OK:
             assert size >= 0
-            self.get_slice(filename, 0, size)
+            await self.get_slice(filename, 0, size)
         elif self.status == FILE_NOT_FOUND:
             logging.info("El archivo solicitado no existe.")
         else:
@@ -195,6 +1486,38 @@ class Client(object):
                 f"No se pudo obtener el archivo {filename} (code={self.status})."
             )
 
+    async def retrieve_many(self, names):
+        received = []
+        for i in range(0, len(names), BATCH_FILES):
+            batch = names[i:i + BATCH_FILES]
+            await self.send('get_files ' + ' '.join(batch))
+            self.status, message = await self.read_response_line()
+            if self.status != CODE_OK:
+                logging.warning(
+                    f"No se pudieron obtener los archivos (code={self.status})."
+                )
+                return received
+            header = await self.read_line()
+            while header:
+                parsed = self._parse_file_header(header)
+                if parsed is None:
+                    self.status = None
+                    return received
+                filename, size = parsed
+                with open(filename, 'wb') as output:
+                    length = await self.read_fragment(size, output)
+                if length < size:
+                    logging.warning(
+                        "Se cortó la conexión bajando %s." % filename)
+                    self.status = None
+                    return received
+                received.append(filename)
+                header = await self.read_line()
+            if not self.connected:
+                self.status = None
+                return received
+        return received
+
 
 def main():
     """
@@ -211,6 +1534,17 @@ def main():
     parser = optparse.OptionParser(usage="%prog [options] server")
     parser.add_option("-p", "--port",
                       help="Numero de puerto TCP donde escuchar", default=DEFAULT_PORT)
+    parser.add_option("-c", "--connections",
+                      help="Cantidad de conexiones en paralelo con las que "
+                      "bajar el archivo", default=1)
+    parser.add_option("--verify", action="store_true",
+                      help="Verificar la descarga con los hashes del server",
+                      default=False)
+    parser.add_option("--sync", action="store_true",
+                      help="Si ya hay una copia local del archivo, bajar "
+                      "solo lo que cambió", default=False)
+    parser.add_option("-z", "--compress", action="store_true",
+                      help="Pedir los datos comprimidos", default=False)
     parser.add_option("-v", "--verbose", dest="level", action="store",
                       help="Determina cuanta informacion de depuracion a mostrar"
                       "(valores posibles son: ERROR, WARN, INFO, DEBUG)",
@@ -223,6 +1557,15 @@ def main():
                          % repr(options.port))
         parser.print_help()
         sys.exit(1)
+    try:
+        connections = int(options.connections)
+        if connections < 1:
+            raise ValueError
+    except ValueError:
+        sys.stderr.write("Cantidad de conexiones invalida: %s\n"
+                         % repr(options.connections))
+        parser.print_help()
+        sys.exit(1)
 
     if len(args) != 1 or options.level not in list(DEBUG_LEVELS.keys()):
         parser.print_help()
@@ -238,6 +1581,9 @@ def main():
         sys.stderr.write("Error al conectarse\n")
         sys.exit(1)
 
+    if options.compress:
+        client.set_compression()
+
     print("* Bienvenido al cliente HFTP - "
           "the Home-made File Transfer Protocol *\n"
           "* Estan disponibles los siguientes archivos:")
@@ -248,8 +1594,16 @@ def main():
         print(filename)
 
     if client.status == CODE_OK:
-        print("* Indique el nombre del archivo a descargar:")
-        client.retrieve(input().strip())
+        print("* Indique el nombre del archivo a descargar (o varios, "
+              "separados por espacios, o un patrón como *.txt):")
+        filename = input().strip()
+        if ' ' in filename or set(filename) & PATTERN_CHARS:
+            # Varios archivos o patrones
+            client.retrieve_many(filename.split())
+        elif options.sync:
+            client.sync(filename)
+        else:
+            client.retrieve(filename, connections, options.verify)
 
     client.close()
 
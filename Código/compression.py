@@ -0,0 +1,97 @@
+# encoding: utf-8
+# Compresión de los datos de los get_slice, compartida por el server y el
+# cliente HFTP
+
+import struct
+import zlib
+from abc import ABC, abstractmethod
+from constants import *
+
+# Encabezado de cada frame: tipo (RAW o COMPRESSED) y largo de los datos
+FRAME_HEADER = struct.Struct('>BI')
+RAW = 0
+COMPRESSED = 1
+
+
+class Codec(ABC):
+    """
+    Algoritmo de compresión que se puede negociar con set_compression.
+    Cada trozo se comprime por separado, así que compress y decompress no
+    guardan estado entre una llamada y otra.
+
+    Para agregar un algoritmo, se define una subclase con su 'name' y se la
+    agrega a CODECS.
+    """
+
+    name = None
+
+    @abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        pass
+
+    @abstractmethod
+    def decompress(self, data: bytes) -> bytes:
+        pass
+
+
+class ZlibCodec(Codec):
+
+    name = 'zlib'
+
+    def __init__(self, level: int = COMPRESSION_LEVEL):
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+CODECS = {codec.name: codec for codec in [ZlibCodec()]}
+
+
+def encode_frame(codec: Codec, data: bytes) -> bytes:
+    """
+    Devuelve el frame con los datos comprimidos con 'codec', o tal cual si
+    comprimidos no ocupan menos.
+    """
+    compressed = codec.compress(data)
+    if len(compressed) < len(data):
+        return FRAME_HEADER.pack(COMPRESSED, len(compressed)) + compressed
+    return raw_frame(data)
+
+
+def raw_frame(data: bytes) -> bytes:
+    """
+    Devuelve el frame con los datos sin comprimir.
+    """
+    return FRAME_HEADER.pack(RAW, len(data)) + data
+
+
+class FrameDecoder(object):
+    """
+    Decodifica una sucesión de frames que llega de a pedazos cualesquiera,
+    devolviendo los datos descomprimidos de los frames que se completan.
+    """
+
+    def __init__(self, codec: Codec):
+        self.codec = codec
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> bytes:
+        self.buffer += data
+        result = []
+        while len(self.buffer) >= FRAME_HEADER.size:
+            kind, length = FRAME_HEADER.unpack_from(self.buffer)
+            end = FRAME_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            payload = bytes(self.buffer[FRAME_HEADER.size:end])
+            del self.buffer[:end]
+            if kind == COMPRESSED:
+                payload = self.codec.decompress(payload)
+            elif kind != RAW:
+                raise ValueError(f"Tipo de frame inválido: {kind}")
+            result.append(payload)
+        return b''.join(result)
@@ -3,12 +3,31 @@
 # Copyright 2014 Carlos Bederián
 # $Id: connection.py 455 2011-05-01 00:32:09Z carlos $
 
+import asyncio
 import socket
+import selectors
+from collections import deque
+from concurrent import futures
+from concurrent.futures import Future
+from fnmatch import fnmatchcase
 from constants import *
-from base64 import b64encode
+from framing import LineBuffer
+from cache import (MetadataCache, DirectoryListing, OpenFiles, MappedFiles,
+                   ChunkCache)
+from base64 import b64encode, b64decode
+from checksum import HashIndex, compute_hashes, hash_range
+import compression
+import metrics
 import os
+import time
 import traceback
 
+# Comandos del protocolo (los demás se cuentan como 'invalid' en las
+# métricas)
+COMMANDS = {'get_file_listing', 'get_metadata', 'get_stat', 'get_slice',
+            'get_slice_raw', 'get_checksum', 'get_signatures',
+            'get_files', 'set_compression', 'quit'}
+
 
 class Connection(object):
     """
@@ -17,12 +36,52 @@ class Connection(object):
     que termina la conexión.
     """
 
-    def __init__(self, socket: socket.socket, directory: str):
+    def __init__(self, socket: socket.socket, directory: str,
+                 chunk_size: int = CHUNK_SIZE, recv_size: int = RECV_SIZE,
+                 metadata: MetadataCache = None,
+                 listing: DirectoryListing = None,
+                 files: OpenFiles = None, chunks: ChunkCache = None,
+                 maps: MappedFiles = None, limiters: list = (),
+                 compress_min: int = COMPRESS_MIN,
+                 hashes: HashIndex = None):
         # Inicialización de conexión
+        assert chunk_size > 0 and chunk_size % 3 == 0
         self.socket = socket
+        set_nodelay(socket)
         self.directory = directory
+        # Cache de tamaños de archivos, compartido con las demás conexiones
+        if metadata is None:
+            metadata = MetadataCache(directory)
+        self.metadata = metadata
+        if listing is None:
+            listing = DirectoryListing(directory)
+        self.listing = listing
+        if files is None:
+            files = OpenFiles(directory)
+        self.files = files
+        # Cache de trozos ya codificados, o None para no usar ninguno
+        self.chunks = chunks
+        # Archivos mapeados en memoria, o None para leerlos con pread
+        self.maps = maps
+        self.chunk_size = chunk_size
+        self.recv_size = recv_size
+        # Algoritmo con el que se comprimen los get_slice de al menos
+        # 'compress_min' bytes (ver set_compression), o None
+        self.codec = None
+        self.compress_min = compress_min
+        # Índice de hashes compartido, o None para calcularlos en cada
+        # get_checksum
+        self.hashes = hashes
+        # Limitadores de velocidad (ratelimit.TokenBucket) por los que pasa
+        # todo lo que se manda, y cantidad de bytes que se manda entre una
+        # consulta y otra a los limitadores: lo que ocupa un trozo
+        # codificado en base64
+        self.limiters = list(limiters)
+        self.quantum = chunk_size // 3 * 4
         self.connection_active = True
-        self.buffer = ''
+        self.buffer = LineBuffer()
+        # Respuestas chicas que todavía no se mandaron (ver _write)
+        self.write_buffer = bytearray()
         print(f"Connected by: {self.socket.getsockname()}")
 
     def send(self, message: bytes | str, instance='ascii'):
@@ -44,10 +103,112 @@ class Connection(object):
             # Nunca se deberia llamar a send con otra cosa
             raise Exception(f"send: Invalid instance '{instance}'")
 
-        while len(message) > 0:
-            bytes_sent = self.socket.send(message)
+        self._write(message)
+
+    def send_stream(self, chunks):
+        """
+        Envía cada uno de los trozos de bytes de 'chunks' codificado en
+        base64, sin terminador de línea.
+
+        Los trozos (salvo el último) tienen que tener un largo múltiplo de 3
+        para que la concatenación sea base64 válido.
+        """
+        for chunk in chunks:
+            self.send(chunk, instance='b64encode')
+
+    def send_chunks(self, chunks):
+        """
+        Envía cada uno de los trozos de bytes de 'chunks' tal cual.
+        """
+        for chunk in chunks:
+            self._write(chunk)
+
+    def send_file(self, pathname: str, offset: int, size: int):
+        """
+        Manda 'size' bytes del archivo a partir de 'offset', tal cual.
+        """
+        self.flush()
+        if size == 0:
+            # socket.sendfile toma 0 como 'hasta el final del archivo'
+            return
+        with open(pathname, 'rb') as f:
+            if not self.limiters:
+                bytes_sent = self.socket.sendfile(f, offset, size)
+                self.throttle(bytes_sent)
+                if bytes_sent < size:
+                    raise EOFError(
+                        f"send_file: faltaron {size - bytes_sent} bytes")
+                return
+            while size > 0:
+                count = min(size, self.quantum)
+                bytes_sent = self.socket.sendfile(f, offset, count)
+                if bytes_sent < count:
+                    raise EOFError(
+                        f"send_file: faltaron {size - bytes_sent} bytes")
+                offset += bytes_sent
+                size -= bytes_sent
+                time.sleep(self.throttle(bytes_sent))
+
+    def send_when_done(self, future: Future, respond):
+        """
+        Manda la respuesta que arma respond(future) cuando termine 'future'
+        (un concurrent.futures.Future que se completa en otro hilo, como
+        los del índice de hashes). Acá, con un hilo por conexión,
+        simplemente se espera; las conexiones con cola la encolan sin
+        esperar (ver QueuedConnection).
+        """
+        futures.wait([future])
+        respond(future)
+
+    def _write(self, data: bytes):
+        """
+        Manda 'data' por el socket.
+
+        Las respuestas chicas se juntan en write_buffer, y se mandan todas
+        juntas cuando se llena o cuando no quedan pedidos por atender (ver
+        handle), así varios pedidos seguidos (pipelining) se contestan con
+        pocas escrituras grandes.
+        """
+        if len(self.write_buffer) + len(data) < WRITE_BUFFER_SIZE:
+            self.write_buffer += data
+        else:
+            self._sendall([self.write_buffer, data])
+            self.write_buffer = bytearray()
+
+    def flush(self):
+        """
+        Manda lo que haya en write_buffer.
+        """
+        if self.write_buffer:
+            self._sendall([self.write_buffer])
+            self.write_buffer = bytearray()
+
+    def _sendall(self, buffers: list):
+        """
+        Manda todos los buffers, en orden, bloqueando hasta que se haya
+        mandado todo. Se mandan juntos con una sola llamada a sendmsg
+        (writev), sin copiarlos a un solo buffer.
+        """
+        buffers = [memoryview(b) for b in buffers if len(b) > 0]
+        while buffers:
+            if self.limiters:
+                bytes_sent = self.socket.sendmsg(
+                    take_buffers(buffers, self.quantum))
+            else:
+                bytes_sent = self.socket.sendmsg(buffers)
             assert bytes_sent > 0
-            message = message[bytes_sent:]
+            consume_buffers(buffers, bytes_sent)
+            time.sleep(self.throttle(bytes_sent))
+
+    def throttle(self, bytes_sent: int) -> float:
+        """
+        Descuenta lo que se mandó de los limitadores de velocidad, y
+        devuelve la cantidad de segundos que hay que esperar antes de
+        mandar más.
+        """
+        metrics.BYTES_SENT.inc(amount=bytes_sent)
+        return max((limiter.reserve(bytes_sent) for limiter in self.limiters),
+                   default=0.0)
 
     def quit(self):
         """
@@ -59,7 +220,7 @@ class Connection(object):
         print("Closing connection...")
 
     def file_exist(self, filename: str) -> bool:
-        return os.path.isfile(os.path.join(self.directory, filename))
+        return self.metadata.stat(filename) is not None
 
     def filename_is_valid(self, filename: str) -> bool:
 
@@ -75,43 +236,76 @@ class Connection(object):
 
         print(f"Request: {command}")
 
+        name = args[0] if args[0] in COMMANDS else 'invalid'
+        start = time.perf_counter()
+        try:
+            self.dispatch(args)
+        finally:
+            metrics.REQUESTS.inc(name)
+            metrics.REQUEST_SECONDS.observe(time.perf_counter() - start,
+                                            name)
+
+    def dispatch(self, args: list):
+        """
+        Ejecuta la función del comando dado (como lista de palabras)
+        """
         match args:
             # En cada caso, si los argumentos son cantidad y tipo correctos
             # ejecuta la función correspondiente, que se encarga de enviar la
             # respuesta
             case ['get_file_listing']:
                 self.get_file_listing()
+            case ['get_file_listing', cursor, limit] if cursor.isdecimal() and limit.isdecimal():
+                self.get_file_listing(int(cursor), int(limit))
             case ['get_metadata', filename]:
                 self.get_metadata(filename)
+            case ['get_stat', filename]:
+                self.get_metadata(filename, mtime=True)
             case ['get_slice', filename, offset, size] if offset.isdecimal() and size.isdecimal():
                 self.get_slice(filename, int(offset), int(size))
+            case ['get_slice_raw', filename, offset, size] if offset.isdecimal() and size.isdecimal():
+                self.get_slice_raw(filename, int(offset), int(size))
+            case ['get_checksum', filename]:
+                self.get_checksum(filename)
+            case ['get_checksum', filename, offset, size] if offset.isdecimal() and size.isdecimal():
+                self.get_checksum(filename, int(offset), int(size))
+            case ['get_files', *patterns] if patterns:
+                self.get_files(patterns)
+            case ['get_signatures', filename]:
+                self.get_signatures(filename)
+            case ['set_compression', name]:
+                self.set_compression(name)
             case ['quit']:
                 self.quit()
-            case ['get_file_listing', *_] | ['get_metadata', *_] | ['get_slice', *_] | ['quit', *_]:
+            case ['get_file_listing', *_] | ['get_metadata', *_] | ['get_stat', *_] | ['get_slice', *_] | ['get_slice_raw', *_] | ['get_checksum', *_] | ['get_signatures', *_] | ['get_files', *_] | ['set_compression', *_] | ['quit', *_]:
                 response = mk_code(INVALID_ARGUMENTS)
                 self.send(response)
             case _:
                 response = mk_code(INVALID_COMMAND)
                 self.send(response)
 
-    def get_file_listing(self):
+    def get_file_listing(self, cursor: int = 0, limit: int = None):
         """
-        Lista los archivos de un directorio
+        Lista los archivos del directorio, en orden alfabético. Si se dan
+        'cursor' y 'limit', se saltean los primeros 'cursor' archivos y se
+        listan a lo sumo 'limit' (para pedir el listado de a páginas).
         """
-        response = mk_code(CODE_OK) + EOL
-
-        for dir in os.listdir(self.directory):
-            response += f"{dir} {EOL}"
-
+        chunks = self.listing.chunks(cursor, limit)
+        response = mk_code(CODE_OK)
+        self.send(response)
+        self.send_chunks(chunks)
+        response = ''
         self.send(response)
 
-    def get_metadata(self, filename: str):
+    def get_metadata(self, filename: str, mtime: bool = False):
         """
-        Devuelve el tamaño del archivo dado en bytes
+        Devuelve el tamaño del archivo dado en bytes. Si 'mtime' (para
+        get_stat), también la fecha de modificación en nanosegundos.
         """
         response = mk_code(CODE_OK) + EOL
+        stat = self.metadata.stat(filename)
 
-        if not self.file_exist(filename):
+        if stat is None:
             response = mk_code(FILE_NOT_FOUND)
             self.send(response)
 
@@ -120,12 +314,21 @@ class Connection(object):
             self.send(response)
 
         else:
-            data = os.path.getsize(os.path.join(self.directory, filename))
-            response += f"{str(data)}"
+            file_size, modified = stat
+            response += f"{str(file_size)}"
+            if mtime:
+                response += f" {modified}"
             self.send(response)
 
-    def get_slice(self, filename: str, offset: int, size: int):
-        if not self.file_exist(filename):
+    def check_slice(self, filename: str, offset: int, size: int):
+        """
+        Verifica que se pueda pedir el trozo dado del archivo. Si se puede,
+        devuelve el par (tamaño, fecha de modificación) del archivo. Si no,
+        manda el código de error correspondiente y devuelve None.
+        """
+        stat = self.metadata.stat(filename)
+
+        if stat is None:
             response = mk_code(FILE_NOT_FOUND)
             self.send(response)
 
@@ -134,29 +337,278 @@ class Connection(object):
             self.send(response)
 
         else:
-            file_size = os.path.getsize(os.path.join(self.directory, filename))
+            file_size, _ = stat
 
             if offset < 0 or file_size < offset + size:
                 response = mk_code(BAD_OFFSET)
                 self.send(response)
 
             else:
-                pathname = os.path.join(self.directory, filename)
-                response = mk_code(CODE_OK)
-                self.send(response)
-                with open(pathname, 'rb') as f:  # r = lectura, b = binario
-                    f.seek(offset)
+                return stat
+
+        return None
+
+    def get_slice(self, filename: str, offset: int, size: int):
+        stat = self.check_slice(filename, offset, size)
+        if stat is not None:
+            response = mk_code(CODE_OK)
+            self.send(response)
+            self.send_slice(filename, stat, offset, size)
+
+    def send_slice(self, filename: str, stat: tuple, offset: int,
+                   size: int):
+        """
+        Manda la línea de datos de un get_slice, con 'size' bytes del
+        archivo a partir de 'offset'. 'stat' es el par (tamaño, fecha de
+        modificación) del archivo.
+        """
+        # Se manda de a trozos, para no tener nunca el slice
+        # entero en memoria. Los archivos se codifican con b64encode
+        if self.codec is not None:
+            self.send_chunks(b64encode_stream(
+                self.compressed_chunks(filename, stat, offset, size)))
+        elif self.chunks is not None and offset % 3 == 0:
+            self.send_chunks(
+                self.encoded_chunks(filename, stat, offset, size))
+        else:
+            self.send_stream(
+                self.slice_chunks(filename, stat, offset, size))
 
-                    remaining = size
+        response = ''
+        self.send(response)
 
-                    while remaining > 0:
-                        bytes_read = f.read(remaining)
-                        remaining -= len(bytes_read)
-                        self.send(bytes_read, instance='b64encode')
-                            # Los archivos se codifican con b64encode
+    def get_files(self, patterns: list):
+        """
+        Manda varios archivos enteros en una sola respuesta. Para cada uno,
+        una línea con el nombre y el tamaño, y después el contenido como en
+        get_slice. Termina con una línea vacía.
 
-                    response = ''
+        Los argumentos pueden ser nombres de archivos o patrones (con *, ?
+        y [...], ver fnmatch), que se reemplazan por los archivos del
+        listado que coinciden, en orden alfabético (solo los archivos
+        regulares, no los subdirectorios). Cada archivo se manda una sola
+        vez. Si algún nombre dado explícitamente no existe o no es válido,
+        no se manda ninguno.
+        """
+        files = []
+        seen = set()
+        for pattern in patterns:
+            is_pattern = bool(set(pattern) & PATTERN_CHARS)
+            if is_pattern:
+                if not set(pattern) <= VALID_CHARS | PATTERN_CHARS:
+                    response = mk_code(INVALID_ARGUMENTS)
+                    self.send(response)
+                    return
+                names = [name for name in self.listing.names()
+                         if fnmatchcase(name, pattern)]
+            else:
+                names = [pattern]
+            for filename in names:
+                if filename in seen:
+                    continue
+                stat = self.metadata.stat(filename)
+                if stat is None and is_pattern:
+                    # Un subdirectorio, o un archivo que ya no existe
+                    continue
+                if stat is None:
+                    response = mk_code(FILE_NOT_FOUND)
+                    self.send(response)
+                    return
+                if not self.filename_is_valid(filename):
+                    response = mk_code(INVALID_ARGUMENTS)
                     self.send(response)
+                    return
+                seen.add(filename)
+                files.append((filename, stat))
+
+        response = mk_code(CODE_OK)
+        self.send(response)
+        for filename, stat in files:
+            file_size, _ = stat
+            response = f"{filename} {file_size}"
+            self.send(response)
+            self.send_slice(filename, stat, 0, file_size)
+        response = ''
+        self.send(response)
+
+    def slice_chunks(self, filename: str, stat: tuple, offset: int,
+                     size: int):
+        """
+        Generador que lee 'size' bytes del archivo a partir de 'offset', de
+        a trozos de 'chunk_size' bytes. 'stat' es el par (tamaño, fecha de
+        modificación) del archivo.
+
+        Si hay archivos mapeados en memoria, los trozos son memoryviews del
+        mapeo, sin copias. Si no, se leen con pread de los archivos
+        abiertos compartidos, y el archivo queda en uso solo mientras se lo
+        recorre.
+        """
+        if size == 0:
+            return
+        if self.maps is not None:
+            view = memoryview(self.maps.map(filename, stat))
+            for start in range(offset, offset + size, self.chunk_size):
+                yield view[start:min(start + self.chunk_size, offset + size)]
+        else:
+            with self.files.open(filename) as fd:
+                yield from pread_chunks(fd, offset, size, self.chunk_size)
+
+    def encoded_chunks(self, filename: str, stat: tuple, offset: int,
+                       size: int):
+        """
+        Generador que devuelve el trozo del archivo ya codificado en base64,
+        armado con los trozos alineados del cache de trozos codificados
+        (codificando y guardando los que no están).
+
+        'offset' tiene que ser múltiplo de 3, para que el trozo empiece al
+        principio de un grupo de 4 caracteres base64.
+        """
+        assert offset % 3 == 0
+        file_size, _ = stat
+        end = offset + size
+        while offset < end:
+            start = offset - offset % self.chunk_size
+            length = min(self.chunk_size, file_size - start)
+            key = (filename, stat, start)
+            encoded = self.chunks.get(key)
+            if encoded is None:
+                encoded = b''.join(map(b64encode, self.slice_chunks(
+                    filename, stat, start, length)))
+                self.chunks.put(key, encoded)
+
+            # Posiciones (en bytes del archivo) dentro del trozo alineado
+            first = offset - start
+            last = min(end - start, length)
+            view = memoryview(encoded)
+            if last % 3 == 0 or last == length:
+                yield view[first // 3 * 4:-(-last // 3) * 4]
+            else:
+                # El slice termina en la mitad de un grupo de 4 caracteres:
+                # ese grupo se vuelve a codificar solo con los bytes pedidos
+                whole = last - last % 3
+                yield view[first // 3 * 4:whole // 3 * 4]
+                group = b64decode(view[whole // 3 * 4:whole // 3 * 4 + 4])
+                yield b64encode(group[:last % 3])
+            offset = start + last
+
+    def compressed_chunks(self, filename: str, stat: tuple, offset: int,
+                          size: int):
+        """
+        Generador que devuelve el trozo del archivo como una sucesión de
+        frames (ver compression), uno por cada trozo alineado a
+        'chunk_size', comprimidos con el algoritmo de la conexión. Los
+        trozos de menos de 'compress_min' bytes se mandan sin comprimir.
+
+        Si hay cache de trozos, guarda los frames de los trozos alineados
+        enteros, así los archivos muy pedidos se comprimen una sola vez.
+        """
+        if size < self.compress_min:
+            for data in self.slice_chunks(filename, stat, offset, size):
+                yield compression.raw_frame(data)
+            return
+
+        file_size, _ = stat
+        end = offset + size
+        while offset < end:
+            start = offset - offset % self.chunk_size
+            stop = min(start + self.chunk_size, end)
+            cacheable = (self.chunks is not None and offset == start and
+                         stop == min(start + self.chunk_size, file_size))
+            key = (filename, stat, start, self.codec.name)
+            frame = self.chunks.get(key) if cacheable else None
+            if frame is None:
+                data = b''.join(self.slice_chunks(filename, stat, offset,
+                                                  stop - offset))
+                frame = compression.encode_frame(self.codec, data)
+                if cacheable:
+                    self.chunks.put(key, frame)
+            yield frame
+            offset = stop
+
+    def get_checksum(self, filename: str, offset: int = 0, size: int = None):
+        """
+        Devuelve el hash SHA-256 (en hexadecimal) del archivo entero, o de
+        'size' bytes a partir de 'offset'.
+        """
+        if size is None:
+            stat = self.metadata.stat(filename)
+            size = 0 if stat is None else stat[0]
+        stat = self.check_slice(filename, offset, size)
+        if stat is not None:
+            if self.hashes is not None:
+                future = self.hashes.checksum(filename, stat, offset, size)
+            else:
+                future = Future()
+                future.set_result(hash_range(
+                    os.path.join(self.directory, filename), offset, size))
+
+            def respond(future):
+                response = mk_code(CODE_OK) + EOL + future.result()
+                self.send(response)
+            self.send_when_done(future, respond)
+
+    def get_signatures(self, filename: str):
+        """
+        Manda las firmas de los bloques del archivo, para que el cliente
+        busque cuáles ya tiene (ver checksum.find_matches): una línea con el
+        tamaño del archivo, el tamaño de bloque y el hash del archivo
+        entero, y después una línea por bloque con su checksum débil (en
+        hexadecimal) y su hash, terminando con una línea vacía.
+        """
+        stat = self.check_slice(filename, 0, 0)
+        if stat is not None:
+            if self.hashes is not None:
+                block_size = self.hashes.block_size
+                future = self.hashes.signatures(filename, stat)
+            else:
+                block_size = CHECKSUM_BLOCK
+                future = Future()
+                future.set_result(compute_hashes(
+                    os.path.join(self.directory, filename), block_size))
+
+            def respond(future):
+                hashes = future.result()
+                file_size, _ = hashes.version
+                response = mk_code(CODE_OK)
+                self.send(response)
+                response = f"{file_size} {block_size} {hashes.digest}"
+                self.send(response)
+                self.send_chunks([''.join(
+                    f"{weak:08x} {strong}{EOL}"
+                    for weak, strong in zip(hashes.weak, hashes.blocks)
+                ).encode("ascii")])
+                response = ''
+                self.send(response)
+            self.send_when_done(future, respond)
+
+    def set_compression(self, name: str):
+        """
+        Elige el algoritmo con el que se comprimen los siguientes get_slice
+        de la conexión ('none' para no comprimir).
+        """
+        if name == 'none':
+            self.codec = None
+        elif name in compression.CODECS:
+            self.codec = compression.CODECS[name]
+        else:
+            response = mk_code(INVALID_ARGUMENTS)
+            self.send(response)
+            return
+        response = mk_code(CODE_OK)
+        self.send(response)
+
+    def get_slice_raw(self, filename: str, offset: int, size: int):
+        """
+        Como get_slice, pero después de la línea de respuesta se mandan
+        exactamente 'size' bytes del archivo tal cual, sin codificar y sin
+        terminador de línea. Los bytes van directo del page cache al socket
+        (sendfile), sin pasar por Python.
+        """
+        if self.check_slice(filename, offset, size) is not None:
+            pathname = os.path.join(self.directory, filename)
+            response = mk_code(CODE_OK)
+            self.send(response)
+            self.send_file(pathname, offset, size)
 
     def _recv(self):
         """
@@ -164,18 +616,35 @@ class Connection(object):
 
         Para uso privado del server.
         """
-        try:
-            data = self.socket.recv(4096).decode("ascii")
-            self.buffer += data
+        self._feed(self.socket.recv(self.recv_size))
 
-            if len(data) == 0:
-                self.connection_active = False
+    def _feed(self, data: bytes):
+        """
+        Acumula en el buffer interno los datos recibidos del cliente.
+        """
+        self.buffer.feed(data)
+        metrics.BYTES_RECEIVED.inc(amount=len(data))
+
+        if len(data) == 0:
+            self.connection_active = False
+
+    def _pop_request(self) -> str:
+        """
+        Saca del buffer la primera línea (que tiene que estar completa) y
+        la devuelve decodificada, sin el terminador ni espacios al principio
+        y al final.
 
+        Si la línea no es ascii, responde BAD_REQUEST y termina la conexión.
+        """
+        request = self.buffer.pop_line()
+        try:
+            return request.decode("ascii").strip()
         except UnicodeError:
             response = mk_code(BAD_REQUEST)
             self.send(response)
             self.connection_active = False
             print("Closing connection...")
+            return ""
 
     def read_line(self):
         """
@@ -185,41 +654,480 @@ class Connection(object):
         Devuelve la línea, eliminando el terminaodr y los espacios en blanco
         al principio y al final.
         """
-        while EOL not in self.buffer and self.connection_active:
+        while not self.buffer.has_line() and self.connection_active:
             self._recv()
 
-        if EOL in self.buffer:
-            request, self.buffer = self.buffer.split(EOL, 1)
-            return request.strip()
+        if self.buffer.has_line():
+            return self._pop_request()
         else:
             self.connected = False
             return ""
 
-    def handle(self):
+    def handle_line(self, line: str):
         """
-        Atiende eventos de la conexión hasta que termina.
+        Atiende una línea de pedido, ya sin el terminador.
         """
-        while self.connection_active:
-            response = self.read_line()
-            if NEWLINE in response:
-                response = mk_code(BAD_EOL)
+        if NEWLINE in line:
+            response = mk_code(BAD_EOL)
+            self.send(response)
+            self.connection_active = False
+            print("Closing connection...")
+        elif len(line) > 0:
+            try:
+                self.analizar_comando(line)
+            except Exception:
+                print('INTERNAL SERVER ERROR')
+                print(traceback.format_exc())
+                response = mk_code(INTERNAL_ERROR)
                 self.send(response)
                 self.connection_active = False
                 print("Closing connection...")
-            elif len(response) > 0:
-                try:
-                    self.analizar_comando(response)
-                except Exception:
-                    print('INTERNAL SERVER ERROR')
-                    print(traceback.format_exc())
-                    response = mk_code(INTERNAL_ERROR)
-                    self.send(response)
-                    self.connection_active = False
-                    print("Closing connection...")
+
+    def handle(self):
+        """
+        Atiende eventos de la conexión hasta que termina.
+        """
+        while self.connection_active:
+            if not self.buffer.has_line():
+                # Antes de esperar más pedidos se manda lo pendiente
+                self.flush()
+            self.handle_line(self.read_line())
+        self.flush()
         self.socket.close()
 
 
+class QueuedConnection(Connection):
+    """
+    Conexión que en lugar de mandar las respuestas en el momento, las encola
+    en 'output' para que otro (el loop de eventos) las mande cuando el socket
+    esté listo.
+
+    Los elementos de la cola son bytes, iteradores de bytes que se
+    consumen de a un trozo por vez (así un get_slice grande nunca está
+    entero en memoria), FileRange para mandar con sendfile, o Deferred para
+    respuestas que esperan algo que se hace en otro hilo.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.output = deque()
+
+    def _write(self, data: bytes):
+        self.output.append(data)
+
+    def send_stream(self, chunks):
+        self.output.append(map(b64encode, chunks))
+
+    def send_chunks(self, chunks):
+        self.output.append(iter(chunks))
+
+    def send_file(self, pathname: str, offset: int, size: int):
+        self.output.append(FileRange(pathname, offset, size))
+
+    def send_when_done(self, future: Future, respond):
+        self.output.append(Deferred(future, respond))
+
+    def waiting(self) -> Future:
+        """
+        Devuelve el Future que tiene que terminar para poder seguir
+        mandando respuestas, o None si no hay ninguno.
+        """
+        if self.output and isinstance(self.output[0], Deferred):
+            future = self.output[0].future
+            if not future.done():
+                return future
+        return None
+
+    def next_output(self):
+        """
+        Devuelve el próximo trozo de bytes (o FileRange) a mandar, sin
+        sacarlo de la cola, o None si no hay nada para mandar (o si lo
+        próximo es un Deferred que todavía no terminó, ver waiting).
+        """
+        while self.output:
+            head = self.output[0]
+            if isinstance(head, (bytes, memoryview)):
+                return head
+            if isinstance(head, FileRange):
+                if head.remaining > 0:
+                    return head
+                head.close()
+                self.output.popleft()
+                continue
+            if isinstance(head, Deferred):
+                if not head.future.done():
+                    return None
+                # La respuesta va en su lugar, antes de lo que ya estaba
+                # encolado después
+                self.output.popleft()
+                rest, self.output = self.output, deque()
+                head.respond(head.future)
+                self.output.extend(rest)
+                continue
+            chunk = next(head, None)
+            if chunk is None:
+                self.output.popleft()
+            else:
+                self.output.appendleft(chunk)
+        return None
+
+    def gather_output(self, limit: int = WRITE_BUFFER_SIZE) -> list:
+        """
+        Devuelve los trozos de bytes del principio de la cola (hasta que
+        sumen 'limit' bytes o aparezca un FileRange), sin sacarlos de la
+        cola, para mandarlos todos juntos con una sola escritura.
+
+        De los iteradores se saca a lo sumo un trozo por vez.
+        """
+        buffers = []
+        total = 0
+        i = 0
+        while (i < len(self.output) and total < limit
+               and len(buffers) < IOV_MAX):
+            item = self.output[i]
+            if isinstance(item, (bytes, memoryview)):
+                if total + len(item) > limit:
+                    item = memoryview(item)[:limit - total]
+                buffers.append(item)
+                total += len(item)
+                i += 1
+            elif isinstance(item, (FileRange, Deferred)):
+                break
+            else:
+                chunk = next(item, None)
+                if chunk is None:
+                    del self.output[i]
+                else:
+                    self.output.insert(i, chunk)
+        return buffers
+
+    def consume_output(self, bytes_sent: int):
+        """
+        Saca de la cola los primeros 'bytes_sent' bytes, que ya se mandaron.
+        """
+        while bytes_sent > 0:
+            head = self.output[0]
+            if bytes_sent >= len(head):
+                bytes_sent -= len(head)
+                self.output.popleft()
+            else:
+                self.output[0] = memoryview(head)[bytes_sent:]
+                bytes_sent = 0
+
+    def output_full(self) -> bool:
+        """
+        Indica si ya hay suficientes respuestas encoladas como para dejar de
+        atender pedidos hasta mandarlas. Las respuestas de tamaño no
+        conocido (iteradores, FileRange y Deferred) cuentan como llenas.
+        """
+        total = 0
+        for item in self.output:
+            if not isinstance(item, (bytes, memoryview)):
+                return True
+            total += len(item)
+        return total >= WRITE_BUFFER_SIZE
+
+    def pending_lines(self):
+        """
+        Saca del buffer las líneas completas que se pueden atender.
+
+        Se atienden varios pedidos seguidos (pipelining) mientras las
+        respuestas encoladas sean pocas; con la cola llena se espera a
+        mandarlas, para que no crezca sin límite.
+        """
+        while (self.connection_active and not self.output_full()
+               and self.buffer.has_line()):
+            yield self._pop_request()
+
+
+class SelectorConnection(QueuedConnection):
+    """
+    Conexión atendida por un loop de eventos con selectors. El socket tiene
+    que ser no bloqueante.
+
+    Es una máquina de estados: cuando hay respuestas encoladas espera poder
+    escribir, si no espera pedidos; cuando terminó y mandó todo, se cierra.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Hasta cuándo no puede mandar nada (ver paused)
+        self.resume_at = 0.0
+
+    def events(self) -> int:
+        """
+        Eventos que le interesan a la conexión en su estado actual, o 0 si
+        la conexión terminó y ya se puede cerrar.
+        """
+        if self.output:
+            return selectors.EVENT_WRITE
+        elif self.connection_active:
+            return selectors.EVENT_READ
+        else:
+            return 0
+
+    def on_readable(self):
+        """
+        El socket tiene datos (o se cerró del otro lado).
+        """
+        self._recv()
+        self.handle_pending()
+
+    def paused(self) -> bool:
+        """
+        Indica si la conexión no puede mandar nada hasta 'resume_at',
+        porque se pasó de la velocidad permitida.
+        """
+        return self.resume_at > time.monotonic()
+
+    def on_writable(self):
+        """
+        El socket tiene lugar para mandar datos.
+
+        Se manda a lo sumo 'quantum' bytes por vez, así el loop de eventos
+        reparte el ancho de banda por turnos entre todas las conexiones y
+        las respuestas chicas no esperan a que terminen las grandes.
+        """
+        budget = self.quantum
+        data = self.next_output()
+        while data is not None and budget > 0:
+            try:
+                if isinstance(data, FileRange):
+                    bytes_sent = data.sendfile(self.socket, budget)
+                    expected = bytes_sent
+                else:
+                    buffers = self.gather_output(budget)
+                    bytes_sent = self.socket.sendmsg(buffers)
+                    self.consume_output(bytes_sent)
+                    expected = sum(map(len, buffers))
+            except BlockingIOError:
+                return
+            budget -= bytes_sent
+            delay = self.throttle(bytes_sent)
+            if delay > 0:
+                self.resume_at = time.monotonic() + delay
+                return
+            if bytes_sent < expected:
+                return
+            data = self.next_output()
+
+        if data is None:
+            # Se mandó todo, se pueden atender los pedidos que quedaron en
+            # buffer
+            self.handle_pending()
+
+    def handle_pending(self):
+        for line in self.pending_lines():
+            self.handle_line(line)
+
+
+class AsyncConnection(QueuedConnection):
+    """
+    Conexión atendida por una corrutina de asyncio, que lee los pedidos del
+    StreamReader y manda las respuestas por el StreamWriter.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter, *args, **kwargs):
+        super().__init__(writer.get_extra_info('socket'), *args, **kwargs)
+        self.reader = reader
+        self.writer = writer
+
+    async def flush(self):
+        """
+        Manda todas las respuestas encoladas, esperando a que el socket
+        tenga lugar entre trozo y trozo.
+
+        Entre trozo y trozo (de a lo sumo 'quantum' bytes) se le da el turno
+        a las demás conexiones, y se espera lo que digan los limitadores de
+        velocidad. Las respuestas que esperan algo de otro hilo (ver
+        Deferred) se esperan sin bloquear el loop de eventos.
+        """
+        data = await self.next_output_async()
+        while data is not None:
+            if isinstance(data, FileRange):
+                count = data.remaining
+                if self.limiters:
+                    count = min(count, self.quantum)
+                loop = asyncio.get_running_loop()
+                bytes_sent = await loop.sendfile(self.writer.transport,
+                                                 data.file, data.offset,
+                                                 count)
+                data.advance(bytes_sent)
+                if bytes_sent < count:
+                    raise EOFError(f"flush: faltaron {data.remaining} bytes")
+            else:
+                buffers = self.gather_output(self.quantum)
+                self.writer.writelines(buffers)
+                bytes_sent = sum(map(len, buffers))
+                self.consume_output(bytes_sent)
+                await self.writer.drain()
+            await asyncio.sleep(self.throttle(bytes_sent))
+            data = await self.next_output_async()
+
+    async def next_output_async(self):
+        """
+        Como next_output, pero si lo próximo espera un Future (ver waiting),
+        lo espera.
+        """
+        data = self.next_output()
+        while data is None and self.waiting() is not None:
+            await asyncio.wait([asyncio.wrap_future(self.waiting())])
+            data = self.next_output()
+        return data
+
+    async def handle_async(self):
+        """
+        Atiende pedidos de la conexión hasta que termina.
+        """
+        try:
+            while self.connection_active:
+                if self.buffer.has_line():
+                    for line in self.pending_lines():
+                        self.handle_line(line)
+                    await self.flush()
+                else:
+                    self._feed(await self.reader.read(self.recv_size))
+            await self.flush()
+        except Exception:
+            print(traceback.format_exc())
+        finally:
+            self.writer.close()
+
+
+class Deferred(object):
+    """
+    Respuesta que se arma con respond(future) recién cuando termina
+    'future'. Hasta entonces no se manda nada de lo que está encolado
+    después, así las respuestas salen en el orden de los pedidos.
+    """
+
+    def __init__(self, future: Future, respond):
+        self.future = future
+        self.respond = respond
+
+
+class FileRange(object):
+    """
+    Rango de bytes de un archivo que se tiene que mandar tal cual, con
+    sendfile. Se usa en las conexiones no bloqueantes, que lo mandan de a
+    partes a medida que el socket tiene lugar.
+    """
+
+    def __init__(self, pathname: str, offset: int, size: int):
+        self.file = open(pathname, 'rb')
+        self.offset = offset
+        self.remaining = size
+
+    def advance(self, bytes_sent: int):
+        self.offset += bytes_sent
+        self.remaining -= bytes_sent
+
+    def sendfile(self, sock: socket.socket, limit: int = None) -> int:
+        """
+        Manda lo que se pueda del rango (hasta 'limit' bytes) por el socket
+        (no bloqueante) y devuelve la cantidad de bytes mandados. Puede
+        fallar con BlockingIOError si el socket no tiene lugar.
+        """
+        count = self.remaining if limit is None else min(limit,
+                                                         self.remaining)
+        bytes_sent = os.sendfile(sock.fileno(), self.file.fileno(),
+                                 self.offset, count)
+        if bytes_sent == 0:
+            raise EOFError(f"sendfile: faltaron {self.remaining} bytes")
+        self.advance(bytes_sent)
+        return bytes_sent
+
+    def close(self):
+        self.file.close()
+
+
+def consume_buffers(buffers: list, bytes_sent: int):
+    """
+    Saca del principio de la lista de memoryviews los primeros 'bytes_sent'
+    bytes.
+    """
+    while bytes_sent > 0:
+        if bytes_sent >= len(buffers[0]):
+            bytes_sent -= len(buffers[0])
+            buffers.pop(0)
+        else:
+            buffers[0] = buffers[0][bytes_sent:]
+            bytes_sent = 0
+
+
+def b64encode_stream(parts):
+    """
+    Generador que codifica en base64 la concatenación de los trozos de
+    bytes de 'parts', que pueden tener cualquier largo, de a un trozo por
+    vez.
+    """
+    rest = b''
+    for part in parts:
+        data = part if not rest else rest + part
+        whole = len(data) - len(data) % 3
+        if whole > 0:
+            yield b64encode(memoryview(data)[:whole])
+        rest = data[whole:]
+    if rest:
+        yield b64encode(rest)
+
+
+def take_buffers(buffers: list, limit: int) -> list:
+    """
+    Devuelve los memoryviews del principio de la lista que suman a lo sumo
+    'limit' bytes (cortando el último si hace falta), sin sacarlos.
+    """
+    result = []
+    for buffer in buffers:
+        if limit <= 0:
+            break
+        result.append(buffer[:limit])
+        limit -= len(result[-1])
+    return result
+
+
+def set_nodelay(sock: socket.socket):
+    """
+    Desactiva el algoritmo de Nagle en el socket. Sin esto, una respuesta
+    chica seguida de otra escritura (como la línea de estado antes del
+    sendfile de un get_slice_raw) espera el ACK retrasado del cliente,
+    unos 40 ms. Las respuestas chicas igual se juntan en write_buffer
+    antes de mandarlas.
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass  # No es un socket TCP
+
+
 def mk_code(code: int) -> str:
     assert code in error_messages.keys()
+    metrics.RESPONSES.inc(code)
 
     return f"{code} {error_messages[code]}"
+
+
+def pread_chunks(fd: int, offset: int, size: int,
+                 chunk_size: int = CHUNK_SIZE):
+    """
+    Generador que lee 'size' bytes del file descriptor 'fd', a partir de
+    'offset', de a trozos de a lo sumo 'chunk_size' bytes. Usa os.pread,
+    así que no importa (ni cambia) la posición actual del archivo.
+
+    Si 'chunk_size' es múltiplo de 3, todos los trozos menos el último
+    también lo son, por lo que se pueden codificar en base64 por separado
+    y concatenar el resultado.
+
+    Falla con EOFError si el archivo termina antes de tiempo (por ejemplo,
+    porque lo truncaron mientras se leía).
+    """
+    remaining = size
+    while remaining > 0:
+        data = os.pread(fd, min(chunk_size, remaining), offset)
+        if len(data) == 0:
+            raise EOFError(f"pread_chunks: faltaron {remaining} bytes")
+        offset += len(data)
+        remaining -= len(data)
+        yield data
+
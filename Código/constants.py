@@ -9,9 +9,108 @@ DEFAULT_DIR = 'testdata'
 DEFAULT_ADDR = '0.0.0.0'  # 0.0.0.0 representa todas las IPv4 del server
 DEFAULT_PORT = 19500
 
+# Cantidad mínima y máxima de hilos que atienden conexiones en el modo
+# threads, y cuántos segundos espera un hilo de más sin conexiones antes de
+# terminar
+MIN_THREADS = 1
 MAX_THREADS = 5
+THREAD_IDLE_TIMEOUT = 30.0
+
+# Con --workers, cuánto se espera para relanzar un hijo que murió antes de
+# WORKER_MIN_UPTIME segundos de haber arrancado (la espera se duplica con
+# cada muerte seguida, hasta WORKER_RESTART_MAX segundos); los que duraron
+# más se relanzan enseguida
+WORKER_RESTART_DELAY = 0.5
+WORKER_RESTART_MAX = 30.0
+WORKER_MIN_UPTIME = 10.0
+# Cuántos segundos espera un hijo que se le pidió terminar a que terminen
+# las conexiones que está atendiendo, antes de cortarlas
+WORKER_SHUTDOWN_TIMEOUT = 10.0
+
+# Largo de la cola de conexiones que todavía no se aceptaron (listen), y
+# cantidad máxima de conexiones aceptadas que esperan a ser atendidas
+LISTEN_BACKLOG = 128
+MAX_PENDING = 64
+
+# Cantidad de bytes que se leen del archivo por vez al atender un get_slice.
+# Tiene que ser múltiplo de 3 para que la concatenación de los trozos
+# codificados en base64 siga siendo un texto base64 válido.
+CHUNK_SIZE = 3 * 2 ** 14  # 48 KiB
+
+# Cantidad máxima de bytes que se reciben del socket por vez
+RECV_SIZE = 2 ** 16
+
+# Las respuestas chicas se juntan hasta tener esta cantidad de bytes antes
+# de mandarlas (pipelining)
+WRITE_BUFFER_SIZE = 2 ** 16
+# Cantidad máxima de buffers en una sola llamada a sendmsg
+IOV_MAX = 1024
+
+# Cantidad máxima de pedidos que el cliente manda sin esperar respuesta
+PIPELINE_DEPTH = 32
+
+# Cada cuántos segundos se revisa el directorio compartido buscando cambios,
+# si no se puede usar inotify
+POLL_INTERVAL = 1.0
+
+# Cantidad de nombres por bloque en el listado de archivos que guarda el
+# server
+LISTING_BLOCK = 1024
+
+# Cantidad máxima de archivos que el server deja abiertos (o mapeados en
+# memoria) para reutilizarlos
+OPEN_FILES = 128
+
+# Cantidad máxima de bytes de trozos de archivos ya codificados en base64
+# que el server guarda en memoria (0 para no guardar ninguno)
+CHUNK_CACHE_SIZE = 0
+
+# Nivel de compresión de zlib (de 1, el más rápido, a 9, el que más
+# comprime), y tamaño mínimo de un get_slice para comprimirlo, en las
+# conexiones que pidieron compresión con set_compression
+COMPRESSION_LEVEL = 6
+COMPRESS_MIN = 1024
+
+# Dirección y puerto donde se publican las métricas del server (0 para no
+# publicarlas), y límites (en segundos) de los intervalos de los
+# histogramas de tiempos de respuesta
+METRICS_ADDR = '127.0.0.1'
+METRICS_PORT = 0
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Cantidad máxima de nombres (o patrones) que el cliente pide por vez con
+# get_files
+BATCH_FILES = 256
+
+# Cantidad máxima de conexiones abiertas de un ClientPool, cuántos segundos
+# puede quedar libre una conexión antes de cerrarla, y después de cuántos
+# segundos libre se revisa que el server la siga atendiendo (y cuánto se
+# espera su respuesta)
+POOL_SIZE = 4
+POOL_IDLE_TIMEOUT = 30.0
+POOL_CHECK_INTERVAL = 5.0
+POOL_CHECK_TIMEOUT = 5.0
+
+# Tamaño de los bloques de los que el server guarda el hash (SHA-256) en
+# el índice de get_checksum, cantidad máxima de archivos en el índice, y
+# cantidad máxima de hilos que calculan hashes a la vez
+CHECKSUM_BLOCK = 2 ** 20  # 1 MiB
+CHECKSUM_FILES = 4096
+CHECKSUM_WORKERS = 4
+
+# Cantidad máxima de bytes de la copia local que Client.sync recorre byte
+# por byte buscando bloques corridos (ver checksum.find_matches); si las
+# partes que no coinciden en su lugar suman más, esos bloques se bajan
+SYNC_SCAN_LIMIT = 64 * 2 ** 20
+
+# Extensión del archivo donde el cliente registra el progreso de una
+# descarga, y cada cuántos bytes recibidos lo actualiza
+JOURNAL_SUFFIX = '.journal'
+JOURNAL_INTERVAL = 2 ** 20  # 1 MiB
 
 EOL = '\r\n'
+EOL_BYTES = EOL.encode("ascii")
 
 NEWLINE = '\n'
 
@@ -19,6 +118,7 @@ NEWLINE = '\n'
 CODE_OK = 0
 BAD_EOL = 100
 BAD_REQUEST = 101
+SERVER_BUSY = 102
 INTERNAL_ERROR = 199
 INVALID_COMMAND = 200
 INVALID_ARGUMENTS = 201
@@ -31,6 +131,7 @@ error_messages = {
     # 1xx: Errores fatales (no se pueden atender más pedidos)
     BAD_EOL: "BAD EOL",
     BAD_REQUEST: "BAD REQUEST",
+    SERVER_BUSY: "SERVER BUSY",
     INTERNAL_ERROR: "INTERNAL SERVER ERROR",
     # 2xx: Errores no fatales (no se pudo atender este pedido)
     INVALID_COMMAND: "NO SUCH COMMAND",
@@ -56,3 +157,7 @@ for i in range(ord('a'), ord('z') + 1):
     VALID_CHARS.add(chr(i))
 for i in range(ord('0'), ord('9') + 1):
     VALID_CHARS.add(chr(i))
+
+# Caracteres de los patrones de get_files (ver fnmatch), además de los de
+# los nombres
+PATTERN_CHARS = set("*?[]!")
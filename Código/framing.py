@@ -0,0 +1,89 @@
+# encoding: utf-8
+# Buffer de recepción compartido por el server y el cliente HFTP
+
+from constants import *
+
+
+class LineBuffer(object):
+    """
+    Buffer de recepción de un protocolo de líneas terminadas en EOL.
+
+    Guarda los bytes recibidos en un bytearray, sin decodificarlos: quien
+    saca una línea de pedido o de respuesta la decodifica, pero los datos
+    de los archivos se sacan tal cual.
+
+    La búsqueda del terminador arranca desde donde terminó la búsqueda
+    anterior, así que una línea muy larga que llega de a pedazos se recorre
+    una sola vez. Sacar datos del principio de un bytearray no copia el
+    resto, así que tampoco cuesta más cuanto más datos haya en el buffer.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        # Hasta dónde ya se buscó el terminador sin encontrarlo
+        self.scanned = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def feed(self, data: bytes):
+        """
+        Agrega al final del buffer los datos recibidos.
+        """
+        self.data += data
+
+    def find_eol(self) -> int:
+        """
+        Devuelve la posición del primer terminador de línea en el buffer, o
+        -1 si no hay ninguno.
+        """
+        # El terminador pudo haber quedado partido entre dos recepciones
+        start = max(0, self.scanned - len(EOL_BYTES) + 1)
+        end = self.data.find(EOL_BYTES, start)
+        self.scanned = len(self.data) if end < 0 else end
+        return end
+
+    def has_line(self) -> bool:
+        return self.find_eol() >= 0
+
+    def pop(self, size: int) -> bytes:
+        """
+        Saca y devuelve los primeros 'size' bytes del buffer (o menos, si
+        no hay tantos).
+        """
+        data = bytes(self.data[:size])
+        del self.data[:size]
+        self.scanned = max(0, self.scanned - len(data))
+        return data
+
+    def pop_line(self):
+        """
+        Saca la primera línea completa del buffer y la devuelve sin el
+        terminador, o devuelve None si todavía no hay ninguna.
+        """
+        end = self.find_eol()
+        if end < 0:
+            return None
+        line = self.pop(end)
+        self.pop(len(EOL_BYTES))
+        return line
+
+    def pop_base64(self):
+        """
+        Saca del buffer todo lo que se pueda decodificar de una línea de
+        datos en base64 que todavía puede no haber llegado entera.
+
+        Devuelve un par (bytes, bool), donde el bool indica si se llegó al
+        final de la línea (y se sacó el terminador). Si no, el largo de los
+        datos es múltiplo de 4, que es lo que se puede decodificar por
+        separado (cada 4 caracteres base64 representan 3 bytes).
+        """
+        line = self.pop_line()
+        if line is not None:
+            return line, True
+
+        usable = len(self.data)
+        if self.data.endswith(EOL_BYTES[:1]):
+            # Puede ser el comienzo del terminador
+            usable -= 1
+        return self.pop(usable - usable % 4), False
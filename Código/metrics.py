@@ -0,0 +1,221 @@
+# encoding: utf-8
+# Métricas del server, que se publican por HTTP en el formato de texto de
+# Prometheus
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from constants import *
+
+# Tipos de métrica de Prometheus
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+
+class Registry(object):
+    """
+    Conjunto de métricas que se publican juntas.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        Devuelve todas las métricas en el formato de texto de Prometheus.
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{format_labels(labels)} "
+                             f"{format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(object):
+    """
+    Contador que solo sube, con un valor por cada combinación de valores
+    de las etiquetas 'labelnames'.
+
+    Se puede usar desde varios hilos a la vez.
+    """
+
+    type = COUNTER
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        """
+        Suma 'amount' al contador de las etiquetas dadas (tantos valores
+        como 'labelnames', en el mismo orden).
+        """
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        if not values and not self.labelnames:
+            values = [((), 0)]
+        for labels, value in values:
+            yield self.name, zip(self.labelnames, labels), value
+
+
+class Histogram(object):
+    """
+    Distribución de valores (por ejemplo, tiempos de respuesta): cuenta
+    cuántos valores cayeron por debajo de cada uno de los límites
+    'buckets', además de la cantidad y la suma de todos.
+
+    Se puede usar desde varios hilos a la vez.
+    """
+
+    type = HISTOGRAM
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (),
+                 buckets: tuple = METRICS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = sorted(buckets)
+        # Para cada combinación de etiquetas, la lista de cuántos valores
+        # cayeron en cada intervalo (el último es el de los que superan el
+        # mayor límite), la suma y la cantidad
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total, count = self.values.get(
+                labels, ([0] * (len(self.buckets) + 1), 0.0, 0))
+            counts[index] += 1
+            self.values[labels] = (counts, total + value, count + 1)
+
+    def samples(self):
+        with self.lock:
+            values = sorted((labels, (list(counts), total, count))
+                            for labels, (counts, total, count)
+                            in self.values.items())
+        for labels, (counts, total, count) in values:
+            labels = list(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield (self.name + '_bucket',
+                       labels + [('le', format_value(bound))], cumulative)
+            yield self.name + '_bucket', labels + [('le', '+Inf')], count
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, count
+
+
+class Sampled(object):
+    """
+    Métrica cuyo valor se calcula recién al publicarla, llamando a
+    'function'. Sirve para publicar el estado de otras partes del server
+    (como el pool de hilos o los caches) sin que tengan que actualizar
+    nada en cada operación.
+
+    'function' devuelve un número, o un diccionario de tuplas de valores
+    de las etiquetas 'labelnames' a números.
+    """
+
+    def __init__(self, name: str, help: str, function, type: str = GAUGE,
+                 labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.type = type
+        self.labelnames = tuple(labelnames)
+
+    def samples(self):
+        value = self.function()
+        if not isinstance(value, dict):
+            value = {(): value}
+        for labels, sample in sorted(value.items()):
+            yield self.name, zip(self.labelnames, labels), sample
+
+
+def format_labels(labels) -> str:
+    labels = [f'{name}="{escape(str(value))}"' for name, value in labels]
+    if not labels:
+        return ''
+    return '{' + ','.join(labels) + '}'
+
+
+def format_value(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def escape(value: str) -> str:
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+# Las métricas de todo el proceso. Las de las conexiones se actualizan en
+# cada pedido; las demás las agrega el server (Server.register_metrics).
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter(
+    'hftp_requests_total', "Pedidos atendidos, por comando",
+    ['command']))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'hftp_request_duration_seconds',
+    "Tiempo que lleva atender un pedido, por comando (en los modos select "
+    "y asyncio, hasta que la respuesta queda encolada)", ['command']))
+RESPONSES = REGISTRY.register(Counter(
+    'hftp_responses_total', "Respuestas mandadas, por código",
+    ['code']))
+BYTES_SENT = REGISTRY.register(Counter(
+    'hftp_sent_bytes_total', "Bytes mandados a los clientes"))
+BYTES_RECEIVED = REGISTRY.register(Counter(
+    'hftp_received_bytes_total', "Bytes recibidos de los clientes"))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Contesta cualquier GET con las métricas de REGISTRY.
+    """
+
+    def do_GET(self):
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Sin una línea por cada consulta
+        pass
+
+
+def start_http_server(port: int, addr: str = METRICS_ADDR):
+    """
+    Publica las métricas por HTTP en la dirección y puerto dados, desde un
+    hilo aparte. Devuelve el server HTTP.
+    """
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
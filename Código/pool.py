@@ -0,0 +1,103 @@
+# encoding: utf-8
+# Pool de hilos que atienden las conexiones en el modo threads
+
+import threading
+import time
+import traceback
+from collections import deque
+from constants import *
+
+
+class WorkerPool(object):
+    """
+    Pool de hilos que ejecutan las tareas de una cola compartida, para no
+    lanzar un hilo nuevo por cada conexión.
+
+    Arranca con 'min_threads' hilos. Si llega una tarea y no hay hilos
+    libres se lanza otro, hasta 'max_threads'; con todos ocupados, las
+    tareas esperan en la cola. Los hilos de más que pasan 'idle_timeout'
+    segundos sin tareas terminan.
+
+    Lleva la cuenta de cuánto esperan las tareas en la cola (ver stats).
+    """
+
+    def __init__(self, min_threads: int = MIN_THREADS,
+                 max_threads: int = MAX_THREADS,
+                 idle_timeout: float = THREAD_IDLE_TIMEOUT):
+        assert 0 <= min_threads <= max_threads and max_threads > 0
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        self.idle_timeout = idle_timeout
+        # Tripletas (momento en que se encoló, función, argumentos)
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.threads = 0
+        self.idle = 0
+        # Tareas que ya salieron de la cola, y las que ya terminaron
+        self.started = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def start(self):
+        """
+        Lanza los primeros 'min_threads' hilos. Se tiene que llamar en el
+        proceso que atiende a los clientes (los hilos no sobreviven a un
+        fork).
+        """
+        with self.condition:
+            while self.threads < self.min_threads:
+                self._spawn()
+
+    def submit(self, function, *args):
+        """
+        Encola la llamada function(*args) para que la haga un hilo libre.
+        """
+        with self.condition:
+            self.queue.append((time.monotonic(), function, args))
+            if len(self.queue) > self.idle and self.threads < self.max_threads:
+                self._spawn()
+            self.condition.notify()
+
+    def _spawn(self):
+        self.threads += 1
+        thread = threading.Thread(target=self._work, daemon=True)
+        thread.start()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                self.idle += 1
+                while not self.queue:
+                    timed_out = not self.condition.wait(self.idle_timeout)
+                    if (timed_out and not self.queue
+                            and self.threads > self.min_threads):
+                        self.idle -= 1
+                        self.threads -= 1
+                        return
+                self.idle -= 1
+                queued_at, function, args = self.queue.popleft()
+                wait = time.monotonic() - queued_at
+                self.started += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+
+            try:
+                function(*args)
+            except Exception:
+                print(traceback.format_exc())
+
+            with self.condition:
+                self.completed += 1
+
+    def stats(self) -> dict:
+        """
+        Devuelve el estado del pool: cantidad de hilos (y cuántos están
+        libres), tareas en la cola, tareas terminadas, y espera promedio y
+        máxima de las tareas en la cola (en segundos).
+        """
+        with self.condition:
+            return {'threads': self.threads, 'idle': self.idle,
+                    'queued': len(self.queue), 'completed': self.completed,
+                    'average_wait': self.total_wait / max(self.started, 1),
+                    'max_wait': self.max_wait}
@@ -0,0 +1,41 @@
+# encoding: utf-8
+# Limitación de la velocidad con la que el server manda datos
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Limitador de velocidad de 'rate' bytes por segundo, con ráfagas de
+    hasta 'burst' bytes (por defecto, lo que se manda en un segundo).
+
+    Funciona por reservas: quien manda datos descuenta los bytes con
+    reserve, que le dice cuánto tiene que esperar antes de volver a mandar.
+    Las fichas pueden quedar en negativo (una deuda), y cada reserva espera
+    a que se paguen todas las anteriores, así que los que comparten el
+    limitador se turnan en el orden en que reservaron.
+
+    Se puede usar desde varios hilos a la vez.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        assert rate > 0
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, size: int) -> float:
+        """
+        Descuenta 'size' bytes y devuelve la cantidad de segundos que hay
+        que esperar antes de mandar más datos.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= size
+            return max(0.0, -self.tokens / self.rate)
@@ -6,6 +6,8 @@
 # $Id: server-test.py 388 2011-03-22 14:20:06Z nicolasw $
 
 import unittest
+import asyncio
+import hashlib
 import client
 import constants
 import select
@@ -15,6 +17,7 @@ import os
 import os.path
 import logging
 import sys
+import threading
 
 DATADIR = 'testdata'
 TIMEOUT = 3  # Una cantidad razonable de segundos para esperar respuestas
@@ -122,6 +125,33 @@ class TestHFTPServer(TestBase):
                          "El tamaño reportado para el archivo no es el correcto")
         c.close()
 
+    def test_metadata_after_change(self):
+        c = self.new_client()
+        c.get_metadata('bar')
+        self.assertEqual(c.status, constants.FILE_NOT_FOUND)
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write('x' * 1000)
+        f.close()
+        # El server se entera de los cambios con un poco de demora
+        start = time.time()
+        m = c.get_metadata('bar')
+        while m != 1000 and time.time() - start <= TIMEOUT:
+            time.sleep(0.1)
+            m = c.get_metadata('bar')
+        self.assertEqual(m, 1000,
+                         "El tamaño reportado no cambió al crear el archivo")
+        f = open(os.path.join(DATADIR, 'bar'), 'a')
+        f.write('x' * 234)
+        f.close()
+        start = time.time()
+        m = c.get_metadata('bar')
+        while m != 1234 and time.time() - start <= TIMEOUT:
+            time.sleep(0.1)
+            m = c.get_metadata('bar')
+        self.assertEqual(m, 1234,
+                         "El tamaño reportado no cambió al modificar el archivo")
+        c.close()
+
     def test_get_full_slice(self):
         self.output_file = 'bar'
         test_data = 'The quick brown fox jumped over the lazy dog'
@@ -219,6 +249,14 @@ class TestHFTPErrors(TestBase):
                          "mal tipada (status=%d)" % status)
         c.close()
 
+    def test_non_ascii_request(self):
+        c = self.new_client()
+        c.s.send('get_metadata ñandú\r\n'.encode("utf-8"))
+        status, message = c.read_response_line(TIMEOUT)
+        self.assertEqual(status, constants.BAD_REQUEST,
+                         "El servidor no contestó 101 ante un pedido que no "
+                         "es ascii")
+
     def test_file_not_found(self):
         c = self.new_client()
         c.send('get_metadata does_not_exist')
@@ -252,6 +290,26 @@ class TestHFTPHard(TestBase):
         c.connected = False
         c.s.close()
 
+    def test_pipelined_batches(self):
+        for i in range(100):
+            f = open(os.path.join(DATADIR, 'file%03d' % i), 'wb')
+            f.write(b'x' * i)
+            f.close()
+        c = self.new_client()
+        filenames = ['file%03d' % i for i in range(100)] + ['does_not_exist']
+        sizes = c.get_metadata_batch(filenames)
+        self.assertEqual(sizes, list(range(100)) + [None],
+                         "Los tamaños de los archivos no son los correctos")
+        outputs = [bytearray(10) for i in range(5)]
+        c.get_slice_batch('file099', [(10 * i, 10) for i in range(5)],
+                          outputs)
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(outputs, [b'x' * 10] * 5,
+                         "El contenido de los trozos no es el correcto")
+        # La conexión sigue sincronizada después de los pedidos en lote
+        self.assertEqual(c.get_metadata('file050'), 50)
+        c.close()
+
     def test_big_file(self):
         self.output_file = 'bar'
         f = open(os.path.join(DATADIR, self.output_file), 'wb')
@@ -272,6 +330,46 @@ class TestHFTPHard(TestBase):
         f.close()
         c.close()
 
+    def test_big_unaligned_slice(self):
+        # Un slice que abarca varios trozos de lectura del server, empezando
+        # en un offset que no es múltiplo de 3
+        self.output_file = 'bar'
+        test_data = bytes(range(256)) * (2 ** 12)  # 1 MB
+        f = open(os.path.join(DATADIR, self.output_file), 'wb')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        c.get_slice(self.output_file, 1001, len(test_data) - 2000)
+        self.assertEqual(c.status, constants.CODE_OK)
+        f = open(self.output_file, 'rb')
+        self.assertEqual(f.read(), test_data[1001:-999],
+                         "El contenido del archivo no es el correcto")
+        f.close()
+        c.close()
+
+    def test_repeated_aligned_slices(self):
+        # Slices que empiezan en offsets múltiplos de 3 (que el server puede
+        # armar con trozos ya codificados), pedidos dos veces cada uno
+        test_data = os.urandom(3 * constants.CHUNK_SIZE + 1000)
+        f = open(os.path.join(DATADIR, 'bar'), 'wb')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        ranges = [(0, len(test_data)), (0, 1), (3, 4), (3, 5),
+                  (constants.CHUNK_SIZE - 3, 10),
+                  (constants.CHUNK_SIZE, constants.CHUNK_SIZE),
+                  (3 * constants.CHUNK_SIZE, 1000), (len(test_data) - 1, 1),
+                  (6, 2 * constants.CHUNK_SIZE + 2)]
+        for _ in range(2):
+            for start, length in ranges:
+                data = bytearray()
+                c.get_slice('bar', start, length, data)
+                self.assertEqual(c.status, constants.CODE_OK)
+                self.assertEqual(data, test_data[start:start + length],
+                                 "El contenido del slice (%d, %d) no es el "
+                                 "correcto" % (start, length))
+        c.close()
+
     def test_big_filename(self):
         c = self.new_client()
         c.send('get_metadata ' + 'x' * (5 * 2 ** 20), timeout=120)
@@ -298,12 +396,263 @@ class TestHFTPHard(TestBase):
         f.close()
         c.close()
 
+    def test_slice_after_replace(self):
+        pathname = os.path.join(DATADIR, 'bar')
+        with open(pathname, 'w') as f:
+            f.write('a' * 300)
+        c = self.new_client()
+        data = bytearray()
+        c.get_slice('bar', 0, 300, data)
+        self.assertEqual(data, b'a' * 300)
+        # Se reemplaza el archivo por otro con el mismo nombre
+        with open(pathname + '.new', 'w') as f:
+            f.write('b' * 300)
+        os.replace(pathname + '.new', pathname)
+        # El server se entera de los cambios con un poco de demora
+        start = time.time()
+        data = bytearray()
+        c.get_slice('bar', 0, 300, data)
+        while data != b'b' * 300 and time.time() - start <= TIMEOUT:
+            time.sleep(0.1)
+            data = bytearray()
+            c.get_slice('bar', 0, 300, data)
+        self.assertEqual(data, b'b' * 300,
+                         "Se siguió mandando el contenido del archivo viejo")
+        c.close()
+
+    def test_slice_to_buffer_and_callback(self):
+        test_data = os.urandom(200000)
+        f = open(os.path.join(DATADIR, 'bar'), 'wb')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        buffer = bytearray(100000)
+        c.get_slice('bar', 50000, 100000, buffer)
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(buffer, test_data[50000:150000],
+                         "El contenido del buffer no es el correcto")
+        pieces = []
+        c.get_slice('bar', 0, len(test_data), pieces.append)
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(b''.join(pieces), test_data,
+                         "Los datos pasados a la función no son los correctos")
+        self.assertFalse(os.path.exists('bar'),
+                         "Se creó un archivo local teniendo un destino")
+        c.close()
+
+    def test_parallel_retrieve(self):
+        self.output_file = 'bar'
+        test_data = os.urandom(1000001)
+        f = open(os.path.join(DATADIR, self.output_file), 'wb')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        c.retrieve(self.output_file, connections=4)
+        self.assertEqual(c.status, constants.CODE_OK)
+        f = open(self.output_file, 'rb')
+        self.assertEqual(f.read(), test_data,
+                         "El contenido del archivo no es el correcto")
+        f.close()
+        c.close()
+
+    def test_parallel_retrieve_many_connections(self):
+        # Más conexiones que hilos del server: las que no entran no pueden
+        # dejar colgada la descarga
+        self.output_file = 'bar'
+        test_data = os.urandom(1000001)
+        f = open(os.path.join(DATADIR, self.output_file), 'wb')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        t = threading.Thread(target=c.retrieve, args=(self.output_file,),
+                             kwargs={'connections': constants.MAX_THREADS + 2},
+                             daemon=True)
+        t.start()
+        t.join(30)
+        self.assertFalse(t.is_alive(), "La descarga no terminó")
+        self.assertEqual(c.status, constants.CODE_OK)
+        f = open(self.output_file, 'rb')
+        self.assertEqual(f.read(), test_data,
+                         "El contenido del archivo no es el correcto")
+        f.close()
+        c.close()
+
+    def test_resume_retrieve(self):
+        self.output_file = 'bar'
+        test_data = os.urandom(300000)
+        f = open(os.path.join(DATADIR, self.output_file), 'wb')
+        f.write(test_data)
+        f.close()
+        # Una descarga anterior que quedó a medias: el journal dice que ya
+        # están los primeros 100000 bytes. Se los deja distintos de los del
+        # server para comprobar que no se vuelven a pedir.
+        f = open(self.output_file, 'wb')
+        f.write(b'x' * len(test_data))
+        f.close()
+        journal = self.output_file + constants.JOURNAL_SUFFIX
+        mtime = os.stat(os.path.join(DATADIR, self.output_file)).st_mtime_ns
+        f = open(journal, 'w')
+        f.write('%d %d\n0 100000\n' % (len(test_data), mtime))
+        f.close()
+        c = self.new_client()
+        c.retrieve(self.output_file)
+        self.assertEqual(c.status, constants.CODE_OK)
+        f = open(self.output_file, 'rb')
+        self.assertEqual(f.read(), b'x' * 100000 + test_data[100000:],
+                         "Se volvió a bajar un rango que ya estaba")
+        f.close()
+        self.assertFalse(os.path.exists(journal),
+                         "No se borró el journal al terminar la descarga")
+        # Si el archivo cambió en el server (aunque tenga el mismo tamaño),
+        # el journal no sirve y se baja todo de nuevo
+        f = open(self.output_file, 'wb')
+        f.write(b'x' * len(test_data))
+        f.close()
+        f = open(journal, 'w')
+        f.write('%d %d\n0 100000\n' % (len(test_data), mtime - 1))
+        f.close()
+        c.retrieve(self.output_file)
+        self.assertEqual(c.status, constants.CODE_OK)
+        f = open(self.output_file, 'rb')
+        self.assertEqual(f.read(), test_data,
+                         "Se mezclaron datos de otra versión del archivo")
+        f.close()
+        self.assertFalse(os.path.exists(journal))
+        c.close()
+
+    def test_retrieve_without_get_stat(self):
+        self.output_file = 'bar'
+        test_data = os.urandom(300000)
+        f = open(os.path.join(DATADIR, self.output_file), 'wb')
+        f.write(test_data)
+        f.close()
+        f = open(self.output_file, 'wb')
+        f.write(b'x' * len(test_data))
+        f.close()
+        journal = self.output_file + constants.JOURNAL_SUFFIX
+        f = open(journal, 'w')
+        f.write('%d\n0 100000\n' % len(test_data))
+        f.close()
+        c = self.new_client()
+
+        # Como un server que no tiene get_stat
+        def get_stat(filename):
+            c.send('no_such_command %s' % filename)
+            c.status, message = c.read_response_line()
+        c.get_stat = get_stat
+        c.retrieve(self.output_file)
+        self.assertEqual(c.status, constants.CODE_OK)
+        f = open(self.output_file, 'rb')
+        self.assertEqual(f.read(), b'x' * 100000 + test_data[100000:],
+                         "No se retomó la descarga usando solo el tamaño")
+        f.close()
+        self.assertFalse(os.path.exists(journal))
+        c.close()
+
+    def test_get_slice_raw(self):
+        self.output_file = 'bar'
+        test_data = bytes(range(256)) * (2 ** 12) + b'\r\n' * 10
+        f = open(os.path.join(DATADIR, self.output_file), 'wb')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        c.get_slice_raw(self.output_file, 10, len(test_data) - 20)
+        self.assertEqual(c.status, constants.CODE_OK)
+        f = open(self.output_file, 'rb')
+        self.assertEqual(f.read(), test_data[10:-10],
+                         "El contenido del archivo no es el correcto")
+        f.close()
+        # La conexión sigue andando después de los datos binarios
+        self.assertEqual(c.get_metadata(self.output_file), len(test_data))
+        # Un trozo vacío
+        c.get_slice_raw(self.output_file, 10, 0)
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(os.path.getsize(self.output_file), 0)
+        self.assertEqual(c.get_metadata(self.output_file), len(test_data))
+        c.close()
+
+    def test_async_client(self):
+        # Varias descargas a la vez con el cliente de asyncio
+        filenames = ['file%d' % i for i in range(20)]
+        for i, filename in enumerate(filenames):
+            f = open(os.path.join(DATADIR, filename), 'wb')
+            f.write(bytes([i]) * (1000 * i))
+            f.close()
+
+        async def download(filename):
+            c = await client.AsyncClient.connect()
+            await c.retrieve(filename)
+            self.assertEqual(c.status, constants.CODE_OK)
+            await c.close()
+
+        async def download_all():
+            await asyncio.gather(*map(download, filenames))
+
+        try:
+            asyncio.run(download_all())
+            for i, filename in enumerate(filenames):
+                f = open(filename, 'rb')
+                self.assertEqual(f.read(), bytes([i]) * (1000 * i),
+                                 "El contenido del archivo no es el correcto")
+                f.close()
+        finally:
+            for filename in filenames:
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+    def test_async_client_batch(self):
+        # Los comandos que mandan varios pedidos juntos, con asyncio
+        contents = {'file%d' % i: os.urandom(1000 * i + 1) for i in range(5)}
+        for filename, data in contents.items():
+            f = open(os.path.join(DATADIR, filename), 'wb')
+            f.write(data)
+            f.close()
+        filenames = sorted(contents)
+
+        async def run():
+            c = await client.AsyncClient.connect()
+            self.assertEqual(await c.file_lookup(page_size=2), filenames)
+            self.assertEqual(await c.get_metadata_batch(filenames),
+                             [len(contents[name]) for name in filenames])
+            ranges = [(0, 10), (100, 900), (4000, 1)]
+            outputs = [bytearray() for _ in ranges]
+            await c.get_slice_batch('file4', ranges, outputs)
+            self.assertEqual(c.status, constants.CODE_OK)
+            self.assertEqual([bytes(output) for output in outputs],
+                             [contents['file4'][start:start + length]
+                              for start, length in ranges])
+            digests = await c.get_checksum_batch('file4', ranges)
+            self.assertEqual(digests,
+                             [hashlib.sha256(contents['file4'][
+                                 start:start + length]).hexdigest()
+                              for start, length in ranges])
+            size, _, digest, blocks = await c.get_signatures('file4')
+            self.assertEqual(size, len(contents['file4']))
+            self.assertEqual(digest,
+                             hashlib.sha256(contents['file4']).hexdigest())
+            self.assertEqual(len(blocks), 1)
+            self.assertEqual(await c.retrieve_many(['file*']), filenames)
+            self.assertEqual(c.status, constants.CODE_OK)
+            await c.close()
+
+        try:
+            asyncio.run(run())
+            for filename, data in contents.items():
+                f = open(filename, 'rb')
+                self.assertEqual(f.read(), data,
+                                 "El contenido del archivo no es el correcto")
+                f.close()
+        finally:
+            for filename in contents:
+                if os.path.exists(filename):
+                    os.remove(filename)
+
     def test_long_file_listing(self):
         # Preparar el directorio de datos
         correct_list = []
         for i in range(1000):
             filename = 'test_file%04d' % i
-            f = open(os.path.join(DATADIR, filename), 'w').close()
+            open(os.path.join(DATADIR, filename), 'w').close()
             correct_list.append(filename)
         c = self.new_client()
         files = sorted(c.file_lookup())
@@ -312,6 +661,289 @@ class TestHFTPHard(TestBase):
                          "La lista de 1000 archivos no es la correcta")
         c.close()
 
+    def test_paged_file_listing(self):
+        correct_list = []
+        for i in range(1000):
+            filename = 'test_file%04d' % i
+            open(os.path.join(DATADIR, filename), 'w').close()
+            correct_list.append(filename)
+        c = self.new_client()
+        page = c.file_lookup_page(990, 100)
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(page, correct_list[990:],
+                         "La última página del listado no es la correcta")
+        files = c.file_lookup(page_size=300)
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(files, correct_list,
+                         "El listado pedido de a páginas no es el correcto")
+        c.close()
+
+    def test_file_listing_after_change(self):
+        for filename in ['bar', 'foo']:
+            open(os.path.join(DATADIR, filename), 'w').close()
+        c = self.new_client()
+        self.assertEqual(sorted(c.file_lookup()), ['bar', 'foo'])
+        os.remove(os.path.join(DATADIR, 'bar'))
+        open(os.path.join(DATADIR, 'x'), 'w').close()
+        # El server se entera de los cambios con un poco de demora
+        start = time.time()
+        files = sorted(c.file_lookup())
+        while files != ['foo', 'x'] and time.time() - start <= TIMEOUT:
+            time.sleep(0.1)
+            files = sorted(c.file_lookup())
+        self.assertEqual(files, ['foo', 'x'],
+                         "El listado no cambió al cambiar los archivos")
+        c.close()
+
+    def test_client_pool(self):
+        with open(os.path.join(DATADIR, 'foo'), 'w') as f:
+            f.write('x' * 100)
+        pool = client.ClientPool(max_size=2)
+        try:
+            with pool.connection() as c1:
+                self.assertEqual(c1.get_metadata('foo'), 100)
+            # La conexión se reutiliza
+            with pool.connection() as c2:
+                self.assertIs(c2, c1)
+                self.assertEqual(c2.get_metadata('foo'), 100)
+                # El server cierra la conexión sin que el cliente se entere
+                c2.send('quit')
+                self.assertEqual(c2.read_response_line()[0],
+                                 constants.CODE_OK)
+            # Y run reintenta con otra
+            self.assertEqual(pool.run(client.Client.get_metadata, 'foo'), 100)
+            with pool.connection() as c3:
+                self.assertIsNot(c3, c1)
+            # Hay a lo sumo 2 conexiones abiertas
+            a = pool.acquire()
+            b = pool.acquire()
+            self.assertRaises(TimeoutError, pool.acquire, 0.1)
+            pool.release(a)
+            self.assertIs(pool.acquire(0.1), a)
+            pool.release(a)
+            pool.release(b)
+        finally:
+            pool.close()
+        # Con check_interval=0 cada conexión reutilizada se revisa con un
+        # pedido, y la compresión no le queda al siguiente que la usa
+        pool = client.ClientPool(max_size=1, check_interval=0)
+        try:
+            with pool.connection() as c1:
+                self.assertTrue(c1.set_compression('zlib'))
+            with pool.connection() as c2:
+                self.assertIs(c2, c1)
+                self.assertIsNone(c2.codec)
+                self.assertEqual(c2.get_metadata('foo'), 100)
+        finally:
+            pool.close()
+
+    def test_compressed_slice(self):
+        text = b''.join(b'linea %d del log\r\n' % i for i in range(50000))
+        test_data = text + os.urandom(100000)
+        f = open(os.path.join(DATADIR, 'foo'), 'wb')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        self.assertTrue(c.set_compression('zlib'))
+        for start, length in [(0, len(test_data)), (1, 200000),
+                              (len(text) - 1000, 5000), (7, 10), (0, 0)]:
+            output = bytearray(length)
+            c.get_slice('foo', start, length, output)
+            self.assertEqual(c.status, constants.CODE_OK)
+            self.assertEqual(output, test_data[start:start + length],
+                             "El trozo comprimido no es el correcto")
+        self.assertTrue(c.set_compression('none'))
+        output = bytearray(100)
+        c.get_slice('foo', 0, 100, output)
+        self.assertEqual(output, test_data[:100])
+        c.send('set_compression foo')
+        self.assertEqual(c.read_response_line()[0],
+                         constants.INVALID_ARGUMENTS)
+        c.close()
+
+    def test_checksum(self):
+        test_data = os.urandom(5 * 2 ** 19 + 1234)
+        f = open(os.path.join(DATADIR, 'foo'), 'wb')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        self.assertEqual(c.get_checksum('foo'),
+                         hashlib.sha256(test_data).hexdigest())
+        for start, length in [(2 ** 20, 2 ** 20), (2 ** 21, 2 ** 19 + 1234),
+                              (7, 100000), (0, 0)]:
+            self.assertEqual(
+                c.get_checksum('foo', start, length),
+                hashlib.sha256(test_data[start:start + length]).hexdigest(),
+                "El hash del trozo no es el correcto")
+        c.get_checksum('foo', len(test_data), 1)
+        self.assertEqual(c.status, constants.BAD_OFFSET)
+        c.get_checksum('bar')
+        self.assertEqual(c.status, constants.FILE_NOT_FOUND)
+        # Si el archivo cambia, cambia el hash
+        test_data = b'x' * 100
+        f = open(os.path.join(DATADIR, 'foo'), 'wb')
+        f.write(test_data)
+        f.close()
+        start = time.time()
+        digest = c.get_checksum('foo')
+        while (digest != hashlib.sha256(test_data).hexdigest()
+               and time.time() - start <= TIMEOUT):
+            time.sleep(0.1)
+            digest = c.get_checksum('foo')
+        self.assertEqual(digest, hashlib.sha256(test_data).hexdigest(),
+                         "El hash no cambió al cambiar el archivo")
+        c.close()
+
+    def test_checksum_does_not_block(self):
+        # Mientras se calculan los hashes de un archivo grande, el server
+        # sigue atendiendo a las demás conexiones
+        block = os.urandom(2 ** 20)
+        for filename in ['big', 'big2']:
+            f = open(os.path.join(DATADIR, filename), 'wb')
+            for _ in range(64):
+                f.write(block)
+            f.close()
+        with open(os.path.join(DATADIR, 'small'), 'w') as f:
+            f.write('x')
+        c = self.new_client()
+        other = client.Client()
+        try:
+            c.send('get_checksum big')
+            self.assertEqual(other.get_metadata('small'), 1)
+            readable, _, _ = select.select([c.s], [], [], 0)
+            self.assertEqual(readable, [],
+                             "El get_checksum frenó a la otra conexión")
+            self.assertEqual(c.read_response_line()[0], constants.CODE_OK)
+            self.assertEqual(c.read_line(),
+                             hashlib.sha256(block * 64).hexdigest())
+            # Lo mismo con get_signatures
+            c.send('get_signatures big2')
+            self.assertEqual(other.get_metadata('small'), 1)
+            readable, _, _ = select.select([c.s], [], [], 0)
+            self.assertEqual(readable, [],
+                             "El get_signatures frenó a la otra conexión")
+            self.assertEqual(c.read_response_line()[0], constants.CODE_OK)
+            self.assertEqual(c.read_line().split()[2],
+                             hashlib.sha256(block * 64).hexdigest())
+            line = c.read_line()
+            while line:
+                line = c.read_line()
+            other.close()
+        finally:
+            other.s.close()
+        c.close()
+
+    def test_retrieve_verify(self):
+        self.output_file = 'foo'
+        test_data = os.urandom(3 * 2 ** 20 + 10)
+        f = open(os.path.join(DATADIR, self.output_file), 'wb')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        c.retrieve(self.output_file, verify=True)
+        self.assertEqual(c.status, constants.CODE_OK)
+        # Se rompe un bloque de la copia local
+        f = open(self.output_file, 'r+b')
+        f.seek(2 ** 20 + 5)
+        f.write(b'roto')
+        f.close()
+        fixed = c.verify(self.output_file, len(test_data))
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(fixed, [(2 ** 20, 2 ** 20)],
+                         "No se volvió a bajar solo el bloque roto")
+        f = open(self.output_file, 'rb')
+        self.assertEqual(f.read(), test_data,
+                         "El contenido del archivo no es el correcto")
+        f.close()
+        c.close()
+
+    def test_sync(self):
+        self.output_file = 'foo'
+        old_data = os.urandom(5 * 2 ** 20)
+        f = open(self.output_file, 'wb')
+        f.write(old_data)
+        f.close()
+        # Se cambia un bloque, y se inserta y se borra un poco en otros
+        test_data = (old_data[:2 ** 20 + 10] + b'nuevo' * 10
+                     + old_data[2 ** 20 + 10:3 * 2 ** 20 - 100]
+                     + old_data[3 * 2 ** 20:])
+        f = open(os.path.join(DATADIR, self.output_file), 'wb')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        fetched = c.sync(self.output_file)
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertLess(fetched, len(test_data) // 2,
+                        "Se bajó casi todo el archivo")
+        f = open(self.output_file, 'rb')
+        self.assertEqual(f.read(), test_data,
+                         "El contenido del archivo no es el correcto")
+        f.close()
+        # Modificado en el lugar y agrandado
+        test_data = test_data[:100] + b'x' * 100 + test_data[200:] + b'fin'
+        f = open(os.path.join(DATADIR, self.output_file), 'wb')
+        f.write(test_data)
+        f.close()
+        start = time.time()
+        fetched = c.sync(self.output_file)
+        while (c.status == constants.CODE_OK and fetched == 0
+               and time.time() - start <= TIMEOUT):
+            time.sleep(0.1)
+            fetched = c.sync(self.output_file)
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertLessEqual(fetched, 2 * 2 ** 20)
+        f = open(self.output_file, 'rb')
+        self.assertEqual(f.read(), test_data,
+                         "El contenido del archivo no es el correcto")
+        f.close()
+        c.close()
+
+    def test_retrieve_many(self):
+        # Varios archivos, con nombres y patrones, en un solo pedido
+        contents = {'log%d' % i: os.urandom(1000 * i) for i in range(5)}
+        contents['other'] = b'x' * 3 * 2 ** 20
+        for filename, data in contents.items():
+            f = open(os.path.join(DATADIR, filename), 'wb')
+            f.write(data)
+            f.close()
+        c = self.new_client()
+        try:
+            received = c.retrieve_many(['other', 'log[0-3]', 'log*'])
+            self.assertEqual(c.status, constants.CODE_OK)
+            self.assertEqual(received,
+                             ['other', 'log0', 'log1', 'log2', 'log3',
+                              'log4'])
+            for filename, data in contents.items():
+                f = open(filename, 'rb')
+                self.assertEqual(f.read(), data,
+                                 "El contenido del archivo no es el correcto")
+                f.close()
+            # Comprimidos
+            os.remove('other')
+            c.set_compression()
+            self.assertEqual(c.retrieve_many(['oth*']), ['other'])
+            self.assertEqual(c.status, constants.CODE_OK)
+            f = open('other', 'rb')
+            self.assertEqual(f.read(), contents['other'])
+            f.close()
+            # Si falta algún archivo no se manda ninguno
+            self.assertEqual(c.retrieve_many(['log1', 'missing']), [])
+            self.assertEqual(c.status, constants.FILE_NOT_FOUND)
+            self.assertEqual(c.retrieve_many(['nada*']), [])
+            self.assertEqual(c.status, constants.CODE_OK)
+            # Los patrones no incluyen los subdirectorios
+            os.mkdir(os.path.join(DATADIR, 'logdir'))
+            self.assertEqual(c.retrieve_many(['log*']),
+                             ['log0', 'log1', 'log2', 'log3', 'log4'])
+            self.assertEqual(c.status, constants.CODE_OK)
+            self.assertEqual(c.retrieve_many(['logdir']), [])
+            self.assertEqual(c.status, constants.FILE_NOT_FOUND)
+            c.close()
+        finally:
+            for filename in contents:
+                if os.path.exists(filename):
+                    os.remove(filename)
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -6,12 +6,27 @@
 # Copyright 2008-2010 Natalia Bidart y Daniel Moisset
 # $Id: server.py 656 2013-03-18 23:49:11Z bc $
 
+import asyncio
+import heapq
+import itertools
 import optparse
 import os
+import selectors
+import signal
 import socket
 import connection
+import metrics
+from admission import AdmissionController, ADMIT, QUEUE, REJECT
+from pool import WorkerPool
+from ratelimit import TokenBucket
+from checksum import HashIndex
+from cache import (MetadataCache, DirectoryListing, OpenFiles, MappedFiles,
+                   ChunkCache)
+from watcher import DirectoryWatcher
 import sys
-import threading
+import time
+import traceback
+from collections import deque
 from constants import *
 
 
@@ -19,10 +34,28 @@ class Server(object):
     """
     El servidor, que crea y atiende el socket en la dirección y puerto
     especificados donde se reciben nuevas conexiones de clientes.
+
+    Las conexiones las atienden los hilos de un WorkerPool, de entre
+    'min_threads' y 'threads' hilos.
+
+    Las conexiones nuevas pasan por un AdmissionController: se atienden a
+    lo sumo 'max_active' a la vez (por defecto, una por hilo en este modo y
+    sin límite en los otros), y las demás esperan en una cola o se las
+    rechaza con SERVER_BUSY.
+
+    Si se da 'metrics_port', publica las métricas del server por HTTP en
+    ese puerto (ver metrics).
     """
 
     def __init__(self, addr=DEFAULT_ADDR, port=DEFAULT_PORT,
-                 directory=DEFAULT_DIR):
+                 directory=DEFAULT_DIR, chunk_size=CHUNK_SIZE,
+                 chunk_cache=CHUNK_CACHE_SIZE, use_mmap=False,
+                 backlog=LISTEN_BACKLOG, max_active=None,
+                 max_pending=MAX_PENDING, max_per_client=0,
+                 threads=MAX_THREADS, min_threads=MIN_THREADS,
+                 idle_timeout=THREAD_IDLE_TIMEOUT, rate=0, client_rate=0,
+                 metrics_port=METRICS_PORT, metrics_addr=METRICS_ADDR,
+                 compress_min=COMPRESS_MIN, checksum_dir=None):
         print(f"Serving {directory} on {addr}:{port}.")
         # FALTA: Crear socket del servidor, configurarlo, asignarlo
         # a una dirección y puerto, etc.
@@ -32,47 +65,663 @@ class Server(object):
             os.mkdir(directory)
 
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Para poder volver a levantar el server enseguida en el mismo puerto
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((addr, port))
 
         self.socket = s
         self.directory = directory
+        self.chunk_size = chunk_size
+
+        # Estado compartido por todas las conexiones. El watcher avisa de
+        # los cambios en el directorio para invalidar los caches.
+        self.watcher = DirectoryWatcher(directory)
+        self.metadata = MetadataCache(directory, self.watcher)
+        self.listing = DirectoryListing(directory, self.watcher)
+        self.files = OpenFiles(directory, self.watcher)
+        # Trozos ya codificados en base64 (opcional)
+        self.chunks = ChunkCache(chunk_cache) if chunk_cache > 0 else None
+        # Archivos mapeados en memoria (opcional)
+        self.maps = MappedFiles(directory, self.watcher) if use_mmap else None
+        # Hashes de los archivos para get_checksum, guardados en disco si
+        # se da 'checksum_dir'
+        self.hashes = HashIndex(directory, self.watcher,
+                                index_dir=checksum_dir)
+
+        self.pool = WorkerPool(min(min_threads, threads), threads,
+                               idle_timeout)
+        # Límites de velocidad (en bytes por segundo) de todo lo que manda
+        # el server y de cada conexión (0 para no limitar)
+        self.rate_limit = TokenBucket(rate) if rate > 0 else None
+        self.client_rate = client_rate
+        self.backlog = backlog
+        if max_active is None:
+            max_active = self.default_max_active()
+        self.admission = AdmissionController(max_active, max_pending,
+                                             max_per_client)
+        self.metrics_port = metrics_port
+        self.metrics_addr = metrics_addr
+        self.compress_min = compress_min
+        # Si se pidió terminar (ver stop)
+        self.stopping = False
+
+    def default_max_active(self) -> int:
+        """
+        Cantidad máxima de conexiones atendidas a la vez, si no se da otra
+        (0 para no limitar).
+        """
+        return self.pool.max_threads
+
+    def new_connection(self, connection_class, *args):
+        """
+        Crea una conexión de la clase dada (con los argumentos propios de
+        la clase), que comparte el estado del server.
+        """
+        return connection_class(*args, self.directory,
+                                chunk_size=self.chunk_size,
+                                metadata=self.metadata,
+                                listing=self.listing,
+                                files=self.files, chunks=self.chunks,
+                                maps=self.maps,
+                                limiters=self.new_limiters(),
+                                compress_min=self.compress_min,
+                                hashes=self.hashes)
+
+    def new_limiters(self) -> list:
+        """
+        Limitadores de velocidad para una conexión nueva: el de todo el
+        server y uno propio de la conexión.
+        """
+        limiters = []
+        if self.rate_limit is not None:
+            limiters.append(self.rate_limit)
+        if self.client_rate > 0:
+            limiters.append(TokenBucket(self.client_rate))
+        return limiters
+
+    def start_metrics(self):
+        """
+        Empieza a publicar las métricas, si se pidió. Se tiene que llamar
+        en el proceso que atiende a los clientes.
+        """
+        if self.metrics_port == 0:
+            return
+        self.register_metrics()
+        metrics.start_http_server(self.metrics_port, self.metrics_addr)
+        print(f"Metrics on {self.metrics_addr}:{self.metrics_port}.")
+
+    def register_metrics(self):
+        """
+        Agrega a las métricas el estado del control de admisión, del pool
+        de hilos y del cache de trozos. Se calculan recién al publicarlas.
+        """
+        admission = self.admission.stats
+        for name, key, help in [
+                ('active', 'active', "Conexiones que se están atendiendo"),
+                ('pending', 'pending', "Conexiones esperando lugar"),
+                ('pending_max_wait_seconds', 'max_wait',
+                 "Máximo tiempo que esperó lugar una conexión (en "
+                 "segundos)"),
+                ('pending_average_wait_seconds', 'average_wait',
+                 "Tiempo promedio que esperaron lugar las conexiones "
+                 "encoladas (en segundos)")]:
+            metrics.REGISTRY.register(metrics.Sampled(
+                f'hftp_connections_{name}', help,
+                lambda key=key: admission()[key]))
+        for name, help in [
+                ('admitted', "Conexiones que se empezaron a atender"),
+                ('queued', "Conexiones que tuvieron que esperar lugar"),
+                ('rejected', "Conexiones rechazadas con SERVER BUSY")]:
+            metrics.REGISTRY.register(metrics.Sampled(
+                f'hftp_connections_{name}_total', help,
+                lambda name=name: admission()[name], metrics.COUNTER))
+        metrics.REGISTRY.register(metrics.Sampled(
+            'hftp_connections_max_active',
+            "Máximo de conexiones atendidas a la vez (0 si no hay límite)",
+            lambda: self.admission.max_active))
+
+        self.register_pool_metrics()
+
+        if self.chunks is not None:
+            chunks = self.chunks.stats
+            for name, help, type in [
+                    ('hits_total', "Trozos encontrados en el cache",
+                     metrics.COUNTER),
+                    ('misses_total', "Trozos que no estaban en el cache",
+                     metrics.COUNTER),
+                    ('entries', "Trozos guardados", metrics.GAUGE),
+                    ('bytes', "Bytes guardados", metrics.GAUGE)]:
+                key = name.removesuffix('_total')
+                metrics.REGISTRY.register(metrics.Sampled(
+                    f'hftp_chunk_cache_{name}', help,
+                    lambda key=key: chunks()[key], type))
 
-        # Semaforo para limitar la cantidad de hilos
-        # Cada ves que se crea un hilo, el nuevo hilo adquire el semaforo
-        # y cuando termina, lo libera
-        # Idea sacada de
-        # https://stackoverflow.com/questions/1787397/how-do-i-limit-the-number-of-active-threads-in-python/5991741#5991741
-        self.threadLimiter = threading.BoundedSemaphore(MAX_THREADS)
+    def register_pool_metrics(self):
+        pool = self.pool.stats
+        for name, help in [
+                ('threads', "Hilos del pool"),
+                ('idle', "Hilos del pool sin conexión para atender"),
+                ('queued', "Conexiones admitidas esperando un hilo libre "
+                 "(las que esperan lugar están en hftp_connections_pending)"),
+                ('max_wait', "Máximo tiempo que esperó una conexión "
+                 "admitida un hilo libre (en segundos)"),
+                ('average_wait', "Tiempo promedio que esperaron las "
+                 "conexiones admitidas un hilo libre (en segundos)")]:
+            metrics.REGISTRY.register(metrics.Sampled(
+                f'hftp_pool_{name}', help, lambda name=name: pool()[name]))
+        metrics.REGISTRY.register(metrics.Sampled(
+            'hftp_pool_completed_total', "Conexiones atendidas por el pool",
+            lambda: pool()['completed'], metrics.COUNTER))
+        metrics.REGISTRY.register(metrics.Sampled(
+            'hftp_pool_max_threads', "Máximo de hilos del pool",
+            lambda: self.pool.max_threads))
 
+        def saturation():
+            stats = pool()
+            return (stats['threads'] - stats['idle']) / self.pool.max_threads
+        metrics.REGISTRY.register(metrics.Sampled(
+            'hftp_pool_saturation',
+            "Fracción de los hilos posibles que están ocupados", saturation))
+
+    def reject(self, conn_socket: socket.socket):
+        """
+        Le contesta SERVER_BUSY a la conexión, sin esperar a que el socket
+        tenga lugar, y la cierra.
+        """
+        response = connection.mk_code(SERVER_BUSY) + EOL
+        try:
+            conn_socket.setblocking(False)
+            conn_socket.send(response.encode("ascii"))
+            # Si se cierra con datos sin leer se manda un RST, y el cliente
+            # puede perder la respuesta
+            conn_socket.recv(RECV_SIZE)
+        except OSError:
+            pass
+        conn_socket.close()
+        print("Server busy, connection rejected")
 
     def serve(self):
         """
-        Loop principal del servidor. Se acepta una conexión a la vez
-        y se espera a que concluya antes de seguir.
+        Loop principal del servidor. Acepta conexiones y, según lo que
+        decida el control de admisión, se las pasa al pool de hilos, las
+        deja esperando o las rechaza. El loop nunca se bloquea esperando
+        que termine otra conexión.
         """
-        self.socket.listen()
+        self.watcher.start()
+        self.pool.start()
+        self.start_metrics()
+        self.socket.listen(self.backlog)
 
-        while True:
-            # Aceptar una conexión al server, crear una Connection para la
-            # conexión y atenderla hasta que termine.
-            
-            conn_socket, _ = self.socket.accept()
-            conn = connection.Connection(conn_socket, self.directory)
-            self.handle(conn)
-    
-    def handle(self, conn: connection):
-        """
-        Función que para manejar un cliente.
-        """
-        self.threadLimiter.acquire()
-        def handler():
+        try:
+            while True:
+                conn_socket, (host, _) = self.socket.accept()
+                decision = self.admission.admit((conn_socket, host), host)
+                if decision == ADMIT:
+                    self.handle(conn_socket, host)
+                elif decision == REJECT:
+                    self.reject(conn_socket)
+                # Si quedó en espera, la atiende un hilo cuando se libere
+        except KeyboardInterrupt:
+            if not self.stopping:
+                raise
+        self.socket.close()
+        deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+        while self.active() > 0 and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+    def stop(self):
+        """
+        Pide que el server termine: deja de aceptar conexiones, y serve
+        vuelve cuando terminan las que está atendiendo (incluidas las que
+        esperaban lugar), o a los WORKER_SHUTDOWN_TIMEOUT segundos. Se
+        llama desde el manejador de SIGTERM de los hijos (ver
+        serve_workers).
+
+        En este modo interrumpe el accept del hilo principal con
+        KeyboardInterrupt; las conexiones siguen en los hilos del pool.
+        """
+        if self.stopping:
+            return
+        self.stopping = True
+        raise KeyboardInterrupt
+
+    def active(self) -> int:
+        """
+        Cantidad de conexiones que se están atendiendo o esperan lugar.
+        """
+        stats = self.admission.stats()
+        return stats['active'] + stats['pending']
+
+    def serve_workers(self, workers: int):
+        """
+        Lanza 'workers' procesos hijos que atienden (con serve) el socket
+        del server, que heredan ya escuchando. Así el trabajo de CPU (como
+        codificar en base64) se reparte entre todos los núcleos.
+
+        Si un hijo muere se lanza otro en su lugar. Si muere enseguida de
+        arrancar (por ejemplo, porque el puerto de sus métricas está en
+        uso), el siguiente se lanza después de una espera que se duplica
+        con cada muerte seguida, para no quedar lanzando hijos sin parar.
+        Con SIGINT o SIGTERM se les pide a todos que terminen y se espera a
+        que lo hagan.
+
+        Cada hijo publica sus métricas en su propio puerto: el número de
+        hijo (de 0 a workers - 1) más 'metrics_port'.
+        """
+        self.socket.listen(self.backlog)
+
+        # Número de hijo de cada proceso
+        children = {}
+        stopping = False
+        # Para cada número de hijo, cuándo arrancó el último y cuánto se
+        # esperó antes de lanzarlo
+        started = {}
+        delays = {}
+        # Hijos que hay que volver a lanzar: pares (momento, número de
+        # hijo), ordenados con heapq
+        restarts = []
+
+        def stop_child(signum, frame):
+            self.stop()
+
+        def spawn(index: int):
+            pid = os.fork()
+            if pid == 0:
+                if self.metrics_port != 0:
+                    self.metrics_port += index
+                # Hijo: al recibir SIGTERM deja de aceptar conexiones y
+                # termina cuando terminan las que está atendiendo (ver
+                # stop).
+                signal.signal(signal.SIGTERM, stop_child)
+                signal.signal(signal.SIGINT, stop_child)
+                status = 0
+                try:
+                    self.serve()
+                except KeyboardInterrupt:
+                    pass
+                except BaseException:
+                    print(traceback.format_exc())
+                    status = 1
+                finally:
+                    self.socket.close()
+                # Nunca se vuelve al código del padre
+                os._exit(status)
+            children[pid] = index
+            started[index] = time.monotonic()
+            print(f"Worker {pid} started")
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+            for pid in children:
+                os.kill(pid, signal.SIGTERM)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        for index in range(workers):
+            spawn(index)
+
+        while children or (restarts and not stopping):
+            now = time.monotonic()
+            while restarts and not stopping and restarts[0][0] <= now:
+                _, index = heapq.heappop(restarts)
+                spawn(index)
+            timeout = None
+            if restarts and not stopping:
+                timeout = restarts[0][0] - now
+            result = wait_child(timeout)
+            if result is None:
+                continue
+            pid, status = result
+            index = children.pop(pid, None)
+            if stopping or index is None:
+                continue
+            if time.monotonic() - started[index] < WORKER_MIN_UPTIME:
+                delay = min(max(2 * delays.get(index, 0.0),
+                                WORKER_RESTART_DELAY), WORKER_RESTART_MAX)
+            else:
+                delay = 0.0
+            delays[index] = delay
+            print(f"Worker {pid} {describe_exit(status)}, restarting in "
+                  f"{delay:.1f}s")
+            heapq.heappush(restarts, (time.monotonic() + delay, index))
+
+    def handle(self, conn_socket: socket.socket, host: str):
+        """
+        Le pasa la conexión al pool de hilos.
+        """
+        self.pool.submit(self.handle_connections, (conn_socket, host))
+
+    def handle_connections(self, item):
+        """
+        Atiende la conexión hasta que termina, y después sigue con las
+        conexiones en espera que le toquen.
+        """
+        while item is not None:
+            conn_socket, host = item
             try:
+                conn = self.new_connection(connection.Connection,
+                                           conn_socket)
                 conn.handle()
-            finally:
-                self.threadLimiter.release()
-        thread = threading.Thread(target = handler)
-        thread.start()
-        
+            except Exception:
+                print(traceback.format_exc())
+                conn_socket.close()
+            item = self.admission.release(host)
+
+
+class SelectorServer(Server):
+    """
+    Servidor que atiende a todos los clientes desde un solo hilo, con un
+    loop de eventos (selectors, que en Linux usa epoll). Cada conexión es
+    una máquina de estados (connection.SelectorConnection), así que por
+    defecto no hay límite de clientes simultáneos más allá de los file
+    descriptors.
+    """
+
+    def default_max_active(self) -> int:
+        return 0
+
+    def register_pool_metrics(self):
+        # No usa el pool de hilos
+        pass
+
+    def serve(self):
+        """
+        Loop principal del servidor. Espera eventos en el socket del server
+        (nuevas conexiones) y en los de los clientes, y los atiende.
+        """
+        self.watcher.start()
+        self.start_metrics()
+        self.socket.listen(self.backlog)
+        self.socket.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        # Conexiones que se pasaron de la velocidad permitida, sacadas del
+        # selector hasta que puedan volver a mandar: tuplas (momento en que
+        # vuelven, número de orden, conexión, host), ordenadas con heapq
+        self.paused = []
+        self.pause_order = itertools.count()
+        # Conexiones que esperan un Future (ver
+        # connection.QueuedConnection.waiting), también sacadas del
+        # selector. Cuando termina el Future, desde otro hilo se las agrega
+        # a 'ready' y se escribe en 'wakeup' para despertar al loop.
+        self.ready = deque()
+        self.wakeup, wakeup_reader = socket.socketpair()
+        self.wakeup.setblocking(False)
+        wakeup_reader.setblocking(False)
+        self.selector.register(wakeup_reader, selectors.EVENT_READ)
+
+        deadline = None
+        while deadline is None or (self.active() > 0
+                                   and time.monotonic() < deadline):
+            if self.stopping and deadline is None:
+                # Deja de aceptar conexiones y sigue hasta que terminen
+                # las que hay
+                self.selector.unregister(self.socket)
+                self.socket.close()
+                deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+            timeout = None
+            if self.paused:
+                timeout = max(0.0, self.paused[0][0] - time.monotonic())
+            if deadline is not None:
+                remaining = max(0.0, deadline - time.monotonic())
+                timeout = remaining if timeout is None else min(timeout,
+                                                                remaining)
+            for key, mask in self.selector.select(timeout):
+                if key.fileobj is self.socket:
+                    self.accept()
+                elif key.fileobj is wakeup_reader:
+                    drain(wakeup_reader)
+                else:
+                    conn, host = key.data
+                    self.handle(conn, host, mask)
+            self.resume_paused()
+            self.resume_ready()
+
+    def stop(self):
+        # Lo ve el loop de serve, que se despierta con 'wakeup'
+        self.stopping = True
+        if hasattr(self, 'wakeup'):
+            try:
+                self.wakeup.send(b'\0')
+            except BlockingIOError:
+                pass
+
+    def resume_paused(self):
+        """
+        Vuelve a registrar en el selector las conexiones pausadas que ya
+        pueden mandar.
+        """
+        now = time.monotonic()
+        while self.paused and self.paused[0][0] <= now:
+            _, _, conn, host = heapq.heappop(self.paused)
+            self.selector.register(conn.socket, conn.events(), (conn, host))
+
+    def resume_ready(self):
+        """
+        Vuelve a registrar en el selector las conexiones cuyo Future ya
+        terminó.
+        """
+        while self.ready:
+            conn, host = self.ready.popleft()
+            self.selector.register(conn.socket, conn.events(), (conn, host))
+
+    def wake(self, conn: connection.SelectorConnection, host: str):
+        """
+        Avisa al loop que la conexión ya puede seguir. Se llama desde el
+        hilo que completa el Future que esperaba.
+        """
+        self.ready.append((conn, host))
+        try:
+            self.wakeup.send(b'\0')
+        except BlockingIOError:
+            pass  # Ya hay un aviso pendiente
+
+    def accept(self):
+        """
+        Acepta todas las conexiones pendientes y, según lo que decida el
+        control de admisión, las registra en el selector, las deja
+        esperando o las rechaza.
+        """
+        while True:
+            try:
+                conn_socket, (host, _) = self.socket.accept()
+            except BlockingIOError:
+                return
+            decision = self.admission.admit((conn_socket, host), host)
+            if decision == ADMIT:
+                self.register(conn_socket, host)
+            elif decision == REJECT:
+                self.reject(conn_socket)
+
+    def register(self, conn_socket: socket.socket, host: str):
+        conn_socket.setblocking(False)
+        conn = self.new_connection(connection.SelectorConnection,
+                                   conn_socket)
+        self.selector.register(conn_socket, conn.events(), (conn, host))
+
+    def handle(self, conn: connection.SelectorConnection, host: str,
+               mask: int):
+        """
+        Atiende un evento de una conexión y actualiza los eventos que se
+        esperan de ella, cerrándola si terminó.
+        """
+        try:
+            if mask & selectors.EVENT_READ:
+                conn.on_readable()
+            if mask & selectors.EVENT_WRITE:
+                conn.on_writable()
+            events = conn.events()
+            waiting = conn.waiting()
+        except Exception:
+            # Un error a mitad de una respuesta no se le puede informar al
+            # cliente, solo queda cortar la conexión
+            print(traceback.format_exc())
+            events = 0
+            waiting = None
+
+        if events == 0:
+            self.selector.unregister(conn.socket)
+            conn.socket.close()
+            print("Connection closed")
+            item = self.admission.release(host)
+            if item is not None:
+                self.register(*item)
+        elif conn.paused():
+            self.selector.unregister(conn.socket)
+            heapq.heappush(self.paused, (conn.resume_at,
+                                         next(self.pause_order), conn, host))
+        elif waiting is not None:
+            # Si ya terminó, el callback se llama enseguida, desde acá
+            self.selector.unregister(conn.socket)
+            waiting.add_done_callback(lambda _: self.wake(conn, host))
+        elif events != self.selector.get_key(conn.socket).events:
+            self.selector.modify(conn.socket, events, (conn, host))
+
+
+class AsyncServer(Server):
+    """
+    Servidor que atiende a todos los clientes desde un solo hilo, con
+    asyncio. Cada conexión es una corrutina (ver
+    connection.AsyncConnection).
+    """
+
+    def default_max_active(self) -> int:
+        return 0
+
+    def register_pool_metrics(self):
+        # No usa el pool de hilos
+        pass
+
+    def serve(self):
+        asyncio.run(self.serve_async())
+
+    async def serve_async(self):
+        self.watcher.start()
+        self.start_metrics()
+        self.socket.setblocking(False)
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        if self.stopping:
+            self.stopped.set()
+        server = await asyncio.start_server(self.handle_client,
+                                            sock=self.socket,
+                                            backlog=self.backlog)
+        try:
+            await self.stopped.wait()
+        finally:
+            server.close()
+        # Ya no acepta conexiones: espera que terminen las que hay
+        deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+        while self.active() > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+    def stop(self):
+        # Despierta a serve_async, desde el manejador de la señal
+        self.stopping = True
+        if hasattr(self, 'stopped'):
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    async def handle_client(self, reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter):
+        """
+        Corrutina que atiende un cliente hasta que termina la conexión.
+        Si el control de admisión la deja esperando, espera a que la
+        conexión que termine le pase su lugar.
+        """
+        host = writer.get_extra_info('peername')[0]
+        waiter = asyncio.get_running_loop().create_future()
+        decision = self.admission.admit(waiter, host)
+        if decision == REJECT:
+            response = connection.mk_code(SERVER_BUSY) + EOL
+            writer.write(response.encode("ascii"))
+            writer.close()
+            print("Server busy, connection rejected")
+            return
+        if decision == QUEUE:
+            await waiter
+
+        try:
+            conn = self.new_connection(connection.AsyncConnection,
+                                       reader, writer)
+            await conn.handle_async()
+        finally:
+            waiter = self.admission.release(host)
+            if waiter is not None:
+                waiter.set_result(None)
+
+
+SERVER_MODES = {
+    'threads': Server,
+    'select': SelectorServer,
+    'asyncio': AsyncServer,
+}
+
+
+def wait_child(timeout: float = None):
+    """
+    Espera a que termine algún proceso hijo, a lo sumo 'timeout' segundos
+    (None para esperar sin límite). Devuelve el par (pid, estado) de
+    os.wait, o None si no terminó ninguno.
+    """
+    if timeout is None:
+        return os.wait()
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0  # No queda ningún hijo, solo hay que esperar
+        if pid != 0:
+            return pid, status
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(remaining, 0.1))
+
+
+def describe_exit(status: int) -> str:
+    """
+    Describe el estado con el que terminó un proceso (como lo da os.wait).
+    """
+    code = os.waitstatus_to_exitcode(status)
+    if code < 0:
+        try:
+            name = signal.Signals(-code).name
+        except ValueError:
+            name = str(-code)
+        return f"killed by signal {name}"
+    return f"exited with code {code}"
+
+
+def drain(sock: socket.socket):
+    """
+    Descarta todo lo que haya para leer en el socket (no bloqueante).
+    """
+    try:
+        while sock.recv(4096):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def parse_count(parser: optparse.OptionParser, value, name: str) -> int:
+    """
+    Convierte el valor de una opción en un entero no negativo, o termina
+    el programa con un mensaje de error si no es válido.
+    """
+    try:
+        count = int(value)
+        if count < 0:
+            raise ValueError
+    except ValueError:
+        sys.stderr.write(f"{name} invalida: {repr(value)}\n")
+        parser.print_help()
+        sys.exit(1)
+    return count
+
 
 def main():
     """Parsea los argumentos y lanza el server"""
@@ -87,6 +736,84 @@ def main():
     parser.add_option(
         "-d", "--datadir",
         help="Directorio compartido", default=DEFAULT_DIR)
+    parser.add_option(
+        "-c", "--chunk-size",
+        help="Cantidad de bytes que se leen por vez en get_slice "
+        "(múltiplo de 3)", default=CHUNK_SIZE)
+    parser.add_option(
+        "-m", "--mode", type="choice", choices=list(SERVER_MODES.keys()),
+        help="Forma de atender a los clientes: un hilo por conexión "
+        "(threads), un loop de eventos (select) o asyncio",
+        default='threads')
+    parser.add_option(
+        "-w", "--workers",
+        help="Cantidad de procesos que atienden clientes (0 para atender "
+        "desde este mismo proceso)", default=0)
+    parser.add_option(
+        "--chunk-cache",
+        help="Cantidad máxima de bytes de trozos ya codificados en base64 "
+        "que se guardan en memoria, en cada worker (0 para no guardar)",
+        default=CHUNK_CACHE_SIZE)
+    parser.add_option(
+        "--mmap", action="store_true",
+        help="Leer los archivos mapeándolos en memoria. Los archivos no se "
+        "tienen que truncar mientras se sirven (reemplazarlos sí se puede)",
+        default=False)
+    parser.add_option(
+        "--backlog",
+        help="Largo de la cola de conexiones sin aceptar del socket",
+        default=LISTEN_BACKLOG)
+    parser.add_option(
+        "--max-connections",
+        help="Cantidad máxima de conexiones atendidas a la vez, en cada "
+        "worker (0 para no limitar; por defecto %d en el modo threads y sin "
+        "límite en los otros)" % MAX_THREADS, default=None)
+    parser.add_option(
+        "--max-pending",
+        help="Cantidad máxima de conexiones que esperan a ser atendidas; "
+        "las demás se rechazan con SERVER BUSY", default=MAX_PENDING)
+    parser.add_option(
+        "--max-per-client",
+        help="Cantidad máxima de conexiones de una misma dirección IP "
+        "(0 para no limitar)", default=0)
+    parser.add_option(
+        "-t", "--threads",
+        help="Cantidad máxima de hilos que atienden conexiones en el modo "
+        "threads", default=MAX_THREADS)
+    parser.add_option(
+        "--min-threads",
+        help="Cantidad de hilos que se mantienen aunque no haya conexiones",
+        default=MIN_THREADS)
+    parser.add_option(
+        "--thread-idle-timeout",
+        help="Segundos que espera un hilo de más sin conexiones antes de "
+        "terminar", default=THREAD_IDLE_TIMEOUT)
+    parser.add_option(
+        "--rate",
+        help="Cantidad máxima de bytes por segundo que manda el server (en "
+        "cada worker) sumando todas las conexiones (0 para no limitar)",
+        default=0)
+    parser.add_option(
+        "--client-rate",
+        help="Cantidad máxima de bytes por segundo que se le mandan a cada "
+        "conexión (0 para no limitar)", default=0)
+    parser.add_option(
+        "--metrics-port",
+        help="Puerto donde publicar las métricas por HTTP, en el formato de "
+        "Prometheus (0 para no publicarlas). Con varios workers, cada uno "
+        "usa el siguiente", default=METRICS_PORT)
+    parser.add_option(
+        "--metrics-address",
+        help="Dirección donde publicar las métricas", default=METRICS_ADDR)
+    parser.add_option(
+        "--compress-min",
+        help="Tamaño mínimo en bytes de un get_slice para comprimirlo, si "
+        "el cliente pidió compresión", default=COMPRESS_MIN)
+    parser.add_option(
+        "--checksum-dir",
+        help="Directorio donde guardar el índice de hashes de los archivos "
+        "(fuera del directorio compartido), para no volver a calcularlos "
+        "al reiniciar el server", default=None)
 
     options, args = parser.parse_args()
     if len(args) > 0:
@@ -99,9 +826,85 @@ def main():
             f"Numero de puerto invalido: {repr(options.port)}\n")
         parser.print_help()
         sys.exit(1)
+    try:
+        chunk_size = int(options.chunk_size)
+        if chunk_size <= 0 or chunk_size % 3 != 0:
+            raise ValueError
+    except ValueError:
+        sys.stderr.write(
+            f"Tamaño de trozo invalido: {repr(options.chunk_size)}\n")
+        parser.print_help()
+        sys.exit(1)
+
+    try:
+        workers = int(options.workers)
+        if workers < 0:
+            raise ValueError
+    except ValueError:
+        sys.stderr.write(
+            f"Cantidad de workers invalida: {repr(options.workers)}\n")
+        parser.print_help()
+        sys.exit(1)
+
+    try:
+        chunk_cache = int(options.chunk_cache)
+        if chunk_cache < 0:
+            raise ValueError
+    except ValueError:
+        sys.stderr.write(
+            f"Tamaño de cache invalido: {repr(options.chunk_cache)}\n")
+        parser.print_help()
+        sys.exit(1)
+
+    backlog = parse_count(parser, options.backlog,
+                          "Cantidad de conexiones sin aceptar")
+    max_active = None
+    if options.max_connections is not None:
+        max_active = parse_count(parser, options.max_connections,
+                                 "Cantidad de conexiones")
+    max_pending = parse_count(parser, options.max_pending,
+                              "Cantidad de conexiones en espera")
+    max_per_client = parse_count(parser, options.max_per_client,
+                                 "Cantidad de conexiones por cliente")
+
+    threads = parse_count(parser, options.threads, "Cantidad de hilos")
+    if threads == 0:
+        sys.stderr.write("Tiene que haber al menos un hilo\n")
+        parser.print_help()
+        sys.exit(1)
+    min_threads = parse_count(parser, options.min_threads,
+                              "Cantidad mínima de hilos")
+    try:
+        idle_timeout = float(options.thread_idle_timeout)
+        if idle_timeout <= 0:
+            raise ValueError
+    except ValueError:
+        sys.stderr.write(
+            f"Tiempo de espera invalido: {repr(options.thread_idle_timeout)}\n")
+        parser.print_help()
+        sys.exit(1)
+
+    rate = parse_count(parser, options.rate, "Velocidad")
+    client_rate = parse_count(parser, options.client_rate,
+                              "Velocidad por conexión")
+
+    metrics_port = parse_count(parser, options.metrics_port,
+                               "Puerto de métricas")
+
+    compress_min = parse_count(parser, options.compress_min,
+                               "Tamaño mínimo para comprimir")
 
-    server = Server(options.address, port, options.datadir)
-    server.serve()
+    server_class = SERVER_MODES[options.mode]
+    server = server_class(options.address, port, options.datadir, chunk_size,
+                          chunk_cache, options.mmap, backlog, max_active,
+                          max_pending, max_per_client, threads, min_threads,
+                          idle_timeout, rate, client_rate, metrics_port,
+                          options.metrics_address, compress_min,
+                          options.checksum_dir)
+    if workers > 0:
+        server.serve_workers(workers)
+    else:
+        server.serve()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,148 @@
+# encoding: utf-8
+# Aviso de cambios en el directorio compartido por el server
+
+import ctypes
+import ctypes.util
+import os
+import struct
+import threading
+import time
+from constants import *
+
+# Constantes de inotify (ver inotify(7))
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 0o2000000
+
+IN_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+                 IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+                 IN_MOVE_SELF)
+
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+class DirectoryWatcher(object):
+    """
+    Avisa a los interesados cuando cambia algún archivo del directorio.
+
+    Los interesados se registran con subscribe, y se los llama (desde el
+    hilo del watcher) con el nombre del archivo que cambió, o con None si
+    pudo haber cambiado cualquiera.
+
+    En Linux usa inotify. Si no está disponible, revisa cada POLL_INTERVAL
+    segundos el tamaño y la fecha de modificación de todos los archivos.
+
+    'watching' indica si en este momento se está vigilando el directorio
+    (no es así, por ejemplo, si lo borraron y todavía no lo volvieron a
+    crear); mientras no, los caches no tienen que guardar nada.
+    """
+
+    def __init__(self, directory: str, poll_interval: float = POLL_INTERVAL):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.callbacks = []
+        self.thread = None
+        self.watching = False
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+    def notify(self, filename):
+        for callback in self.callbacks:
+            callback(filename)
+
+    def start(self):
+        """
+        Lanza el hilo que espera los cambios. Se tiene que llamar en el
+        proceso que atiende a los clientes (los hilos no sobreviven a un
+        fork).
+        """
+        if self.thread is not None:
+            return
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(IN_CLOEXEC)
+        except (OSError, AttributeError):
+            fd = -1
+        if fd < 0:
+            target, args = self._poll, ()
+        else:
+            target, args = self._watch, (libc, fd)
+        self.thread = threading.Thread(target=target, args=args, daemon=True)
+        self.thread.start()
+
+    def _watch(self, libc, fd: int):
+        """
+        Vigila el directorio con inotify. Si el directorio desaparece, se
+        espera a que vuelva a existir y se lo vuelve a vigilar.
+        """
+        while True:
+            wd = libc.inotify_add_watch(fd, os.fsencode(self.directory),
+                                        IN_WATCH_MASK)
+            if wd < 0:
+                time.sleep(self.poll_interval)
+                continue
+            self.watching = True
+            self.notify(None)
+            self._read_events(libc, fd, wd)
+            self.watching = False
+            self.notify(None)
+
+    def _read_events(self, libc, fd: int, wd: int):
+        """
+        Lee los eventos de inotify y avisa de cada cambio, hasta que se deja
+        de vigilar el directorio.
+        """
+        while True:
+            data = os.read(fd, 2 ** 16)
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_IGNORED:
+                    # El directorio se borró, o se dejó de vigilar
+                    return
+                elif mask & IN_MOVE_SELF:
+                    # El directorio ya no está en ese lugar; al dejar de
+                    # vigilarlo llega un IN_IGNORED
+                    libc.inotify_rm_watch(fd, wd)
+                elif mask & IN_Q_OVERFLOW or not name:
+                    self.notify(None)
+                else:
+                    self.notify(os.fsdecode(name))
+
+    def _poll(self):
+        self.watching = True
+        previous = self._scan()
+        while True:
+            time.sleep(self.poll_interval)
+            current = self._scan()
+            for filename in previous.keys() | current.keys():
+                if previous.get(filename) != current.get(filename):
+                    self.notify(filename)
+            previous = current
+
+    def _scan(self) -> dict:
+        result = {}
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    result[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            pass
+        return result